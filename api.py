@@ -0,0 +1,261 @@
+"""Read-only HTTP/JSON API over the processed dataset
+
+Serves the same data the dashboard shows, built by main.load_data:
+
+    GET /entidades                          entities and their tipo
+    GET /entidades/{entidad}/metricas       quarterly metrics and health scores
+    GET /entidades/{entidad}/competidores   peers of the same tipo closest in size (?n=3)
+    GET /metricas                           metrics of every entity (?tipo=Sociedad)
+    GET /sector                             sector aggregates per quarter and tipo
+    GET /version                            dataset version
+
+Responses carry an ETag derived from the dataset version, the format and the
+encoding, and are cached in process. The metrics are the ones stored in the
+version's snapshot. When the source files change (checked at most every
+RELOAD_CHECK_SECONDS) the dataset is rebuilt, so the version and the ETags change. They are gzip-compressed when the client accepts it, and Arrow IPC
+streams are returned for `Accept: application/vnd.apache.arrow.stream` or
+`?formato=arrow`.
+
+Run with:
+    uvicorn api:app --port 8000
+"""
+import asyncio
+import gzip
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+import pandas as pd
+
+import main
+
+ARROW_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+
+# Maximum number of encoded responses kept in memory
+RESPONSE_CACHE_SIZE = 512
+
+# Responses smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
+
+# Seconds between two checks of the source files for a data refresh
+RELOAD_CHECK_SECONDS = 30
+
+
+# Function to fingerprint the registered source files (path, size and modification time)
+def source_signature():
+    signature = []
+    for source in main.ENTITY_SOURCES.values():
+        try:
+            stat = os.stat(source['path'])
+            signature.append((source['path'], stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            signature.append((source['path'], None, None))
+    return tuple(signature)
+
+
+class DatasetCache:
+    """Processed dataset and encoded responses, reloaded when the source files change"""
+
+    def __init__(self):
+        self.combined = None
+        self.metrics = None
+        self.sector = None
+        self.version = None
+        self.signature = None
+        self.checked_at = 0.0
+        self.responses = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    async def ensure_loaded(self):
+        if self.combined is not None and time.monotonic() - self.checked_at < RELOAD_CHECK_SECONDS:
+            return
+        async with self._lock:
+            if self.combined is None or self.is_stale():
+                await asyncio.to_thread(self._load)
+
+    def is_stale(self):
+        self.checked_at = time.monotonic()
+        return source_signature() != self.signature
+
+    def _load(self):
+        signature = source_signature()
+        if self.signature is not None:
+            main.load_data.clear()
+            main.load_sector_aggregates.clear()
+        combined, version = main.load_data()
+        # The metrics and health scores stored with the build (recomputed if its snapshot could not be written)
+        metrics = main.read_snapshot_table(version, 'metrics')
+        if metrics is None:
+            metrics = main.entity_metrics_stage(combined)
+        self.metrics = metrics
+        self.sector = main.load_sector_aggregates()
+        self.version = version
+        self.responses.clear()
+        self.combined = combined
+        self.signature, self.checked_at = signature, time.monotonic()
+
+    def get_response(self, key):
+        body = self.responses.get(key)
+        if body is not None:
+            self.responses.move_to_end(key)
+        return body
+
+    def put_response(self, key, body):
+        self.responses[key] = body
+        if len(self.responses) > RESPONSE_CACHE_SIZE:
+            self.responses.popitem(last=False)
+
+
+cache = DatasetCache()
+
+
+# Route handlers: each returns a DataFrame or a JSON-serializable object
+def list_entities(params):
+    return cache.combined[['entidad', 'tipo']].drop_duplicates().sort_values('entidad')
+
+
+def entity_metrics(params, entity):
+    metrics = cache.metrics[cache.metrics['entidad'] == entity]
+    return metrics if not metrics.empty else None
+
+
+def entity_peers(params, entity):
+    if entity not in set(cache.combined['entidad']):
+        return None
+    n = int(params.get('n', ['3'])[0])
+    if n < 1:
+        raise ValueError('n debe ser un entero positivo')
+    return {'entidad': entity, 'competidores': main.find_similar_entities(cache.combined, entity, n=n)}
+
+
+def all_metrics(params):
+    tipo = params.get('tipo', [None])[0]
+    return cache.metrics if tipo is None else cache.metrics[cache.metrics['tipo'] == tipo]
+
+
+def sector(params):
+    return cache.sector
+
+
+def version(params):
+    return {'version': cache.version}
+
+
+ROUTES = [
+    (re.compile(r'^/entidades/?$'), list_entities),
+    (re.compile(r'^/entidades/(?P<entity>[^/]+)/metricas/?$'), entity_metrics),
+    (re.compile(r'^/entidades/(?P<entity>[^/]+)/competidores/?$'), entity_peers),
+    (re.compile(r'^/metricas/?$'), all_metrics),
+    (re.compile(r'^/sector/?$'), sector),
+    (re.compile(r'^/version/?$'), version),
+]
+
+
+# Function to encode a handler result as JSON or Arrow
+def encode(result, fmt):
+    if fmt == 'arrow' and isinstance(result, pd.DataFrame):
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(result, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), ARROW_MEDIA_TYPE
+    if isinstance(result, pd.DataFrame):
+        body = result.to_json(orient='records', date_format='iso', force_ascii=False)
+        return body.encode('utf-8'), 'application/json'
+    return json.dumps(result, ensure_ascii=False).encode('utf-8'), 'application/json'
+
+
+async def send_response(send, status, body=b'', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_error(send, status, message):
+    body = json.dumps({'error': message}, ensure_ascii=False).encode('utf-8')
+    await send_response(send, status, body, [('content-type', 'application/json'),
+                                             ('content-length', str(len(body)))])
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await cache.ensure_loaded()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    if scope['method'] not in ('GET', 'HEAD'):
+        await send_error(send, 405, 'Solo se admiten peticiones GET')
+        return
+
+    await cache.ensure_loaded()
+
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    params = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+    fmt = 'arrow' if (params.get('formato', [''])[0] == 'arrow'
+                      or ARROW_MEDIA_TYPE in headers.get('accept', '')) else 'json'
+    use_gzip = 'gzip' in headers.get('accept-encoding', '')
+
+    for pattern, handler in ROUTES:
+        match = pattern.match(scope['path'])
+        if match:
+            break
+    else:
+        await send_error(send, 404, 'Ruta no encontrada')
+        return
+
+    # Only resources that exist get a response (cached ones were validated when built)
+    version = cache.version
+    key = (version, scope['path'], scope.get('query_string', b''), fmt)
+    cached = cache.get_response(key)
+    if cached is None:
+        try:
+            result = await asyncio.to_thread(handler, params, **match.groupdict())
+        except ValueError as e:
+            await send_error(send, 400, str(e))
+            return
+        if result is None:
+            await send_error(send, 404, 'Entidad no encontrada')
+            return
+        body, media_type = encode(result, fmt)
+        cached = {'body': body, 'gzip': None, 'media_type': media_type}
+        cache.put_response(key, cached)
+
+    # Each representation (format and encoding) of a dataset version has its own ETag
+    use_gzip = use_gzip and len(cached['body']) >= GZIP_MIN_BYTES
+    encoding = '-gzip' if use_gzip else ''
+    etag = f'"{version}-{fmt}{encoding}"'
+    response_headers = [('etag', etag), ('cache-control', 'no-cache'), ('vary', 'accept, accept-encoding')]
+    if etag in [tag.strip() for tag in headers.get('if-none-match', '').split(',')]:
+        await send_response(send, 304, headers=response_headers)
+        return
+
+    body = cached['body']
+    response_headers.append(('content-type', cached['media_type']))
+    if use_gzip:
+        if cached['gzip'] is None:
+            cached['gzip'] = gzip.compress(body, compresslevel=6)
+        body = cached['gzip']
+        response_headers.append(('content-encoding', 'gzip'))
+    response_headers.append(('content-length', str(len(body))))
+
+    await send_response(send, 200, b'' if scope['method'] == 'HEAD' else body, response_headers)
@@ -0,0 +1,308 @@
+"""Benchmarks for the dashboard pipeline and charts
+
+Usage:
+    python benchmark.py              # run every section
+    python benchmark.py rendering    # run only the named sections
+
+Each section prints a small table to stdout.
+"""
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from plotly.subplots import make_subplots
+
+import main
+
+
+# Function to time a callable, returning (best seconds, last result)
+def timed(func, repeat=3):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+# Function to print a list of dicts as an aligned table
+def print_table(title, rows):
+    print(f"\n## {title}\n")
+    if not rows:
+        print("(sin resultados)")
+        return
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+# Function to build synthetic quarterly series for many entities
+def synthetic_series(n_entities, n_quarters, seed=0):
+    rng = np.random.default_rng(seed)
+    periods = [f"{1990 + q // 4} Q{q % 4 + 1}" for q in range(n_quarters)]
+    values = np.cumsum(rng.normal(0, 50, size=(n_entities, n_quarters)), axis=1) + 1000
+    return periods, values
+
+
+# Function to build a chart the way the tabs do, in the given rendering mode
+def build_figure(periods, values, render_mode):
+    main.load_plotting()
+    fig = make_subplots(rows=1, cols=2, specs=[[{'secondary_y': True}, {'secondary_y': False}]])
+    for i, series in enumerate(values):
+        fig.add_trace(
+            main.bar_trace(x=periods, y=series, name=f'E{i}', opacity=0.7,
+                           text=np.round(series, 0), textposition='outside', render_mode=render_mode),
+            row=1, col=1, secondary_y=False
+        )
+        fig.add_trace(
+            main.line_trace(x=periods, y=series, name=f'E{i}', mode='lines+markers',
+                            marker=dict(size=10), render_mode=render_mode),
+            row=1, col=2
+        )
+    fig.update_layout(**main.professional_theme['layout'], height=700)
+    return fig
+
+
+# Rendering: payload size and serialization time, standard vs lightweight figures
+def bench_rendering():
+    scenarios = [
+        ('1 entidad x 18 trim.', 1, 18),
+        ('1 entidad x 400 trim.', 1, 400),
+        ('1 entidad x 5.000 trim.', 1, 5000),
+        ('300 entidades x 80 trim.', 300, 80),
+        ('20 entidades x 2.000 trim.', 20, 2000),
+    ]
+    rows = []
+    for label, n_entities, n_quarters in scenarios:
+        periods, values = synthetic_series(n_entities, n_quarters)
+        for render_mode in ['estandar', 'ligero']:
+            build_time, fig = timed(lambda: build_figure(periods, values, render_mode))
+            json_time, payload = timed(lambda: fig.to_json())
+            rows.append({
+                'escenario': label,
+                'modo': render_mode,
+                'construccion_ms': round(build_time * 1000, 1),
+                'serializacion_ms': round(json_time * 1000, 1),
+                'payload_kb': round(len(payload) / 1024, 1),
+                'payload_gzip_kb': round(len(gzip.compress(payload.encode())) / 1024, 1),
+            })
+    print_table("Renderizado de gráficos (estándar vs ligero)", rows)
+    print("\nEl tiempo de dibujo en el navegador no se mide aquí; payload y serialización "
+          "son el coste del lado del servidor y de la transferencia.")
+
+
+# Function to build a synthetic processed dataset shaped like load_data's output
+def synthetic_dataset(n_entities, n_quarters, seed=0):
+    rng = np.random.default_rng(seed)
+    fechas = pd.date_range('1990-03-31', periods=n_quarters, freq='QE')
+    n = n_entities * n_quarters
+    size = np.repeat(rng.lognormal(8, 1.5, n_entities), n_quarters)
+    revenue = size * rng.uniform(0.02, 0.2, n)
+    margin = revenue * rng.uniform(0.6, 1.0, n)
+    return pd.DataFrame({
+        'entidad': np.repeat([f'ENTIDAD {i:06d}' for i in range(n_entities)], n_quarters),
+        'tipo': np.repeat(np.where(np.arange(n_entities) % 3 == 0, 'Sociedad', 'Agencia'), n_quarters),
+        'fecha': np.tile(fechas, n_entities),
+        'periodo': np.tile([f"{f.year} Q{f.quarter}" for f in fechas], n_entities),
+        'activos_totales': size,
+        'fondos_propios': size * rng.uniform(0.2, 0.8, n),
+        'comisiones_percibidas': revenue,
+        'comisiones_netas': revenue * 0.8,
+        'margen_bruto': margin,
+        'gastos_explotacion': margin * rng.uniform(0.5, 1.3, n),
+        'resultados_antes_impuestos': margin * rng.normal(0.1, 0.2, n),
+    })
+
+
+# Scaling: per-entity pipeline stages on 1..N worker processes
+def bench_scaling():
+    cores = os.cpu_count() or 1
+    worker_counts = sorted({1, *[2 ** i for i in range(1, cores.bit_length())], cores})
+    data = synthetic_dataset(n_entities=20_000, n_quarters=40)
+    stages = [
+        ('rolling', main.add_rolling_metrics, data, {'sort_by': ['entidad', 'fecha'], 'ignore_index': True}),
+        ('métricas + salud', main.entity_metrics_stage, data, {'sort_by': ['entidad', 'fecha'], 'ignore_index': True}),
+        ('z-score entidad', main.entity_z_scores, main.compute_quarterly_metrics(data), {}),
+    ]
+    rows = []
+    for label, func, frame, options in stages:
+        baseline = None
+        for workers in worker_counts:
+            elapsed, _ = timed(lambda: main.run_by_entity(func, frame, workers=workers, min_rows=0, **options),
+                               repeat=2)
+            baseline = baseline or elapsed
+            rows.append({
+                'etapa': label,
+                'filas': len(frame),
+                'procesos': workers,
+                'tiempo_s': round(elapsed, 3),
+                'aceleracion': round(baseline / elapsed, 2),
+                'eficiencia': round(baseline / elapsed / workers, 2),
+            })
+    print_table(f"Escalado por procesos ({cores} núcleos disponibles)", rows)
+    print("\nCon 1 proceso la etapa se ejecuta en el proceso principal; el resto incluye "
+          "arrancar el pool, copiar la entrada a memoria compartida y devolver los resultados.")
+
+
+# Startup targets: importing main.py (everything before the first element is
+# drawn), the first script run (cold caches) and a rerun with warm caches. A rerun
+# is timed through AppTest, which adds about 180 ms of its own per run (building
+# the element tree) to the ~200 ms the script takes, so the rerun target is set
+# from those measurements rather than from the script time alone
+STARTUP_TARGETS = {
+    'importacion_ms': 500,
+    'primera_ejecucion_ms': 3000,
+    'reejecucion_ms': 450,
+}
+
+
+# Function to run `python -X importtime -c "import main"` and parse its report
+def import_time_report():
+    """Total import time of main (ms) and its direct imports sorted by cumulative time"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        entries.append((name[1:], int(cumulative_us)))
+    # Direct imports of main are the two-space entries reported just before it
+    main_at = next(i for i, (name, _) in enumerate(entries) if name == 'main')
+    start = max((i for i in range(main_at) if not entries[i][0].startswith(' ')), default=-1) + 1
+    children = [(name.strip(), cumulative / 1000) for name, cumulative in entries[start:main_at]
+                if name.startswith('  ') and not name.startswith('   ')]
+    return entries[main_at][1] / 1000, sorted(children, key=lambda item: -item[1])
+
+
+# Startup: import time of main.py, first run and per-rerun overhead against STARTUP_TARGETS
+def bench_startup():
+    reports = [import_time_report() for _ in range(3)]
+    total_ms, children = min(reports, key=lambda report: report[0])
+    print_table("Importación de main.py (-X importtime, mejor de 3)",
+                [{'modulo': name, 'acumulado_ms': round(ms, 1)} for name, ms in children[:10]])
+    
+    from streamlit.testing.v1 import AppTest
+    
+    app = AppTest.from_file(os.path.abspath(main.__file__), default_timeout=300)
+    first_run, _ = timed(app.run, repeat=1)
+    rerun, _ = timed(app.run, repeat=3)
+    
+    measured = {'importacion_ms': total_ms, 'primera_ejecucion_ms': first_run * 1000, 'reejecucion_ms': rerun * 1000}
+    print_table("Arranque frente a objetivos", [
+        {'medida': name, 'ms': round(value, 1), 'objetivo_ms': STARTUP_TARGETS[name],
+         'cumple': 'sí' if value <= STARTUP_TARGETS[name] else 'no'}
+        for name, value in measured.items()
+    ])
+
+
+# Function to build synthetic raw YTD filings shaped like the source spreadsheets
+def synthetic_raw_filings(n_entities, n_years, tipo, seed=0):
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    names = np.array([''.join(rng.choice(letters, 12)) + ', S.V., S.A.' for _ in range(n_entities)])
+    months = np.array(list(main.MONTH_ORDER))
+    n = n_entities * n_years * 4
+    entity = np.repeat(np.arange(n_entities), n_years * 4)
+    year = np.tile(np.repeat(np.arange(2000, 2000 + n_years), 4), n_entities)
+    quarter = np.tile(np.arange(4), n_entities * n_years)
+    size = rng.lognormal(8, 1.5, n_entities)[entity]
+    ytd = (size[:, None] * rng.uniform(0.005, 0.05, (n, 5))).reshape(-1, 4, 5).cumsum(axis=1).reshape(n, 5)
+    filings = pd.DataFrame({
+        'Tipo_Entidad': tipo,
+        'Periodo': months[quarter] + ' ' + year.astype(str),
+        'Año': year,
+        'Mes': months[quarter],
+        'Denominación': names[entity],
+        'Fondos_Propios_Miles_EUR': size * rng.uniform(0.2, 0.8, n),
+        'Activos_Totales_Miles_EUR': size,
+        **dict(zip(main.YTD_COLUMNS, ytd.T)),
+        'Fecha': pd.to_datetime(pd.DataFrame({'year': year, 'month': quarter * 3 + 3, 'day': 1})),
+    })
+    # Some filings are missing, so the imputation runs too
+    return filings[rng.random(n) > 0.02]
+
+
+# Function to read the peak RSS of this process in MB
+def peak_rss_mb():
+    """VmHWM from /proc (ru_maxrss would include the parent's peak when it was forked)"""
+    try:
+        with open('/proc/self/status') as status:
+            return next(int(line.split()[1]) for line in status if line.startswith('VmHWM')) / 1024
+    except OSError:
+        import resource
+        
+        scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+# Function run in a fresh process by bench_memory: build the dataset, report time and peak RSS as JSON
+def memory_run(mode, paths, budget_mb):
+    sources = {tipo: dict(main.ENTITY_SOURCES[tipo], path=path) for tipo, path in paths.items()}
+    base = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == 'en_memoria':
+        main.ENTITY_SOURCES.update(sources)
+        main.CHUNKED_INPUT_BYTES = float('inf')
+        main.load_data()
+    else:
+        main.build_dataset_chunked(sources, memory_budget_mb=budget_mb)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'tiempo_s': elapsed, 'base_mb': base, 'pico_mb': peak_rss_mb()}))
+
+
+# Memory: peak RSS of the in-memory pipeline and of the chunked one on growing raw inputs
+def bench_memory(budget_mb=256):
+    scenarios = [
+        ('2 x 2.500 entidades x 10 años', 2_500, 10),
+        ('2 x 5.000 entidades x 10 años', 5_000, 10),
+        ('2 x 10.000 entidades x 10 años', 10_000, 10),
+    ]
+    here = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    with tempfile.TemporaryDirectory() as work:
+        for label, n_entities, n_years in scenarios:
+            paths = {}
+            for seed, tipo in enumerate(['Sociedad', 'Agencia']):
+                paths[tipo] = os.path.join(work, f'{tipo}.parquet')
+                filings = synthetic_raw_filings(n_entities, n_years, tipo, seed)
+                filings.to_parquet(paths[tipo], index=False, row_group_size=main.RAW_CHUNK_ROWS)
+            raw_mb = sum(pd.read_parquet(path).memory_usage(deep=True).sum() for path in paths.values()) / 2 ** 20
+            for mode in ['en_memoria', 'por_lotes']:
+                result = subprocess.run(
+                    [sys.executable, '-c', f'import benchmark; benchmark.memory_run({mode!r}, {paths!r}, {budget_mb})'],
+                    capture_output=True, text=True, cwd=work, env={**os.environ, 'PYTHONPATH': here}
+                )
+                report = json.loads(result.stdout.splitlines()[-1])
+                rows.append({
+                    'escenario': label,
+                    'modo': mode,
+                    'bruto_mb': round(raw_mb, 1),
+                    'tiempo_s': round(report['tiempo_s'], 1),
+                    'rss_pico_mb': round(report['pico_mb']),
+                    'rss_pipeline_mb': round(report['pico_mb'] - report['base_mb']),
+                })
+                shutil.rmtree(os.path.join(work, 'store'), ignore_errors=True)
+    print_table(f"Memoria del pipeline (presupuesto por lotes: {budget_mb} MB)", rows)
+    print("\nrss_pipeline_mb es el pico de RSS (VmHWM) menos el pico tras importar; "
+          "en 'por_lotes' el pico depende del presupuesto, no del tamaño de la entrada.")
+
+
+SECTIONS = {
+    'rendering': bench_rendering,
+    'scaling': bench_scaling,
+    'startup': bench_startup,
+    'memory': bench_memory,
+}
+
+
+if __name__ == "__main__":
+    selected = sys.argv[1:] or list(SECTIONS)
+    for name in selected:
+        SECTIONS[name]()
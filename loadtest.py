@@ -0,0 +1,129 @@
+"""Load test for the metrics API (api.py)
+
+Starts the API with uvicorn on a local port (or targets a running one with
+--url) and reports requests/sec and latency percentiles per endpoint:
+
+    python loadtest.py
+    python loadtest.py --url http://127.0.0.1:8000 --concurrency 32 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from urllib.parse import quote, urlsplit
+
+
+# Function to perform GET requests on a keep-alive connection until the deadline
+async def worker(host, port, paths, deadline, headers, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    extra = ''.join(f'{k}: {v}\r\n' for k, v in headers.items())
+    i = 0
+    try:
+        while time.perf_counter() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\n{extra}\r\n'.encode('latin-1'))
+            await writer.drain()
+            status_line = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value.strip())
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if not status_line.startswith(b'HTTP/1.1 2') and not status_line.startswith(b'HTTP/1.1 304'):
+                errors.append(status_line)
+    finally:
+        writer.close()
+
+
+async def run_load(url, paths, concurrency, duration, headers):
+    parts = urlsplit(url)
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        worker(parts.hostname, parts.port or 80, paths, deadline, headers, latencies, errors)
+        for _ in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def wait_until_ready(url, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f'{url}/version', timeout=5):
+                return True
+        except OSError:
+            time.sleep(0.5)
+    return False
+
+
+def fetch_entities(url):
+    with urllib.request.urlopen(f'{url}/entidades', timeout=30) as response:
+        return [row['entidad'] for row in json.loads(response.read())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='URL of a running API; if omitted a local server is started')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        url = f'http://127.0.0.1:{args.port}'
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'api:app', '--port', str(args.port),
+             '--log-level', 'warning', '--no-access-log'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    try:
+        if not wait_until_ready(url):
+            sys.exit('La API no respondió a tiempo')
+
+        entities = fetch_entities(url)[:50]
+        scenarios = [
+            ('/version', ['/version'], {}),
+            ('/entidades/{e}/metricas (json)', [f'/entidades/{quote(e)}/metricas' for e in entities], {}),
+            ('/entidades/{e}/metricas (gzip)', [f'/entidades/{quote(e)}/metricas' for e in entities],
+             {'Accept-Encoding': 'gzip'}),
+            ('/metricas (arrow+gzip)', ['/metricas?formato=arrow'], {'Accept-Encoding': 'gzip'}),
+            ('/sector (json)', ['/sector'], {}),
+        ]
+
+        print(f"\n## Carga sobre {url} ({args.concurrency} conexiones, {args.duration:.0f}s por escenario)\n")
+        print(f"{'escenario':<36}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errores':>10}")
+        for label, paths, headers in scenarios:
+            latencies, errors, elapsed = asyncio.run(
+                run_load(url, paths, args.concurrency, args.duration, headers)
+            )
+            if not latencies:
+                print(f"{label:<36}{'-':>10}")
+                continue
+            ordered = sorted(latencies)
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            print(f"{label:<36}{len(latencies) / elapsed:>10.0f}"
+                  f"{statistics.median(ordered) * 1000:>10.2f}{p99 * 1000:>10.2f}{len(errors):>10}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,62 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
 import numpy as np
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import hashlib
+import io
+import itertools
+import os
+import re
+import shutil
+import tempfile
+import unicodedata
 import warnings
 warnings.filterwarnings('ignore')
 
-# Page configuration
-st.set_page_config(
-    page_title="Análisis Financiero - ESIs y AVs",
-    page_icon="📊",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+# Plotting modules, imported on first use by load_plotting()
+go = None
+make_subplots = None
+
+# Distinct empty subplot grids kept for reuse (the titles of some grids name a quarter)
+SUBPLOT_GRID_CACHE_SIZE = 64
+
+# Function to wrap make_subplots so that each grid is built once and then copied
+def reuse_subplot_grids(build, figure):
+    """make_subplots validates every axis and annotation of the grid, which made it the
+    largest cost of a rerun; copying the empty grid built earlier with the same options
+    is about three times faster. The cached grids are never modified."""
+    grids = {}
+    
+    def make(**options):
+        key = repr(sorted(options.items()))
+        grid = grids.get(key)
+        if grid is None:
+            if len(grids) >= SUBPLOT_GRID_CACHE_SIZE:
+                grids.clear()
+            grid = grids[key] = build(**options)
+        return figure(grid)
+    return make
+
+# Function to import the plotting stack once per server process
+@st.cache_resource
+def plotting_modules():
+    """Kept across reruns, which execute this script from the top and would reset the
+    module-level bindings (and the subplot grids) on every interaction"""
+    import plotly.graph_objects
+    from plotly.subplots import make_subplots as plotly_make_subplots
+    return plotly.graph_objects, reuse_subplot_grids(plotly_make_subplots, plotly.graph_objects.Figure)
+
+# Function to import the plotting stack only when a chart is about to be drawn
+def load_plotting():
+    """Bind plotly's graph_objects and make_subplots; a no-op once loaded"""
+    global go, make_subplots
+    if go is None:
+        go, make_subplots = plotting_modules()
 
 # Professional CSS styling (unchanged)
-st.markdown("""
+APP_CSS = """
     <style>
     @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700;800;900&display=swap');
     
@@ -145,20 +184,8 @@ st.markdown("""
         backdrop-filter: blur(10px);
     }
     
-    /* Badges de tipo */
-    .type-badge-sociedad {
-        background: linear-gradient(135deg, #b794f6 0%, #9f7aea 100%);
-        color: white;
-        padding: 4px 12px;
-        border-radius: 16px;
-        font-size: 11px;
-        font-weight: 600;
-        letter-spacing: 0.5px;
-        display: inline-block;
-    }
-    
-    .type-badge-agencia {
-        background: linear-gradient(135deg, #00d4ff 0%, #0091ff 100%);
+    /* Badges de tipo (el color de fondo es el del tipo) */
+    .type-badge {
         color: white;
         padding: 4px 12px;
         border-radius: 16px;
@@ -168,7 +195,23 @@ st.markdown("""
         display: inline-block;
     }
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+# Function to configure the page and inject the stylesheet
+def configure_page():
+    """Page config and CSS, sent once at the top of each run
+    
+    Streamlit drops elements that a rerun does not send again, so the <style>
+    block cannot be skipped on reruns; it is a constant string, so this only
+    costs one small message.
+    """
+    st.set_page_config(
+        page_title="Análisis Financiero - ESIs y AVs",
+        page_icon="📊",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+    st.markdown(APP_CSS, unsafe_allow_html=True)
 
 # Function to clean and standardize entity names
 def clean_entity_name(name):
@@ -187,12 +230,206 @@ def clean_entity_name(name):
     name = name.rstrip('.,')
     return name
 
-# Function to detect and merge duplicate entities
-def merge_duplicate_entities(df):
-    """Detect and merge entities that are likely duplicates"""
-    if df.empty:
-        return df
+# Minimum trigram Jaccard similarity for two name variants to be merged
+FUZZY_MATCH_THRESHOLD = 0.8
+
+# Blocking keys shared by more names than this are too generic to compare
+MAX_BLOCK_SIZE = 200
+
+# Legal-form tokens ignored when comparing names
+LEGAL_FORM_TOKENS = {'S', 'A', 'SA', 'SAU', 'SL', 'SLU', 'SV', 'AV', 'SGIIC', 'EAF', 'DE', 'Y'}
+
+# Function to build the normalized key used for fuzzy matching
+def entity_match_key(name):
+    """Uppercase, accent-free, punctuation-free name with legal forms removed and tokens sorted"""
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode().upper()
+    tokens = re.sub(r'[^A-Z0-9]+', ' ', name.replace('.', '')).split()
+    core = [token for token in tokens if token not in LEGAL_FORM_TOKENS] or tokens
+    return ' '.join(sorted(core))
+
+# Function to get the character trigrams of a match key
+def name_trigrams(key):
+    padded = f'  {key} '
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+# Function to compute the trigram Jaccard similarity of two trigram sets
+def trigram_similarity(a, b):
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+# Function to compact a name for the legacy matching rules
+def compact_entity_name(name):
+    return name.upper().replace('.', '').replace(',', '').replace(' ', '')
+
+# Function to name the legacy rule matching two compact names, if any
+def legacy_match_rule(a, b):
+    if a in b or b in a:
+        return 'contenido'
+    if a.startswith(b[:min(10, len(b))]) or b.startswith(a[:min(10, len(a))]):
+        return 'prefijo'
+    return None
+
+# Substring length used to look up the names that contain a given name
+CONTAINMENT_GRAM = 5
+
+# Up to this many names, comparing every pair is faster than the substring lookup
+LEGACY_PAIRWISE_MAX_NAMES = 300
+
+# Function to find every pair of names matched by the legacy containment/prefix rules
+def legacy_match_pairs(compact):
+    """Pairs (i, j), i < j, of compact names where one contains the other or both share the 10-char prefix
     
+    Gives the same pairs as comparing every pair, without doing so. A name is only
+    checked against the names holding its rarest CONTAINMENT_GRAM-char substring
+    (or the whole name, if shorter), which any name containing it must hold.
+    Names sharing the 10-char prefix are chained, which links them all.
+    """
+    if len(compact) <= LEGACY_PAIRWISE_MAX_NAMES:
+        return [(i, j) for i, j in itertools.combinations(range(len(compact)), 2)
+                if compact[i] and compact[j] and legacy_match_rule(compact[i], compact[j])]
+    
+    pairs = set()
+    by_prefix = {}
+    for i, name in enumerate(compact):
+        if len(name) >= 10:
+            by_prefix.setdefault(name[:10], []).append(i)
+    for members in by_prefix.values():
+        pairs.update(zip(members, members[1:]))
+    
+    # Substrings of every name, for each anchor length in use
+    names = pd.Series(compact, dtype=object)
+    lengths = names.str.len()
+    anchor_lengths = lengths.clip(upper=CONTAINMENT_GRAM)
+    grams = []
+    for size in sorted(set(anchor_lengths[anchor_lengths > 0])):
+        for start in range(int(lengths.max()) - size + 1):
+            holders = names[lengths >= start + size]
+            grams.append(pd.DataFrame({'id': holders.index, 'largo': size,
+                                       'gram': holders.str[start:start + size].to_numpy()}))
+    if not grams:
+        return sorted(pairs)
+    grams = pd.concat(grams, ignore_index=True).drop_duplicates()
+    grams['frecuencia'] = grams.groupby(['largo', 'gram'])['id'].transform('size')
+    
+    # Anchor of each name: its rarest substring of the anchor length
+    anchors = grams[grams['largo'].to_numpy() == anchor_lengths.to_numpy()[grams['id'].to_numpy()]]
+    anchors = anchors.sort_values(['id', 'frecuencia', 'gram']).drop_duplicates('id')
+    candidates = anchors[['id', 'largo', 'gram']].merge(grams[['id', 'largo', 'gram']], on=['largo', 'gram'],
+                                                        suffixes=('', '_contiene'))
+    candidates = candidates[candidates['id'] != candidates['id_contiene']]
+    for short, long in zip(candidates['id'].tolist(), candidates['id_contiene'].tolist()):
+        if compact[short] in compact[long]:
+            pairs.add((min(short, long), max(short, long)))
+    return sorted(pairs)
+
+# Function to find groups of name variants and their canonical name
+def match_entity_names(names, quality_scores, threshold=FUZZY_MATCH_THRESHOLD):
+    """Map name variants to the best version of each entity
+    
+    A pair matches by the legacy containment/prefix rules on the compact
+    (punctuation- and space-free) name, found over all pairs by
+    legacy_match_pairs, or when its trigram Jaccard similarity reaches threshold
+    (None disables the fuzzy rule). Fuzzy candidates come from blocking (shared
+    name tokens, 4-char token prefixes and the 10-char compact prefix), so only
+    names in a common block are compared. Matches are grouped transitively and
+    each group maps to the version with the highest quality score, then the
+    longest name; only the names matching that canonical name directly are
+    merged into it, and the others of the group are grouped again. The result
+    is deterministic.
+    
+    Returns the mapping {variant: canonical} and an audit table of the merges,
+    whose regla is the rule matching each variant to its canonical name.
+    """
+    audit_columns = ['entidad_original', 'entidad_canonica', 'similitud', 'regla']
+    names = list(names)
+    if len(names) < 2:
+        return {}, pd.DataFrame(columns=audit_columns)
+    
+    keys = [entity_match_key(name) for name in names]
+    compact = [compact_entity_name(name) for name in names]
+    trigrams = [name_trigrams(key) for key in keys]
+    sizes = [len(grams) for grams in trigrams]
+    pairs = legacy_match_pairs(compact)
+    
+    if threshold is not None:
+        # Blocking: one row per (name, block key)
+        block_rows = []
+        for i, key in enumerate(keys):
+            tokens = key.split()
+            block_keys = set(tokens) | {token[:4] for token in tokens if len(token) > 4}
+            block_keys.add('P:' + compact[i][:10])
+            block_rows.extend((i, block_key) for block_key in block_keys)
+        blocks = pd.DataFrame(block_rows, columns=['id', 'bloque'])
+        block_size = blocks.groupby('bloque')['id'].transform('size')
+        blocks = blocks[(block_size > 1) & (block_size <= MAX_BLOCK_SIZE)]
+        
+        candidates = blocks.merge(blocks, on='bloque')
+        candidates = candidates[candidates['id_x'] < candidates['id_y']][['id_x', 'id_y']].drop_duplicates()
+        for a, b in zip(candidates['id_x'].tolist(), candidates['id_y'].tolist()):
+            # Size filter: Jaccard can never exceed min/max of the set sizes
+            if (min(sizes[a], sizes[b]) >= threshold * max(sizes[a], sizes[b])
+                    and trigram_similarity(trigrams[a], trigrams[b]) >= threshold):
+                pairs.append((a, b))
+    
+    # Function to name the rule matching two names directly, if any
+    def direct_rule(i, j):
+        rule = legacy_match_rule(compact[i], compact[j]) if compact[i] and compact[j] else None
+        if rule is None and threshold is not None and trigram_similarity(trigrams[i], trigrams[j]) >= threshold:
+            rule = 'trigramas'
+        return rule
+    
+    # Union-find over matching pairs
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    # Each component of the matching pairs keeps the names that match its canonical name
+    # directly; the others are grouped again among themselves, so chains of matches
+    # (A ~ B ~ C with A !~ C) never merge unrelated names
+    mapping = {}
+    audit_rows = []
+    remaining = {i for pair in pairs for i in pair}
+    while remaining:
+        parent = {i: i for i in remaining}
+        for a, b in pairs:
+            if a in parent and b in parent:
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+        
+        groups = {}
+        for i in sorted(remaining):
+            groups.setdefault(find(i), []).append(i)
+        
+        remaining = set()
+        for members in groups.values():
+            best = min(members, key=lambda i: (-quality_scores[i], -len(names[i]), names[i]))
+            for i in members:
+                if i == best:
+                    continue
+                rule = direct_rule(i, best)
+                if rule is None:
+                    remaining.add(i)
+                    continue
+                mapping[names[i]] = names[best]
+                audit_rows.append({
+                    'entidad_original': names[i],
+                    'entidad_canonica': names[best],
+                    'similitud': round(trigram_similarity(trigrams[i], trigrams[best]), 4),
+                    'regla': rule
+                })
+    
+    audit = pd.DataFrame(audit_rows, columns=audit_columns)
+    audit = audit.sort_values(['entidad_canonica', 'entidad_original']).reset_index(drop=True)
+    return mapping, audit
+
+# Function to score the data quality of every entity, used to pick canonical names
+def entity_quality_scores(df):
+    """One row per entity with its aggregates and quality_score, sorted by name"""
     # Group entities and calculate their data quality
     entity_quality = df.groupby('entidad').agg({
         'comisiones_percibidas': ['sum', 'count', 'max'],
@@ -209,61 +446,10 @@ def merge_duplicate_entities(df):
         (entity_quality['activos_totales_sum'] > 0).astype(int) * 5 +
         entity_quality['comisiones_percibidas_count'] * 2
     )
-    
-    # Sort by entity name to group similar names together
-    entity_quality = entity_quality.sort_values('entidad')
-    
-    # Dictionary to map duplicates to the best version
-    entity_mapping = {}
-    processed = set()
-    
-    entities = entity_quality['entidad'].tolist()
-    
-    for i, entity1 in enumerate(entities):
-        if entity1 in processed:
-            continue
-            
-        # Check for potential duplicates
-        potential_duplicates = []
-        entity1_upper = entity1.upper().replace('.', '').replace(',', '').replace(' ', '')
-        
-        for j, entity2 in enumerate(entities):
-            if i == j or entity2 in processed:
-                continue
-                
-            entity2_upper = entity2.upper().replace('.', '').replace(',', '').replace(' ', '')
-            
-            # Check if one is contained in the other or they're very similar
-            if (entity1_upper in entity2_upper or 
-                entity2_upper in entity1_upper or
-                entity1_upper.startswith(entity2_upper[:min(10, len(entity2_upper))]) or
-                entity2_upper.startswith(entity1_upper[:min(10, len(entity1_upper))])):
-                
-                potential_duplicates.append(entity2)
-        
-        if potential_duplicates:
-            # Include the original entity in the list
-            all_versions = [entity1] + potential_duplicates
-            
-            # Get quality scores for all versions
-            versions_with_scores = []
-            for version in all_versions:
-                score = entity_quality[entity_quality['entidad'] == version]['quality_score'].values
-                if len(score) > 0:
-                    versions_with_scores.append((version, score[0]))
-            
-            # Sort by quality score (descending) and then by name length (longer is usually more complete)
-            versions_with_scores.sort(key=lambda x: (-x[1], -len(x[0])))
-            
-            # The best version is the one with highest score
-            best_version = versions_with_scores[0][0]
-            
-            # Map all versions to the best one
-            for version, _ in versions_with_scores:
-                if version != best_version:
-                    entity_mapping[version] = best_version
-                processed.add(version)
-    
+    return entity_quality
+
+# Function to rename name variants to their canonical name and keep one row per entity-period
+def apply_entity_mapping(df, entity_mapping):
     # Apply the mapping
     if entity_mapping:
         df['entidad'] = df['entidad'].replace(entity_mapping)
@@ -278,12 +464,152 @@ def merge_duplicate_entities(df):
     
     df = df.sort_values(['entidad', 'periodo', 'data_completeness'], ascending=[True, True, False])
     df = df.drop_duplicates(subset=['entidad', 'periodo'], keep='first')
-    df = df.drop('data_completeness', axis=1)
+    return df.drop('data_completeness', axis=1)
+
+# Function to detect and merge duplicate entities
+def merge_duplicate_entities(df, threshold=FUZZY_MATCH_THRESHOLD, return_audit=False):
+    """Detect and merge entities that are likely duplicates
+    
+    With return_audit=True a table with one row per merged name is also returned.
+    A threshold of None disables the fuzzy stage and keeps only the legacy rules.
+    """
+    if df.empty:
+        return (df, match_entity_names([], [])[1]) if return_audit else df
+    
+    entity_quality = entity_quality_scores(df)
+    
+    # Match name variants (legacy substring/prefix rules over all pairs, trigram similarity within blocks)
+    entity_mapping, audit = match_entity_names(
+        entity_quality['entidad'].tolist(),
+        entity_quality['quality_score'].tolist(),
+        threshold=threshold
+    )
+    
+    df = apply_entity_mapping(df, entity_mapping)
     
+    if return_audit:
+        return df, audit
     return df
 
+# Month order of the YTD filings within a year
+MONTH_ORDER = {'MARZO': 1, 'JUNIO': 2, 'SEPTIEMBRE': 3, 'DICIEMBRE': 4}
+
+# Income statement columns that are accumulated YTD (need conversion)
+YTD_COLUMNS = [
+    'Comisiones_Percibidas_Miles_EUR',
+    'Comisiones_Netas_Miles_EUR',
+    'Margen_Bruto_Miles_EUR',
+    'Gastos_Explotación_Miles_EUR',
+    'Resultados_Antes_Impuestos_Miles_EUR'
+]
+
+# Methods to estimate a quarter when earlier filings of the same year are missing
+IMPUTATION_METHODS = {
+    'estacional': 'Perfil estacional (entidad, o pares del mismo tipo)',
+    'proporcional': 'Reparto proporcional fijo (/2, /3, /4)'
+}
+
+# Default imputation method used when building the dataset
+IMPUTATION_METHOD = 'estacional'
+
+# Function to lay out the YTD filings of a raw frame by entity-year
+def ytd_layout(df):
+    """Clean names, drop unusable filings and index the rest by entity-year
+    
+    Returns (df, group, quarter, present): the filings kept (one per entity,
+    year and month, sorted by entity and year), the entity-year group and the
+    quarter (1-4) of each, and a (groups x 5) mask of the filed quarters whose
+    column 0 ("start of year") is always set.
+    """
+    # First, clean entity names
+    df['Denominación'] = df['Denominación'].apply(clean_entity_name)
+    
+    # Remove rows where entity name is None or empty, and months that are not quarter ends
+    df = df[df['Denominación'].notna() & (df['Denominación'] != '') & df['Mes'].isin(MONTH_ORDER)]
+    
+    # One filing per entity, year and month (the latest one wins)
+    df = df.sort_values(['Denominación', 'Año', 'Fecha'], kind='stable')
+    df = df.drop_duplicates(['Denominación', 'Año', 'Mes'], keep='last')
+    
+    # Wide (entity-year x month) layout with a zero column for "start of year"
+    group = df.groupby(['Denominación', 'Año'], sort=False).ngroup().to_numpy()
+    quarter = df['Mes'].map(MONTH_ORDER).to_numpy(dtype=int)
+    present = np.zeros((group.max() + 1 if len(group) else 0, 5), dtype=bool)
+    present[:, 0] = True
+    present[group, quarter] = True
+    return df, group, quarter, present
+
+# Function to get the peer group label of every entity-year
+def ytd_peer_labels(df, group, n_groups):
+    peers = df['Tipo_Entidad'] if 'Tipo_Entidad' in df.columns else pd.Series('', index=df.index)
+    labels = np.empty(n_groups, dtype=object)
+    labels[group] = peers.astype(str).to_numpy()
+    return labels
+
+# Function to compute each quarter's share of the annual total of every entity-year
+def seasonal_shares(values, present):
+    """(shares, valid) for YTD figures laid out as (year-groups x 5) with column 0 = 0
+    
+    Only complete years with a positive annual total and no negative quarter
+    are valid for learning a profile.
+    """
+    quarters = np.diff(values, axis=1)                                  # (G, 4)
+    annual = values[:, 4]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = quarters / annual[:, np.newaxis]
+    valid = present[:, 1:].all(axis=1) & (annual > 0) & (quarters >= 0).all(axis=1)
+    return shares, valid
+
+# Function to learn the share of each quarter in the annual total
+def seasonal_profiles(values, present, entity_codes, peer_codes, peer_profile=None):
+    """Quarter shares per row's entity, falling back to its peer group and then to equal shares
+    
+    values holds the YTD figures as (year-groups x 5) with column 0 = 0. Only
+    complete years with a positive annual total and no negative quarter teach a
+    profile. peer_profile (indexed by peer code) replaces the one learned from
+    these rows. Returns a (year-groups x 5) array of shares with column 0 = 0.
+    """
+    shares, valid = seasonal_shares(values, present)
+    
+    learned = pd.DataFrame(shares[valid])
+    entity_profile = learned.groupby(entity_codes[valid]).mean()
+    if peer_profile is None:
+        peer_profile = learned.groupby(peer_codes[valid]).mean()
+    
+    profile = np.full((len(values), 4), 0.25)
+    peer_rows = pd.DataFrame(index=peer_codes).join(peer_profile).to_numpy()
+    entity_rows = pd.DataFrame(index=entity_codes).join(entity_profile).to_numpy()
+    profile = np.where(np.isnan(peer_rows).any(axis=1, keepdims=True), profile, peer_rows)
+    profile = np.where(np.isnan(entity_rows).any(axis=1, keepdims=True), profile, entity_rows)
+    return np.hstack([np.zeros((len(values), 1)), profile])
+
+# Function to collect the complete years the peer seasonal profiles are learned from
+def seasonal_learning_rows(df, ytd_columns=YTD_COLUMNS):
+    """Quarter shares (columns 0-3) of every valid entity-year of a raw YTD frame, with its columna and peer
+    
+    Averaging them per (columna, peer) gives the peer profiles that
+    accumulated_to_quarterly learns from the same frame; rows of whole-entity
+    batches concatenated in name order give exactly the same means.
+    """
+    df, group, quarter, present = ytd_layout(df.copy())
+    peers = ytd_peer_labels(df, group, len(present))
+    parts = []
+    for col in ytd_columns:
+        values = np.zeros((len(present), 5))
+        values[group, quarter] = df[col].to_numpy(dtype=float)
+        shares, valid = seasonal_shares(values, present)
+        parts.append(pd.DataFrame(shares[valid]).assign(columna=col, peer=peers[valid]))
+    if not parts:
+        return pd.DataFrame(columns=[0, 1, 2, 3, 'columna', 'peer'])
+    return pd.concat(parts, ignore_index=True)
+
+# Function to average the learning rows into the peer seasonal profiles
+def peer_seasonal_profiles(rows):
+    """YTD column -> profile per peer label (columns 0-3), for accumulated_to_quarterly(peer_profiles=...)"""
+    return {col: part.groupby('peer')[[0, 1, 2, 3]].mean() for col, part in rows.groupby('columna', sort=False)}
+
 # Function to convert YTD (Year-to-Date) accumulated data to quarterly
-def accumulated_to_quarterly(df):
+def accumulated_to_quarterly(df, imputation=IMPUTATION_METHOD, peer_profiles=None, ytd_columns=YTD_COLUMNS):
     """Convert YTD accumulated data to quarterly data
     
     The data comes in YTD format:
@@ -292,298 +618,2326 @@ def accumulated_to_quarterly(df):
     - SEPTIEMBRE: YTD through Q3 (9 months: Jan-Sep)
     - DICIEMBRE: YTD through Q4 (12 months: Jan-Dec)
     
-    We need to convert to individual quarterly data.
+    We need to convert to individual quarterly data. Each quarter is the
+    difference with the previous filing of the year. When earlier filings are
+    missing, the YTD difference spans several quarters and is split:
+    - 'proporcional': evenly (the historical /2, /3, /4 rule)
+    - 'estacional': by the seasonal profile learned from the entity's complete
+      years, or from its peers (same Tipo_Entidad) when it has none
+    Estimated quarters are flagged in the 'imputado' column. peer_profiles
+    (from peer_seasonal_profiles) replaces the peer profiles learned from df,
+    so the entities of a file can be converted in separate batches. Only
+    ytd_columns are converted; with none, the filings are only laid out by
+    quarter.
     """
-    # First, clean entity names
-    df['Denominación'] = df['Denominación'].apply(clean_entity_name)
+    if imputation not in IMPUTATION_METHODS:
+        raise ValueError(f"Unknown imputation method: {imputation}")
     
-    # Remove rows where entity name is None
-    df = df[df['Denominación'].notna()]
+    df, group, quarter, present = ytd_layout(df)
+    if df.empty:
+        return df.assign(Quarter=pd.Series(dtype=str), Periodo_Quarterly=pd.Series(dtype=str),
+                         imputado=pd.Series(dtype=bool))
+    n_groups = len(present)
     
-    df = df.sort_values(['Denominación', 'Año', 'Fecha'])
+    # Base filing each quarter is measured against (0 = start of year)
+    if imputation == 'proporcional':
+        base = np.zeros(len(df), dtype=int)
+        base = np.where((quarter == 2) & present[group, 1], 1, base)
+        base = np.where((quarter == 3) & present[group, 2], 2, base)
+        q4_base = np.where(present[group, 3], 3, np.where(present[group, 2], 2, np.where(present[group, 1], 1, 0)))
+        base = np.where(quarter == 4, q4_base, base)
+    else:
+        last_present = np.maximum.accumulate(np.where(present, np.arange(5), 0), axis=1)
+        base = last_present[group, quarter - 1]
     
-    quarterly_data = []
+    if imputation == 'estacional':
+        entity_codes = df.groupby('Denominación', sort=False).ngroup().to_numpy()
+        group_entity = np.zeros(n_groups, dtype=int)
+        group_entity[group] = entity_codes
+        group_peer, peer_labels = pd.factorize(ytd_peer_labels(df, group, n_groups))
     
-    for entity in df['Denominación'].unique():
-        if not entity:  # Skip empty entity names
-            continue
-            
-        entity_data = df[df['Denominación'] == entity].copy()
+    quarterly = df.copy()
+    for col in ytd_columns:
+        values = np.zeros((n_groups, 5))
+        values[group, quarter] = df[col].to_numpy(dtype=float)
+        span_value = values[group, quarter] - values[group, base]
         
-        for year in entity_data['Año'].unique():
-            year_data = entity_data[entity_data['Año'] == year].sort_values('Fecha')
-            
-            if len(year_data) == 0:
-                continue
-            
-            # Income statement columns that are accumulated YTD (need conversion)
-            ytd_cols = [
-                'Comisiones_Percibidas_Miles_EUR',
-                'Comisiones_Netas_Miles_EUR',
-                'Margen_Bruto_Miles_EUR',
-                'Gastos_Explotación_Miles_EUR',
-                'Resultados_Antes_Impuestos_Miles_EUR'
-            ]
-            
-            # Balance sheet columns (point-in-time, not accumulated)
-            balance_cols = [
-                'Fondos_Propios_Miles_EUR',
-                'Activos_Totales_Miles_EUR'
-            ]
-            
-            # Create a dictionary to store YTD values by month for easy access
-            ytd_values = {}
-            for _, row in year_data.iterrows():
-                ytd_values[row['Mes']] = row
-            
-            # Process each quarter
-            for mes in ['MARZO', 'JUNIO', 'SEPTIEMBRE', 'DICIEMBRE']:
-                if mes not in ytd_values:
-                    continue
-                    
-                row = ytd_values[mes]
-                quarterly_row = row.copy()
-                
-                # Determine quarter and calculate quarterly values
-                if mes == 'MARZO':
-                    quarter = 'Q1'
-                    # Q1 values are already quarterly (first 3 months)
-                    for col in ytd_cols:
-                        quarterly_row[col] = row[col]
-                        
-                elif mes == 'JUNIO':
-                    quarter = 'Q2'
-                    # Q2 = YTD June (6 months) - YTD March (3 months)
-                    if 'MARZO' in ytd_values:
-                        for col in ytd_cols:
-                            quarterly_row[col] = row[col] - ytd_values['MARZO'][col]
-                    else:
-                        # If no March data, June YTD represents Q1+Q2
-                        # We can't accurately separate, so we'll use half as estimate
-                        for col in ytd_cols:
-                            quarterly_row[col] = row[col] / 2
-                            
-                elif mes == 'SEPTIEMBRE':
-                    quarter = 'Q3'
-                    # Q3 = YTD September (9 months) - YTD June (6 months)
-                    if 'JUNIO' in ytd_values:
-                        for col in ytd_cols:
-                            quarterly_row[col] = row[col] - ytd_values['JUNIO'][col]
-                    else:
-                        # Fallback: estimate Q3 as 1/3 of YTD September
-                        for col in ytd_cols:
-                            quarterly_row[col] = row[col] / 3
-                            
-                elif mes == 'DICIEMBRE':
-                    quarter = 'Q4'
-                    # Q4 = YTD December (12 months) - YTD September (9 months)
-                    if 'SEPTIEMBRE' in ytd_values:
-                        for col in ytd_cols:
-                            quarterly_row[col] = row[col] - ytd_values['SEPTIEMBRE'][col]
-                    elif 'JUNIO' in ytd_values:
-                        # If no September, use June: Q4+Q3 = Dec - June
-                        for col in ytd_cols:
-                            quarterly_row[col] = (row[col] - ytd_values['JUNIO'][col]) / 2
-                    elif 'MARZO' in ytd_values:
-                        # If only March available: Q4+Q3+Q2 = Dec - March
-                        for col in ytd_cols:
-                            quarterly_row[col] = (row[col] - ytd_values['MARZO'][col]) / 3
-                    else:
-                        # Only December data: estimate Q4 as 1/4 of total
-                        for col in ytd_cols:
-                            quarterly_row[col] = row[col] / 4
-                
-                # Balance sheet items remain as-is (point in time values)
-                for col in balance_cols:
-                    quarterly_row[col] = row[col]
-                
-                quarterly_row['Quarter'] = quarter
-                quarterly_row['Periodo_Quarterly'] = f"{year} {quarter}"
-                quarterly_data.append(quarterly_row)
+        if imputation == 'estacional':
+            peer_profile = None
+            if peer_profiles is not None:
+                known = peer_profiles.get(col, pd.DataFrame(columns=range(4)))
+                peer_profile = known.reindex(peer_labels).set_axis(range(len(peer_labels)))
+            shares = seasonal_profiles(values, present, group_entity, group_peer, peer_profile)
+            cumulative = np.cumsum(shares, axis=1)
+            span_share = cumulative[group, quarter] - cumulative[group, base]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weight = np.where(span_share > 0, shares[group, quarter] / span_share, 1 / (quarter - base))
+        else:
+            weight = 1 / (quarter - base)
+        
+        quarterly[col] = np.where(quarter - base > 1, span_value * weight, span_value)
     
-    return pd.DataFrame(quarterly_data)
+    quarterly['Quarter'] = 'Q' + pd.Series(quarter, index=df.index).astype(str)
+    quarterly['Periodo_Quarterly'] = df['Año'].astype(str) + ' ' + quarterly['Quarter']
+    quarterly['imputado'] = ((quarter - base) > 1) & bool(ytd_columns)
+    
+    order = np.lexsort((quarter, group))
+    return quarterly.iloc[order]
 
-# Function to load and process data
-@st.cache_data
-def load_data():
+# Raw YTD columns that can only grow within a year
+NON_DECREASING_YTD_COLUMNS = ['Comisiones_Percibidas_Miles_EUR', 'Gastos_Explotación_Miles_EUR']
+
+# Raw numeric columns checked for missing and infinite values
+RAW_VALUE_COLUMNS = [
+    'Fondos_Propios_Miles_EUR', 'Activos_Totales_Miles_EUR', 'Comisiones_Percibidas_Miles_EUR',
+    'Comisiones_Netas_Miles_EUR', 'Margen_Bruto_Miles_EUR', 'Gastos_Explotación_Miles_EUR',
+    'Resultados_Antes_Impuestos_Miles_EUR'
+]
+
+# Quarter-on-quarter ratio of total assets above which (or below its inverse) a jump is flagged
+BALANCE_JUMP_FACTOR = 10
+
+# Quarantine reason codes and what the pipeline does with the row
+QUARANTINE_RULES = {
+    'activos_negativos': 'marcada',
+    'ytd_decreciente': 'marcada',
+    'salto_balance': 'marcada',
+    'mes_faltante': 'estimada',
+    'valor_nulo': 'rellenada_0',
+    'valor_infinito': 'excluida',
+    'sin_actividad': 'excluida',
+    'cambio_tipo': 'excluida'
+}
+
+QUARANTINE_COLUMNS = ['entidad', 'tipo', 'anio', 'mes', 'regla', 'columna', 'valor', 'accion']
+
+# Function to build quarantine rows for the rows selected by a boolean mask
+def quarantine_rows(frame, mask, rule, column=None, values=None):
+    mask = np.asarray(mask, dtype=bool)
+    rows = frame.loc[mask, ['entidad', 'tipo', 'anio', 'mes']].copy()
+    rows['regla'] = rule
+    rows['columna'] = column
+    rows['valor'] = np.asarray(values, dtype=float)[mask] if values is not None else np.nan
+    rows['accion'] = QUARANTINE_RULES[rule]
+    return rows
+
+# Function to run the data-quality checks on a raw YTD file
+def validate_raw_data(raw, tipo, ytd_columns=YTD_COLUMNS):
+    """Vectorized rule checks over every raw row; returns the quarantine table
+    
+    Checks negative assets, YTD figures that decrease within a year, jumps in
+    total assets, months missing before a filing (whose quarter is estimated)
+    and missing or infinite values. Each offending row is reported once per
+    rule and column with a reason code; the data itself is not modified here.
+    Only ytd_columns are checked (and estimated) as YTD figures.
+    """
+    if raw.empty:
+        return pd.DataFrame(columns=QUARANTINE_COLUMNS)
+    
+    # Same normalization as clean_entity_name, with vectorized string methods
+    names = raw['Denominación'].astype('string').str.split().str.join(' ').str.rstrip('.,')
+    frame = pd.DataFrame({
+        'entidad': names,
+        'tipo': tipo,
+        'anio': raw['Año'].to_numpy(),
+        'mes': raw['Mes'].to_numpy(),
+        'orden_mes': raw['Mes'].map(MONTH_ORDER).to_numpy()
+    }, index=raw.index)
+    frame = pd.concat([frame, raw[RAW_VALUE_COLUMNS]], axis=1)
+    frame = frame[frame['entidad'].notna() & (frame['entidad'] != '')]
+    frame = frame.sort_values(['entidad', 'anio', 'orden_mes'], kind='stable')
+    
+    same_entity = frame['entidad'].eq(frame['entidad'].shift(1))
+    same_year = same_entity & frame['anio'].eq(frame['anio'].shift(1))
+    quarter_idx = frame['anio'] * 4 + frame['orden_mes']
+    consecutive = same_entity & (quarter_idx - quarter_idx.shift(1) == 1)
+    
+    found = []
+    assets = frame['Activos_Totales_Miles_EUR']
+    found.append(quarantine_rows(frame, assets < 0, 'activos_negativos', 'Activos_Totales_Miles_EUR', assets))
+    
+    for col in [col for col in NON_DECREASING_YTD_COLUMNS if col in ytd_columns]:
+        decreasing = same_year & (frame[col] < frame[col].shift(1))
+        found.append(quarantine_rows(frame, decreasing, 'ytd_decreciente', col, frame[col]))
+    
+    previous_assets = assets.shift(1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        assets_ratio = assets / previous_assets
+    jump = consecutive & (previous_assets > 0) & (assets > 0) & (
+        (assets_ratio > BALANCE_JUMP_FACTOR) | (assets_ratio < 1 / BALANCE_JUMP_FACTOR)
+    )
+    found.append(quarantine_rows(frame, jump, 'salto_balance', 'Activos_Totales_Miles_EUR', assets))
+    
+    # A filing whose previous month in the same year is absent gets an estimated quarter
+    previous_month = frame['orden_mes'].shift(1).where(same_year, 0)
+    missing_month = frame['orden_mes'].notna() & (frame['orden_mes'] - previous_month > 1) & bool(ytd_columns)
+    found.append(quarantine_rows(frame, missing_month, 'mes_faltante'))
+    
+    values = frame[RAW_VALUE_COLUMNS].to_numpy(dtype=float)
+    for j, col in enumerate(RAW_VALUE_COLUMNS):
+        found.append(quarantine_rows(frame, np.isnan(values[:, j]), 'valor_nulo', col, values[:, j]))
+        found.append(quarantine_rows(frame, np.isinf(values[:, j]), 'valor_infinito', col, values[:, j]))
+    
+    quarantine = pd.concat(found, ignore_index=True)
+    return quarantine[QUARANTINE_COLUMNS].sort_values(['entidad', 'anio', 'regla'], kind='stable').reset_index(drop=True)
+
+# Growth-rate policies for period-over-period variations (key -> label)
+GROWTH_POLICIES = {
+    'abs': 'Denominador absoluto',
+    'simetrica': 'Variación simétrica',
+    'log': 'Variación logarítmica',
+    'nan_cambio_signo': 'Sin dato si cambia el signo'
+}
+
+# Default growth-rate policy used by metrics, tabs and exports
+GROWTH_POLICY = 'abs'
+
+# Function to compute vectorized growth rates between two aligned series
+def growth_rate(current, previous, policy=GROWTH_POLICY, zero_value=np.nan):
+    """Percentage change from previous to current for whole arrays at once
+    
+    Policies:
+    - 'abs': (x - prev) / |prev|, so a shrinking loss reads as positive growth
+    - 'simetrica': (x - prev) / mean(|x|, |prev|), bounded to [-200, 200]
+    - 'log': ln(x / prev), only defined when both values are positive
+    - 'nan_cambio_signo': like 'abs' but NaN when the value changes sign
+    
+    Where the denominator is zero the result is zero_value; missing previous
+    values always give NaN.
+    """
+    if policy not in GROWTH_POLICIES:
+        raise ValueError(f"Unknown growth policy: {policy}")
+    
+    current = np.asarray(current, dtype=float)
+    previous = np.asarray(previous, dtype=float)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if policy == 'simetrica':
+            denominator = (np.abs(current) + np.abs(previous)) / 2
+            rate = (current - previous) / denominator * 100
+        elif policy == 'log':
+            denominator = previous
+            rate = np.where((current > 0) & (previous > 0), np.log(current / previous) * 100, np.nan)
+        else:
+            denominator = previous
+            rate = (current - previous) / np.abs(previous) * 100
+            if policy == 'nan_cambio_signo':
+                rate = np.where(np.sign(current) * np.sign(previous) < 0, np.nan, rate)
+    
+    rate = np.where(denominator == 0, zero_value, rate)
+    return np.where(np.isnan(previous), np.nan, rate)
+
+# Rolling window (in quarters) used for the trailing-twelve-month metrics
+TTM_WINDOW = 4
+
+# Flow columns (income statement) that are summed over the TTM window
+TTM_FLOW_COLUMNS = ['comisiones_percibidas', 'comisiones_netas', 'margen_bruto',
+                    'gastos_explotacion', 'resultados_antes_impuestos']
+
+# Columns added by add_rolling_metrics, carried along with the dataset
+ROLLING_METRIC_COLUMNS = [f'ttm_{col}' for col in TTM_FLOW_COLUMNS] + [
+    'ROA_4q', 'ROE_4q', 'ratio_eficiencia_ttm', 'margen_neto_ttm',
+    'yoy_ingresos', 'yoy_beneficio', 'yoy_activos', 'vol_ingresos_4q'
+]
+
+# Quarterly metric -> rolling replacement used by the TTM chart view
+TTM_VIEW_COLUMNS = {
+    **{col: f'ttm_{col}' for col in TTM_FLOW_COLUMNS},
+    'ROA': 'ROA_4q',
+    'ROE': 'ROE_4q',
+    'ratio_eficiencia': 'ratio_eficiencia_ttm',
+    'margen_neto': 'margen_neto_ttm',
+    'var_ingresos': 'yoy_ingresos',
+    'var_beneficio': 'yoy_beneficio',
+    'var_activos': 'yoy_activos'
+}
+
+# Function to compute trailing-twelve-month and rolling metrics for every entity
+def add_rolling_metrics(df, growth_policy=GROWTH_POLICY):
+    """Add TTM flows, rolling 4Q ROE/ROA, YoY growth and rolling volatility
+    
+    All entities are processed in a single pass over the frame sorted by
+    entity and date. A window is only valid when it covers consecutive
+    quarters of the same entity; otherwise the rolling value is NaN.
+    """
+    if df.empty:
+        return df.reindex(columns=list(df.columns) + ROLLING_METRIC_COLUMNS)
+    
+    df = df.sort_values(['entidad', 'fecha']).reset_index(drop=True)
+    entity = df['entidad']
+    quarter_idx = df['fecha'].dt.year * 4 + (df['fecha'].dt.month - 1) // 3
+    
+    # The window is complete when its first row is exactly TTM_WINDOW-1 quarters back
+    window_span = quarter_idx - quarter_idx.groupby(entity).shift(TTM_WINDOW - 1)
+    full_window = window_span == TTM_WINDOW - 1
+    
+    # Window sums from the shifted rows, masking windows that cross entities or gaps (a rolling
+    # sum over the whole frame would carry rounding from earlier entities into each value)
+    flows = df[TTM_FLOW_COLUMNS + ['activos_totales', 'fondos_propios']]
+    window_sum = sum(flows.shift(lag) for lag in range(TTM_WINDOW)).where(full_window, axis=0)
+    ttm = window_sum[TTM_FLOW_COLUMNS]
+    avg_balance = window_sum[['activos_totales', 'fondos_propios']] / TTM_WINDOW
+    
+    for col in TTM_FLOW_COLUMNS:
+        df[f'ttm_{col}'] = ttm[col]
+    
+    ttm_profit = ttm['resultados_antes_impuestos']
+    df['ROA_4q'] = np.where(avg_balance['activos_totales'] > 0,
+                            ttm_profit / avg_balance['activos_totales'] * 100, 0)
+    df['ROE_4q'] = np.where(avg_balance['fondos_propios'] > 0,
+                            ttm_profit / avg_balance['fondos_propios'] * 100, 0)
+    df['ratio_eficiencia_ttm'] = np.where(ttm['margen_bruto'] > 0,
+                                          ttm['gastos_explotacion'] / ttm['margen_bruto'] * 100, 0)
+    df['margen_neto_ttm'] = np.where(ttm['comisiones_percibidas'] > 0,
+                                     ttm_profit / ttm['comisiones_percibidas'] * 100, 0)
+    # Keep incomplete windows as gaps rather than zeros
+    df.loc[~full_window, ['ROA_4q', 'ROE_4q', 'ratio_eficiencia_ttm', 'margen_neto_ttm']] = np.nan
+    
+    # YoY: join each row with the same entity four quarters earlier
+    yoy_source = {
+        'yoy_ingresos': 'comisiones_percibidas',
+        'yoy_beneficio': 'resultados_antes_impuestos',
+        'yoy_activos': 'activos_totales'
+    }
+    lagged = df[['entidad'] + list(yoy_source.values())].assign(quarter_idx=quarter_idx + 4)
+    lagged = pd.DataFrame({'entidad': entity, 'quarter_idx': quarter_idx}).merge(
+        lagged, on=['entidad', 'quarter_idx'], how='left'
+    )
+    for target, col in yoy_source.items():
+        df[target] = growth_rate(df[col], lagged[col], growth_policy)
+    
+    # Rolling volatility of QoQ revenue growth over consecutive quarters
+    prev_revenue = df['comisiones_percibidas'].groupby(entity).shift(1)
+    consecutive = (quarter_idx - quarter_idx.groupby(entity).shift(1)) == 1
+    qoq_revenue = pd.Series(growth_rate(df['comisiones_percibidas'], prev_revenue, growth_policy),
+                            index=df.index).where(consecutive)
+    window = np.column_stack([qoq_revenue.shift(lag) for lag in range(TTM_WINDOW)])
+    count = (~np.isnan(window)).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.nansum(window, axis=1) / count
+        std = np.sqrt(np.nansum((window - mean[:, np.newaxis]) ** 2, axis=1) / (count - 1))
+    df['vol_ingresos_4q'] = pd.Series(np.where(count >= 2, std, np.nan), index=df.index).where(full_window)
+    
+    return df
+
+# Function to switch a metrics frame between the quarterly and TTM views
+def select_metric_view(metrics, view):
+    """Return metrics with the base columns replaced by their rolling version when view is 'TTM'
+    
+    The TTM view starts at the first complete 4-quarter window of each entity, so
+    an entity without one has no rows (one entity or several alike).
+    """
+    if view != 'TTM' or metrics is None:
+        return metrics
+    view_metrics = metrics.copy()
+    for col, rolling_col in TTM_VIEW_COLUMNS.items():
+        if rolling_col in view_metrics.columns:
+            view_metrics[col] = view_metrics[rolling_col]
+    
+    # Start the view at the first complete 4-quarter window (of each entity, if several)
+    if 'ttm_comisiones_percibidas' in view_metrics.columns:
+        complete = view_metrics['ttm_comisiones_percibidas'].notna()
+        if 'entidad' in view_metrics.columns:
+            view_metrics = view_metrics[complete.groupby(view_metrics['entidad'], sort=False).cummax()]
+        else:
+            view_metrics = view_metrics[complete.cummax()]
+    return view_metrics
+
+# Worker processes for the per-entity stages (None = one per core)
+PIPELINE_WORKERS = None
+
+# Frames smaller than this run in-process: starting workers costs more than it saves
+PARALLEL_MIN_ROWS = 1_000_000
+
+# Function to copy the columns of a frame into one shared-memory block
+def share_frame(df):
+    """Return (SharedMemory, layout) holding every column of df
+    
+    Numeric, boolean and datetime columns are copied as raw arrays; other
+    columns as integer codes, with their unique values kept in the layout.
+    Workers rebuild the frame from the block, so the data is never pickled.
+    """
+    arrays, layout, offset = [], [], 0
+    for name in df.columns:
+        column = df[name]
+        uniques = None
+        if isinstance(column.dtype, np.dtype) and column.dtype.kind in 'biufmM':
+            values = np.ascontiguousarray(column.to_numpy())
+        else:
+            codes, uniques = pd.factorize(column)
+            values, uniques = codes.astype(np.int64), np.append(np.asarray(uniques, dtype=object), None)
+        layout.append((name, str(column.dtype), values.dtype.str, offset, uniques))
+        arrays.append(values)
+        offset += -(-values.nbytes // 8) * 8
+    
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 8))
+    for values, (_, _, _, start, _) in zip(arrays, layout):
+        np.ndarray(values.shape, values.dtype, buffer=block.buf, offset=start)[:] = values
+    return block, layout
+
+# Function to rebuild selected rows of a shared frame
+def attach_frame(block, layout, n_rows, rows):
+    """Copy the given row positions out of the shared block into a DataFrame"""
+    data = {}
+    for name, dtype, np_dtype, offset, uniques in layout:
+        values = np.ndarray(n_rows, np.dtype(np_dtype), buffer=block.buf, offset=offset)[rows]
+        data[name] = values if uniques is None else pd.Series(uniques[values], dtype=object).astype(dtype).to_numpy()
+    return pd.DataFrame(data)
+
+# Function run by each worker on its partition
+def run_partition(block_name, layout, n_rows, partition, func, kwargs):
+    block = shared_memory.SharedMemory(name=block_name)
     try:
-        # Load the new files with updated names
-        sociedades_raw = pd.read_excel('sociedades_de_valores_parsed.xlsx')
-        agencias_raw = pd.read_excel('agencias_de_valores_parsed.xlsx')
-    except FileNotFoundError:
-        try:
-            sociedades_raw = pd.read_excel('./sociedades_de_valores_parsed.xlsx')
-            agencias_raw = pd.read_excel('./agencias_de_valores_parsed.xlsx')
-        except:
-            st.error("No se encontraron los archivos de datos.")
-            st.stop()
+        partitions = np.ndarray(n_rows, np.int64, buffer=block.buf, offset=layout[-1][3])
+        rows = np.flatnonzero(partitions == partition)
+        del partitions
+        frame = attach_frame(block, layout[:-1], n_rows, rows)
+    finally:
+        block.close()
+    index = frame.pop('_indice')
+    frame.index = pd.Index(index.to_numpy())
+    return func(frame, **kwargs)
+
+# Function to run a per-entity stage on partitions of the data in a process pool
+def run_by_entity(func, df, key='entidad', workers=PIPELINE_WORKERS, sort_by=None, ignore_index=False,
+                  min_rows=PARALLEL_MIN_ROWS, **kwargs):
+    """Apply func(df, **kwargs) to hash partitions of df's entities and combine the results
     
-    # Convert accumulated data to quarterly
-    sociedades = accumulated_to_quarterly(sociedades_raw)
-    agencias = accumulated_to_quarterly(agencias_raw)
-    
-    # Rename columns to match the original app structure
-    column_mapping = {
-        'Denominación': 'entidad',
-        'Fondos_Propios_Miles_EUR': 'fondos_propios',
-        'Activos_Totales_Miles_EUR': 'activos_totales',
-        'Comisiones_Percibidas_Miles_EUR': 'comisiones_percibidas',
-        'Comisiones_Netas_Miles_EUR': 'comisiones_netas',
-        'Margen_Bruto_Miles_EUR': 'margen_bruto',
-        'Gastos_Explotación_Miles_EUR': 'gastos_explotacion',
-        'Resultados_Antes_Impuestos_Miles_EUR': 'resultados_antes_impuestos',
-        'Fecha': 'fecha',
-        'Periodo_Quarterly': 'periodo'
+    Rows are assigned to workers by a hash of key (a column name, an aligned
+    Series, or a function of df returning one, called only when the pool is
+    used), so every entity is processed whole by one worker. The input goes
+    through shared memory. func must be a module-level function whose result
+    does not depend on other entities. Results are concatenated, sorted by
+    sort_by and, with ignore_index, renumbered, which reproduces the order of
+    an in-process call. Small frames and workers=1 run in-process.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(df) < min_rows:
+        return func(df, **kwargs)
+    
+    keys = df[key] if isinstance(key, str) else key(df) if callable(key) else key
+    partition = (pd.util.hash_array(keys.to_numpy(dtype=object)) % np.uint64(workers)).astype(np.int64)
+    shared = df.assign(_indice=df.index.to_numpy())
+    shared['_particion'] = partition
+    block, layout = share_frame(shared)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_partition, block.name, layout, len(df), i, func, kwargs)
+                       for i in range(workers) if (partition == i).any()]
+            parts = [future.result() for future in futures]
+    finally:
+        block.close()
+        block.unlink()
+    
+    result = pd.concat(parts)
+    if sort_by is not None:
+        result = result.sort_values(sort_by, kind='stable')
+    else:
+        result = result.sort_index(kind='stable')
+    return result.reset_index(drop=True) if ignore_index else result
+
+# Function to compute the per-entity metrics stages of one partition
+def entity_metrics_stage(df, growth_policy=GROWTH_POLICY):
+    """Quarterly metrics and health scores of the entities in df"""
+    metrics = compute_quarterly_metrics(df, growth_policy)
+    return pd.concat([metrics, compute_health_scores(metrics)], axis=1)
+
+# Registry of raw data sources (tipo -> source), filled by register_source
+ENTITY_SOURCES = {}
+
+# Chart colors per entity type
+TIPO_COLORS = {}
+
+# Marker symbols given to the entity types in registration order (symbol -> legend glyph)
+TIPO_SYMBOLS = {'circle': '●', 'diamond': '◆', 'square': '■', 'triangle-up': '▲', 'cross': '✚'}
+
+# Function to declare the raw data source of an entity type
+def register_source(tipo, path, label, title, color, icon='🏛️', columns=None, ytd_columns=YTD_COLUMNS):
+    """Add an entity type to the pipeline and the dashboard
+    
+    label names the type in plural (filters, charts) and title in singular
+    (badges). columns maps the file's column names to the raw names of
+    RAW_COLUMN_TYPES; value columns the file lacks are read as missing.
+    ytd_columns lists the raw columns filed as year-to-date accumulations,
+    which are converted to quarters; the other columns are taken as quarterly
+    figures. Sources are processed in registration order.
+    """
+    ENTITY_SOURCES[tipo] = {
+        'path': path, 'label': label, 'title': title, 'color': color, 'icon': icon,
+        'symbol': list(TIPO_SYMBOLS)[len(ENTITY_SOURCES) % len(TIPO_SYMBOLS)],
+        'columns': dict(columns or {}), 'ytd_columns': list(ytd_columns)
     }
+    TIPO_COLORS[tipo] = color
+
+register_source('Sociedad', 'sociedades_de_valores_parsed.xlsx', 'Sociedades de Valores', 'Sociedad de Valores',
+                '#b794f6', icon='🏢')
+register_source('Agencia', 'agencias_de_valores_parsed.xlsx', 'Agencias de Valores', 'Agencia de Valores',
+                '#00d4ff', icon='🏦')
+
+# Function to get a display attribute of an entity type (default: the tipo itself) for types not registered
+def source_attribute(tipo, attribute='label', default=None):
+    return ENTITY_SOURCES.get(tipo, {}).get(attribute, tipo if default is None else default)
+
+# Function to get the CSS background of an entity type's badge
+def type_badge_background(tipo):
+    color = TIPO_COLORS.get(tipo, '#48bb78')
+    return f'linear-gradient(135deg, {color} 0%, {color}cc 100%)'
+
+# Types of the raw columns, so that every reader and every chunk yields the same frame
+RAW_COLUMN_TYPES = {
+    'Tipo_Entidad': 'str', 'Periodo': 'str', 'Año': 'int64', 'Mes': 'str', 'Denominación': 'str',
+    **{col: 'float64' for col in RAW_VALUE_COLUMNS},
+    'Fecha': 'datetime64[us]'
+}
+
+# Rename columns to match the original app structure
+RAW_COLUMN_MAPPING = {
+    'Denominación': 'entidad',
+    'Fondos_Propios_Miles_EUR': 'fondos_propios',
+    'Activos_Totales_Miles_EUR': 'activos_totales',
+    'Comisiones_Percibidas_Miles_EUR': 'comisiones_percibidas',
+    'Comisiones_Netas_Miles_EUR': 'comisiones_netas',
+    'Margen_Bruto_Miles_EUR': 'margen_bruto',
+    'Gastos_Explotación_Miles_EUR': 'gastos_explotacion',
+    'Resultados_Antes_Impuestos_Miles_EUR': 'resultados_antes_impuestos',
+    'Fecha': 'fecha',
+    'Periodo_Quarterly': 'periodo'
+}
+
+# Key columns where remaining NaN are filled and infinite values removed
+KEY_COLUMNS = ['comisiones_percibidas', 'activos_totales', 'fondos_propios',
+               'gastos_explotacion', 'resultados_antes_impuestos', 'margen_bruto', 'comisiones_netas']
+
+# Function to give a raw frame (or chunk) of a source the raw column names and types
+def normalize_raw_types(raw, columns=None):
+    raw = raw.rename(columns=columns or {})
+    missing = [col for col in RAW_VALUE_COLUMNS if col not in raw.columns]
+    if missing:
+        raw = raw.assign(**dict.fromkeys(missing, np.nan))
+    return raw.astype({col: dtype for col, dtype in RAW_COLUMN_TYPES.items() if col in raw.columns})
+
+# Function to read the whole raw file (Excel, CSV or Parquet) of a source
+def read_raw_file(source):
+    path = source['path']
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        raw = pd.read_csv(path)
+    elif extension == '.parquet':
+        raw = pd.read_parquet(path)
+    else:
+        raw = pd.read_excel(path)
+    return normalize_raw_types(raw, source['columns'])
+
+# Function to read the raw files of several sources, in parallel processes when there are several cores
+def read_sources(sources, workers=PIPELINE_WORKERS):
+    workers = min(workers or os.cpu_count() or 1, len(sources))
+    if workers <= 1:
+        return {tipo: read_raw_file(source) for tipo, source in sources.items()}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {tipo: pool.submit(read_raw_file, source) for tipo, source in sources.items()}
+        return {tipo: future.result() for tipo, future in futures.items()}
+
+# Function to consolidate duplicate entities (keep the one with most data)
+def consolidate_duplicates(df):
+    # Calculate a "data quality score" for each entity
+    df['data_score'] = (
+        (df['comisiones_percibidas'].abs() > 0).astype(int) * 3 +  # Revenue is most important
+        (df['activos_totales'].abs() > 0).astype(int) * 2 +
+        (df['fondos_propios'].abs() > 0).astype(int) +
+        (df['resultados_antes_impuestos'].notna()).astype(int)
+    )
+    
+    # For each entity-period combination, keep only the row with highest data score
+    df = df.sort_values(['entidad', 'periodo', 'data_score'], ascending=[True, True, False])
+    df = df.drop_duplicates(subset=['entidad', 'periodo'], keep='first')
+    df = df.drop('data_score', axis=1)
+    
+    return df
+
+# Function to filter out entities with no meaningful data
+def filter_empty_entities(df):
+    # Group by entity and check if they have any real activity
+    entity_stats = df.groupby('entidad').agg({
+        'comisiones_percibidas': ['sum', 'max', 'mean', 'count'],
+        'activos_totales': ['sum', 'max', 'mean'],
+        'fondos_propios': ['sum', 'max', 'mean'],
+        'resultados_antes_impuestos': ['sum', 'count']
+    })
+    
+    # Flatten column names
+    entity_stats.columns = ['_'.join(col).strip() for col in entity_stats.columns.values]
     
-    sociedades = sociedades.rename(columns=column_mapping)
-    agencias = agencias.rename(columns=column_mapping)
-    
-    # Clean entity names to avoid variations
-    sociedades['entidad'] = sociedades['entidad'].apply(clean_entity_name)
-    agencias['entidad'] = agencias['entidad'].apply(clean_entity_name)
-    
-    # Remove rows with null entity names
-    sociedades = sociedades[sociedades['entidad'].notna()]
-    agencias = agencias[agencias['entidad'].notna()]
-    
-    # Function to consolidate duplicate entities (keep the one with most data)
-    def consolidate_duplicates(df):
-        # Calculate a "data quality score" for each entity
-        df['data_score'] = (
-            (df['comisiones_percibidas'].abs() > 0).astype(int) * 3 +  # Revenue is most important
-            (df['activos_totales'].abs() > 0).astype(int) * 2 +
-            (df['fondos_propios'].abs() > 0).astype(int) +
-            (df['resultados_antes_impuestos'].notna()).astype(int)
+    # Filter entities that have:
+    # 1. Meaningful revenue at any point
+    # 2. OR meaningful assets
+    # 3. AND more than just one quarter of data
+    # 4. AND not all zeros
+    valid_entities = entity_stats[
+        (
+            (entity_stats['comisiones_percibidas_max'] > 10) |  # Has had at least 10K revenue
+            (entity_stats['activos_totales_max'] > 100)         # Has at least 100K assets
+        ) &
+        (entity_stats['comisiones_percibidas_count'] >= 2) &    # At least 2 quarters
+        (
+            (entity_stats['comisiones_percibidas_sum'].abs() > 0) |
+            (entity_stats['activos_totales_sum'] > 0) |
+            (entity_stats['fondos_propios_sum'] != 0)
         )
+    ]
+    
+    return df[df['entidad'].isin(valid_entities.index)]
+
+# Function to run the per-file stages on the entities of one raw file
+def prepare_entities(raw, tipo, imputation=IMPUTATION_METHOD, peer_profiles=None, ytd_columns=YTD_COLUMNS):
+    """Quality checks, YTD conversion, renaming, consolidation and activity filter
+    
+    Returns (entities, checks, removed): the quarterly rows kept, the quarantine
+    rows of the raw checks and those of the entities removed for lack of
+    activity. Every stage works per entity, so batches of whole entities give
+    the rows of the whole file, provided the peer seasonal profiles of the
+    whole file are passed in peer_profiles. ytd_columns are the source's YTD
+    columns (see register_source).
+    """
+    # Record data-quality issues before the conversion fixes them
+    checks = validate_raw_data(raw, tipo, ytd_columns)
+    
+    # Convert accumulated data to quarterly
+    # (per entity, so it can run on several cores, except when the seasonal profile learns from the peers)
+    ytd_workers = 1 if imputation == 'estacional' and peer_profiles is None else PIPELINE_WORKERS
+    entities = run_by_entity(accumulated_to_quarterly, raw,
+                             key=lambda raw: raw['Denominación'].map(clean_entity_name), workers=ytd_workers,
+                             sort_by=['Denominación', 'Año', 'Quarter'],
+                             imputation=imputation, peer_profiles=peer_profiles, ytd_columns=ytd_columns)
+    entities = entities.rename(columns=RAW_COLUMN_MAPPING)
+    
+    # Clean entity names to avoid variations, and remove rows with null entity names
+    entities['entidad'] = entities['entidad'].apply(clean_entity_name)
+    entities = entities[entities['entidad'].notna()]
+    
+    # Consolidate duplicates and filter out entities with no meaningful data
+    entities = consolidate_duplicates(entities)
+    filtered = filter_empty_entities(entities)
+    removed = ~entities.index.isin(filtered.index)
+    removed = quarantine_rows(entities.assign(tipo=tipo, anio=entities['Año'], mes=entities['Mes']), removed,
+                              'sin_actividad')
+    return filtered, checks, removed[QUARANTINE_COLUMNS]
+
+# Function to run the stages that follow the name merge on whole entities of every tipo
+def combine_entities(entities, mappings, growth_policy=GROWTH_POLICY):
+    """Merge name variants, combine the tipos and compute the per-entity metrics
+    
+    entities and mappings are keyed by tipo: the prepare_entities output and the
+    match_entity_names mapping of each file. Returns (frames, combined, metrics,
+    type_changes): the frame of each tipo, the combined dataset with its rolling
+    metrics, its quarterly metrics and health scores, and the quarantine rows of
+    entities found under several tipos. Batches of whole (canonical) entities
+    give the rows of the whole dataset.
+    """
+    frames = {}
+    for tipo, df in entities.items():
+        df = apply_entity_mapping(df, mappings[tipo])
         
-        # For each entity-period combination, keep only the row with highest data score
-        df = df.sort_values(['entidad', 'periodo', 'data_score'], ascending=[True, True, False])
-        df = df.drop_duplicates(subset=['entidad', 'periodo'], keep='first')
-        df = df.drop('data_score', axis=1)
-        
-        return df
-    
-    # Consolidate duplicates
-    sociedades = consolidate_duplicates(sociedades)
-    agencias = consolidate_duplicates(agencias)
-    
-    # Filter out entities with no meaningful data
-    def filter_empty_entities(df):
-        # Group by entity and check if they have any real activity
-        entity_stats = df.groupby('entidad').agg({
-            'comisiones_percibidas': ['sum', 'max', 'mean', 'count'],
-            'activos_totales': ['sum', 'max', 'mean'],
-            'fondos_propios': ['sum', 'max', 'mean'],
-            'resultados_antes_impuestos': ['sum', 'count']
-        })
-        
-        # Flatten column names
-        entity_stats.columns = ['_'.join(col).strip() for col in entity_stats.columns.values]
-        
-        # Filter entities that have:
-        # 1. Meaningful revenue at any point
-        # 2. OR meaningful assets
-        # 3. AND more than just one quarter of data
-        # 4. AND not all zeros
-        valid_entities = entity_stats[
-            (
-                (entity_stats['comisiones_percibidas_max'] > 10) |  # Has had at least 10K revenue
-                (entity_stats['activos_totales_max'] > 100)         # Has at least 100K assets
-            ) &
-            (entity_stats['comisiones_percibidas_count'] >= 2) &    # At least 2 quarters
-            (
-                (entity_stats['comisiones_percibidas_sum'].abs() > 0) |
-                (entity_stats['activos_totales_sum'] > 0) |
-                (entity_stats['fondos_propios_sum'] != 0)
-            )
-        ]
+        # Remove any remaining NaN or infinite values in key columns
+        for col in KEY_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].fillna(0)
+                df = df[~df[col].isin([float('inf'), float('-inf')])]
         
-        return df[df['entidad'].isin(valid_entities.index)]
+        # Add type column and ensure fecha is datetime
+        df['tipo'] = tipo
+        df['fecha'] = pd.to_datetime(df['fecha'])
+        frames[tipo] = df
+    
+    # Combine datasets
+    combined = pd.concat(list(frames.values()), ignore_index=True)
+    
+    # Final check: remove any entity that appears with inconsistent type
+    entity_types = combined.groupby('entidad')['tipo'].nunique()
+    consistent_entities = entity_types[entity_types == 1].index
+    inconsistent = ~combined['entidad'].isin(consistent_entities)
+    type_changes = quarantine_rows(
+        combined.assign(anio=combined['Año'], mes=combined['Mes']), inconsistent, 'cambio_tipo', 'tipo'
+    )[QUARANTINE_COLUMNS]
+    combined = combined[~inconsistent]
+    
+    # Final duplicate check after combination
+    combined = consolidate_duplicates(combined)
+    
+    # Rolling and TTM metrics are stored with the dataset so views switch without recomputation
+    combined = run_by_entity(add_rolling_metrics, combined, sort_by=['entidad', 'fecha'], ignore_index=True,
+                             growth_policy=growth_policy)
+    metrics = run_by_entity(entity_metrics_stage, combined, sort_by=['entidad', 'fecha'], ignore_index=True,
+                            growth_policy=growth_policy)
+    return frames, combined, metrics, type_changes
+
+# Function to count the flagged figures of every dataset row
+def anomaly_counts(df, anomalies):
+    flag_counts = anomalies.groupby(['entidad', 'periodo']).size()
+    counts = pd.MultiIndex.from_frame(df[['entidad', 'periodo']]).map(flag_counts)
+    return counts.fillna(0).astype(int)
+
+# Function to load and process data
+@st.cache_data
+def load_data(growth_policy=GROWTH_POLICY, imputation=IMPUTATION_METHOD):
+    """Returns (combined, version); the other tables of the build are read from its snapshot"""
+    # Sources whose file is not there yet are left out; the others still load
+    sources = {tipo: source for tipo, source in ENTITY_SOURCES.items() if os.path.exists(source['path'])}
+    for source in ENTITY_SOURCES.values():
+        if source not in sources.values():
+            st.warning(f"No se encontró el archivo de {source['label']} ({source['path']}); se omite este tipo.")
+    if not sources:
+        st.error("No se encontraron los archivos de datos.")
+        st.stop()
+    input_bytes = sum(os.path.getsize(source['path']) for source in sources.values())
+    
+    # Inputs too large to hold in memory are processed in entity batches and read back from the snapshot
+    if input_bytes > CHUNKED_INPUT_BYTES:
+        version = build_dataset_chunked(sources, growth_policy=growth_policy, imputation=imputation)
+        return read_snapshot_table(version), version
     
-    # Apply filtering
-    sociedades = filter_empty_entities(sociedades)
-    agencias = filter_empty_entities(agencias)
+    raw_files = read_sources(sources)
+    
+    # Per-file stages; the seasonal peer profiles are learned first so the YTD conversion can run in parallel
+    entities, quarantine, removed, mappings, audits = {}, [], [], {}, []
+    for tipo, raw in raw_files.items():
+        ytd_columns = sources[tipo]['ytd_columns']
+        peer_profiles = None
+        if imputation == 'estacional':
+            peer_profiles = peer_seasonal_profiles(seasonal_learning_rows(raw, ytd_columns))
+        entities[tipo], checks, removed_rows = prepare_entities(raw, tipo, imputation, peer_profiles, ytd_columns)
+        quarantine.append(checks)
+        removed.append(removed_rows)
+        
+        # Match name variants (this handles variations like ACTIVOTRADE VALOR... and ACTIVOTRADE VALORES...)
+        quality = entity_quality_scores(entities[tipo])
+        mappings[tipo], audit = match_entity_names(quality['entidad'].tolist(), quality['quality_score'].tolist())
+        audits.append(audit.assign(tipo=tipo))
+    
+    # Audit of merged names, stored in the snapshot with the dataset
+    merge_audit = pd.concat(audits, ignore_index=True)
+    
+    _, combined, metrics, type_changes = combine_entities(entities, mappings, growth_policy)
+    
+    # Quarantine table, stored in the snapshot with the dataset
+    quarantine = pd.concat(quarantine + removed + [type_changes], ignore_index=True).astype({'valor': float})
+    
+    # Score every figure for anomalies; the flags are stored in the snapshot and counted per row
+    anomalies = compute_anomaly_scores(metrics)
+    combined['n_anomalias'] = anomaly_counts(combined, anomalies)
+    
+    # Keep an immutable snapshot of this build; its version is the dataset's content hash
+    version = save_snapshot(
+        {'dataset': combined, 'metrics': metrics, 'merge_audit': merge_audit, 'quarantine': quarantine,
+         'anomalies': anomalies},
+        politica_crecimiento=growth_policy, imputacion=imputation
+    )
+    
+    return combined, version
+
+# Base columns carried from the dataset into the quarterly metrics
+METRIC_BASE_COLUMNS = ['periodo', 'fecha', 'tipo', 'fondos_propios', 'activos_totales',
+                       'comisiones_percibidas', 'comisiones_netas', 'margen_bruto',
+                       'gastos_explotacion', 'resultados_antes_impuestos']
+
+# Quarter-over-quarter variation columns and their source column
+VARIATION_COLUMNS = {
+    'var_activos': 'activos_totales',
+    'var_ingresos': 'comisiones_percibidas',
+    'var_beneficio': 'resultados_antes_impuestos'
+}
+
+# Function to compute the financial ratios from aligned arrays of any shape
+def compute_ratio_arrays(profit, assets, equity, gross_margin, expenses, revenue):
+    """ROA, ROE, efficiency, net margin and leverage; 0 where the denominator is not positive"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'ROA': np.where(assets > 0, profit / assets * 100, 0),
+            'ROE': np.where(equity > 0, profit / equity * 100, 0),
+            'ratio_eficiencia': np.where(gross_margin > 0, expenses / gross_margin * 100, 0),
+            'margen_neto': np.where(revenue > 0, profit / revenue * 100, 0),
+            'apalancamiento': np.where(equity > 0, assets / equity, 0)
+        }
+
+# Function to calculate quarterly metrics for all entities at once
+def compute_quarterly_metrics(df, growth_policy=GROWTH_POLICY):
+    """Vectorized ratios and QoQ variations for every entity in df
+    
+    Returns one row per (entidad, periodo) sorted by entity and date. Ratios with
+    a non-positive denominator are 0, and the first quarter of each entity has
+    zero variation, as in the per-entity view.
+    """
+    data = df.sort_values(['entidad', 'fecha'])
+    metrics = data[['entidad'] + METRIC_BASE_COLUMNS].reset_index(drop=True)
+    
+    ratios = compute_ratio_arrays(
+        profit=metrics['resultados_antes_impuestos'].to_numpy(dtype=float),
+        assets=metrics['activos_totales'].to_numpy(dtype=float),
+        equity=metrics['fondos_propios'].to_numpy(dtype=float),
+        gross_margin=metrics['margen_bruto'].to_numpy(dtype=float),
+        expenses=metrics['gastos_explotacion'].to_numpy(dtype=float),
+        revenue=metrics['comisiones_percibidas'].to_numpy(dtype=float)
+    )
+    for name, values in ratios.items():
+        metrics[name] = values
+    
+    # Quarter-to-quarter changes against the previous row of the same entity
+    previous = metrics.groupby('entidad', sort=False)[list(VARIATION_COLUMNS.values())].shift(1)
+    first_quarter = previous.iloc[:, 0].isna().to_numpy()
+    for target, col in VARIATION_COLUMNS.items():
+        rate = growth_rate(metrics[col], previous[col], growth_policy, zero_value=0)
+        metrics[target] = np.where(first_quarter, 0, rate)
+    
+    # Attach the precomputed rolling metrics for the TTM view and the imputation flag
+    rolling_cols = [col for col in ROLLING_METRIC_COLUMNS + ['imputado'] if col in data.columns]
+    for col in rolling_cols:
+        metrics[col] = data[col].to_numpy()
+    
+    return metrics
+
+# Calculate quarterly metrics for one entity
+def calculate_quarterly_metrics(df, entity, growth_policy=GROWTH_POLICY):
+    entity_data = df[df['entidad'] == entity]
+    
+    if len(entity_data) < 1:
+        return None
+    
+    return compute_quarterly_metrics(entity_data, growth_policy).drop(columns='entidad')
+
+# Calculate quarterly metrics for several entities in one batched call
+def calculate_entities_metrics(df, entities, growth_policy=GROWTH_POLICY):
+    entity_data = df[df['entidad'].isin(entities)]
+    
+    if len(entity_data) < 1:
+        return None
+    
+    # Keep the order in which the entities were requested
+    metrics = compute_quarterly_metrics(entity_data, growth_policy)
+    order = {entity: i for i, entity in enumerate(entities)}
+    return metrics.sort_values('entidad', key=lambda col: col.map(order), kind='stable').reset_index(drop=True)
+
+# Columns of the peer comparison table (label -> metric)
+PEER_COMPARISON_METRICS = {
+    'Ingresos': 'comisiones_percibidas',
+    'Beneficio': 'resultados_antes_impuestos',
+    'ROA': 'ROA',
+    'ROE': 'ROE',
+    'Eficiencia': 'ratio_eficiencia'
+}
+
+# Function to build the comparison table of an entity and its peers
+def peer_comparison_table(df, entity, peers, window=(None, None), metrics=tuple(PEER_COMPARISON_METRICS),
+                          growth_policy=GROWTH_POLICY):
+    """Latest quarter within window (first, last periodo; None is open) of each peer, in order, then of entity
+    
+    Metrics are computed on the whole history, so the window only chooses the
+    quarter compared. One column per label of metrics.
+    """
+    history = calculate_entities_metrics(df, list(peers) + [entity], growth_policy)
+    if history is None:
+        return pd.DataFrame(columns=['Empresa', *metrics])
+    
+    first, last = window
+    in_window = pd.Series(True, index=history.index)
+    if first is not None:
+        in_window &= history['periodo'] >= first
+    if last is not None:
+        in_window &= history['periodo'] <= last
+    latest = history[in_window].groupby('entidad', sort=False).tail(1)
+    
+    table = latest[[PEER_COMPARISON_METRICS[label] for label in metrics]].set_axis(list(metrics), axis=1)
+    table.insert(0, 'Empresa', latest['entidad'])
+    return table.reset_index(drop=True)
+
+# Metrics scored by the anomaly detection stage
+ANOMALY_METRICS = ['comisiones_percibidas', 'comisiones_netas', 'margen_bruto', 'resultados_antes_impuestos',
+                   'gastos_explotacion', 'activos_totales', 'fondos_propios', 'ROE', 'ratio_eficiencia',
+                   'apalancamiento', 'var_ingresos']
+
+# Size-free metrics that are also compared across the sector-quarter (amounts depend on size)
+SECTOR_ANOMALY_METRICS = ['ROE', 'ratio_eficiencia', 'apalancamiento', 'var_ingresos']
+
+# Metrics that should never be negative (e.g. commissions after YTD differencing)
+NON_NEGATIVE_METRICS = ['comisiones_percibidas', 'activos_totales']
+
+# Robust z-score above which a value is flagged (Iglewicz-Hoaglin)
+ANOMALY_THRESHOLD = 3.5
+
+# Minimum group size for a robust z-score to be meaningful
+ANOMALY_MIN_GROUP = 5
+
+# Function to compute robust z-scores of several columns within groups
+def robust_z_scores(values, keys):
+    """(x - median) / (1.4826 * MAD) per group, for every column at once
+    
+    When the MAD is 0 (more than half the group identical) the mean absolute
+    deviation is used instead (scaled by 1.2533); if that is 0 too the score is
+    0. Groups smaller than ANOMALY_MIN_GROUP get NaN.
+    """
+    grouped = values.groupby(keys)
+    median = grouped.transform('median')
+    size = grouped.transform('count')
+    deviation = (values - median).abs()
+    deviation_groups = deviation.groupby(keys)
+    mad = deviation_groups.transform('median') * 1.4826
+    mean_ad = deviation_groups.transform('mean') * 1.2533
+    scale = mad.where(mad > 0, mean_ad)
+    
+    z = (values - median) / scale.where(scale > 0)
+    z = z.where(scale > 0, 0.0)
+    return z.where(size >= ANOMALY_MIN_GROUP)
+
+# Function to score every figure of each entity against its own history
+def entity_z_scores(df):
+    return robust_z_scores(df[ANOMALY_METRICS].astype(float), df['entidad'])
+
+# Function to score the size-free metrics against the same tipo and quarter
+def sector_z_scores(metrics):
+    return robust_z_scores(metrics[SECTOR_ANOMALY_METRICS].astype(float), [metrics['tipo'], metrics['periodo']])
+
+# Function to list the flagged figures of whole entities, given their sector z-scores
+def flag_anomalies(metrics, z_sector, threshold=ANOMALY_THRESHOLD):
+    """Flagged values in row and metric order; z_sector is sector_z_scores aligned with metrics
+    
+    Flags are computed on (rows x metrics) arrays; rows are only built for the flagged values.
+    """
+    values = metrics[ANOMALY_METRICS].to_numpy(dtype=float)
+    z_entity = run_by_entity(entity_z_scores, metrics[['entidad'] + ANOMALY_METRICS]).reindex(metrics.index)
+    z_entity = z_entity[ANOMALY_METRICS].to_numpy(dtype=float)
+    z_sector = z_sector.reindex(columns=ANOMALY_METRICS).to_numpy(dtype=float)
+    
+    entity_flag = np.abs(z_entity) >= threshold
+    sector_flag = np.abs(z_sector) >= threshold
+    negative_flag = np.isin(ANOMALY_METRICS, NON_NEGATIVE_METRICS) & (values < 0)
+    score = np.fmax(np.abs(z_entity), np.abs(z_sector))
+    score = np.where(np.isnan(score), 0.0, score)
+    score = np.where(negative_flag, np.maximum(score, threshold), score)
+    reason = np.select(
+        [negative_flag, entity_flag & sector_flag, entity_flag, sector_flag],
+        ['valor_negativo', 'entidad+sector', 'entidad', 'sector'],
+        default=''
+    )
+    
+    rows, columns = np.nonzero(reason != '')
+    flagged = pd.DataFrame({
+        'metrica': np.array(ANOMALY_METRICS)[columns],
+        'valor': values[rows, columns],
+        'z_entidad': z_entity[rows, columns],
+        'z_sector': z_sector[rows, columns],
+        'puntuacion': score[rows, columns],
+        'motivo': reason[rows, columns]
+    })
+    keys = metrics[['entidad', 'tipo', 'periodo']].iloc[rows].reset_index(drop=True)
+    return pd.concat([keys, flagged], axis=1)
+
+# Function to score every quarterly figure against its entity's history and its sector-quarter
+def compute_anomaly_scores(metrics, threshold=ANOMALY_THRESHOLD):
+    """Flagged values as a long table (entidad, tipo, periodo, metrica, valor, z_entidad, z_sector, puntuacion, motivo)
+    
+    metrics is the output of compute_quarterly_metrics for every entity. Every
+    metric is scored against the entity's own history; SECTOR_ANOMALY_METRICS also
+    against the same tipo and quarter. The score is the larger absolute z-score;
+    negative values of NON_NEGATIVE_METRICS are always flagged.
+    """
+    flagged = flag_anomalies(metrics, sector_z_scores(metrics), threshold)
+    return flagged.sort_values('puntuacion', ascending=False).reset_index(drop=True)
+
+# Components of the financial health score (tab 6)
+HEALTH_COMPONENTS = ['Rentabilidad', 'Calidad de Activos', 'Eficiencia', 'Margen', 'Solvencia']
+
+# Function to compute the health components from ratio arrays of any shape
+def compute_health_arrays(roe, roa, efficiency, net_margin, leverage):
+    """Health components (each capped to [-100, 100]) plus 'salud_global', their average"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        components = {
+            'Rentabilidad': np.clip(roe / 20 * 100, -100, 100),
+            'Calidad de Activos': np.clip(roa / 10 * 100, -100, 100),
+            'Eficiencia': np.maximum(0, 100 - efficiency),
+            'Margen': np.clip(net_margin * 5, -100, 100),
+            'Solvencia': np.where(leverage > 0, np.minimum(100, 100 / leverage), 100)
+        }
+    components['salud_global'] = sum(components.values()) / len(HEALTH_COMPONENTS)
+    return components
+
+# Function to compute the financial health score for every row of a metrics frame
+def compute_health_scores(metrics):
+    """Vectorized tab 6 health components and overall score for each row"""
+    components = compute_health_arrays(
+        roe=metrics['ROE'].to_numpy(dtype=float),
+        roa=metrics['ROA'].to_numpy(dtype=float),
+        efficiency=metrics['ratio_eficiencia'].to_numpy(dtype=float),
+        net_margin=metrics['margen_neto'].to_numpy(dtype=float),
+        leverage=metrics['apalancamiento'].to_numpy(dtype=float)
+    )
+    return pd.DataFrame(components, index=metrics.index)
+
+# Fields that scenarios can shock, as relative changes (-0.2 = -20%)
+SHOCK_FIELDS = ['comisiones_percibidas', 'margen_bruto', 'gastos_explotacion',
+                'fondos_propios', 'activos_totales']
+
+# Drop in the health score (points) that counts an entity as deteriorated
+STRESS_HEALTH_DROP = 10
+
+# Function to select the entity rows a stress test is applied to
+def stress_base(df, periodo=None):
+    """One row per entity for the given quarter (the latest one by default)"""
+    periodo = periodo or df['periodo'].max()
+    return df[df['periodo'] == periodo].drop_duplicates('entidad').reset_index(drop=True)
+
+# Function to apply a batch of parametric shocks to every entity at once
+def run_stress_scenarios(base, scenarios):
+    """Apply each scenario to every entity with NumPy broadcasting
+    
+    scenarios has one row per scenario and a column per shocked field in
+    SHOCK_FIELDS (missing columns mean no shock). Lower commissions pass through
+    to gross margin, and the change in gross margin minus the change in expenses
+    flows to profit before tax. Ratios and health components are then
+    recomputed on (scenario x entity) arrays.
+    
+    Returns a summary with one row per scenario (the distribution of affected
+    entities) and a dict of (scenario x entity) arrays for ROE, profit and health.
+    """
+    shocks = scenarios.reindex(columns=SHOCK_FIELDS).fillna(0).to_numpy(dtype=float)
+    shock = {field: shocks[:, [i]] for i, field in enumerate(SHOCK_FIELDS)}       # (S, 1)
+    value = {col: base[col].to_numpy(dtype=float)[np.newaxis, :]                 # (1, E)
+             for col in SHOCK_FIELDS + ['resultados_antes_impuestos']}
+    
+    revenue_change = value['comisiones_percibidas'] * shock['comisiones_percibidas']
+    revenue = value['comisiones_percibidas'] + revenue_change
+    gross_margin = value['margen_bruto'] * (1 + shock['margen_bruto']) + revenue_change
+    expenses = value['gastos_explotacion'] * (1 + shock['gastos_explotacion'])
+    profit = (value['resultados_antes_impuestos']
+              + (gross_margin - value['margen_bruto'])
+              - (expenses - value['gastos_explotacion']))
+    equity = value['fondos_propios'] * (1 + shock['fondos_propios'])
+    assets = value['activos_totales'] * (1 + shock['activos_totales'])
+    
+    ratios = compute_ratio_arrays(profit, assets, equity, gross_margin, expenses, revenue)
+    health = compute_health_arrays(ratios['ROE'], ratios['ROA'], ratios['ratio_eficiencia'],
+                                   ratios['margen_neto'], ratios['apalancamiento'])['salud_global']
+    
+    # Unshocked reference, evaluated the same way
+    base_ratios = compute_ratio_arrays(value['resultados_antes_impuestos'], value['activos_totales'],
+                                       value['fondos_propios'], value['margen_bruto'],
+                                       value['gastos_explotacion'], value['comisiones_percibidas'])
+    base_health = compute_health_arrays(base_ratios['ROE'], base_ratios['ROA'], base_ratios['ratio_eficiencia'],
+                                        base_ratios['margen_neto'], base_ratios['apalancamiento'])['salud_global']
+    health_change = health - base_health
+    
+    summary = scenarios.reindex(columns=SHOCK_FIELDS).fillna(0).reset_index(drop=True)
+    summary['entidades'] = base.shape[0]
+    summary['en_perdidas'] = (profit < 0).sum(axis=1)
+    summary['nuevas_perdidas'] = ((profit < 0) & (value['resultados_antes_impuestos'] >= 0)).sum(axis=1)
+    summary['deterioradas'] = (health_change <= -STRESS_HEALTH_DROP).sum(axis=1)
+    summary['roe_mediano'] = np.median(ratios['ROE'], axis=1) if base.shape[0] else np.nan
+    summary['salud_media'] = health.mean(axis=1) if base.shape[0] else np.nan
+    if base.shape[0]:
+        p10, p50, p90 = np.percentile(health_change, [10, 50, 90], axis=1)
+        summary['delta_salud_p10'], summary['delta_salud_p50'], summary['delta_salud_p90'] = p10, p50, p90
+    
+    detail = {'ROE': ratios['ROE'], 'resultados_antes_impuestos': profit,
+              'salud_global': health, 'delta_salud': health_change}
+    return summary, detail
+
+# Function to build a grid of scenarios from lists of shocks per field
+def scenario_grid(**shock_values):
+    """Cartesian product of the given shocks, e.g. scenario_grid(comisiones_percibidas=[-0.1, -0.2])"""
+    fields = list(shock_values)
+    mesh = np.meshgrid(*[np.asarray(shock_values[field], dtype=float) for field in fields], indexing='ij')
+    return pd.DataFrame({field: grid.ravel() for field, grid in zip(fields, mesh)})
+
+# Function to find the entities of the same type closest in average size
+def find_similar_entities(df, entity, n=3):
+    """Names of the n entities of the same tipo whose mean total assets are closest to entity's"""
+    entity_rows = df[df['entidad'] == entity]
+    if entity_rows.empty:
+        return []
+    
+    same_type = df[df['tipo'] == entity_rows['tipo'].iloc[0]]
+    sizes = same_type.groupby('entidad')['activos_totales'].mean()
+    size_diff = (sizes.drop(entity) - sizes[entity]).abs().sort_values(kind='stable')
+    return size_diff.head(n).index.tolist()
+
+# Function to identify a processed dataset by its content
+def dataset_version(df):
+    """Short content hash of a frame, stable across runs for identical data
+    
+    df can also be an iterable of consecutive chunks of the frame, which hash
+    to the same version as the whole frame.
+    """
+    digest, columns = hashlib.sha1(), []
+    for chunk in [df] if isinstance(df, pd.DataFrame) else df:
+        digest.update(pd.util.hash_pandas_object(chunk, index=False).to_numpy().tobytes())
+        columns = chunk.columns
+    digest.update(','.join(map(str, columns)).encode())
+    return digest.hexdigest()[:12]
+
+# Directory where materialized tables are persisted between runs
+STORE_DIR = 'store'
+
+# Function to read a materialized table from the store
+def read_store_table(name):
+    """Read a persisted table, returning None if it does not exist or cannot be read"""
+    path = os.path.join(STORE_DIR, f'{name}.parquet')
+    if not os.path.exists(path):
+        return None
+    try:
+        return pd.read_parquet(path)
+    except Exception:
+        return None
+
+# Function to persist a materialized table in the store
+def write_store_table(df, name):
+    """Write a table to the store; failures (e.g. read-only disk) are ignored"""
+    try:
+        os.makedirs(STORE_DIR, exist_ok=True)
+        df.to_parquet(os.path.join(STORE_DIR, f'{name}.parquet'), index=False)
+        return True
+    except Exception:
+        return False
+
+# Directory of the immutable snapshots of each processed dataset
+SNAPSHOT_DIR = os.path.join(STORE_DIR, 'snapshots')
+
+# Tables kept in every snapshot ('dataset' is the combined frame)
+SNAPSHOT_TABLES = ['dataset', 'metrics', 'merge_audit', 'quarantine', 'anomalies']
+
+# Function to store a processed build as an immutable, versioned snapshot
+def save_snapshot(tables, **build_info):
+    """Write the tables under snapshots/<version>/ and register the version
+    
+    The version is the content hash of the dataset, so an identical rebuild is a
+    no-op and existing snapshots are never overwritten. Returns the version.
+    """
+    version = dataset_version(tables['dataset'])
+    path = os.path.join(SNAPSHOT_DIR, version)
+    if os.path.exists(os.path.join(path, 'dataset.parquet')):
+        return version
+    try:
+        os.makedirs(path, exist_ok=True)
+        # The dataset is written last: its presence marks a complete snapshot
+        for name in sorted(tables, key=lambda name: name == 'dataset'):
+            tables[name].to_parquet(os.path.join(path, f'{name}.parquet'), index=False)
+    except Exception:
+        return version
+    
+    dataset = tables['dataset']
+    register_snapshot(version, len(dataset), dataset['entidad'].nunique(), dataset['periodo'].max(), **build_info)
+    return version
+
+# Function to add a stored snapshot to the list of versions
+def register_snapshot(version, rows, entities, last_period, **build_info):
+    entry = pd.DataFrame([{
+        'version': version,
+        'creado': pd.Timestamp.now().floor('s'),
+        'filas': rows,
+        'entidades': entities,
+        'ultimo_periodo': last_period,
+        **build_info
+    }])
+    history = read_store_table('snapshots')
+    write_store_table(entry if history is None else pd.concat([history, entry], ignore_index=True), 'snapshots')
+
+# Function to list the stored snapshots, newest first
+def list_snapshots():
+    history = read_store_table('snapshots')
+    if history is None:
+        return pd.DataFrame(columns=['version', 'creado', 'filas', 'entidades', 'ultimo_periodo'])
+    available = history['version'].map(lambda v: os.path.exists(os.path.join(SNAPSHOT_DIR, v, 'dataset.parquet')))
+    return history[available].sort_values('creado', ascending=False).reset_index(drop=True)
+
+# Function to read one table of a snapshot
+def read_snapshot_table(version, name='dataset'):
+    """Read a snapshot table, returning None if it does not exist or cannot be read"""
+    path = os.path.join(SNAPSHOT_DIR, version, f'{name}.parquet')
+    if not os.path.exists(path):
+        return None
+    try:
+        return pd.read_parquet(path)
+    except Exception:
+        return None
+
+# Tables derived from a snapshot's dataset, added to the snapshot the first time they are computed
+SNAPSHOT_DERIVED_TABLES = ['sector_aggregates', 'market_shares', 'concentration', 'peer_bands']
+
+# Function to add a derived table to a stored snapshot
+def save_snapshot_table(version, name, df):
+    """Write-once like the snapshot itself: an existing table is kept, and nothing is written
+    for a version that has no stored snapshot. Failures (e.g. read-only disk) are ignored"""
+    path = os.path.join(SNAPSHOT_DIR, version, f'{name}.parquet')
+    if os.path.exists(path) or not os.path.exists(os.path.join(SNAPSHOT_DIR, version, 'dataset.parquet')):
+        return False
+    try:
+        # Written aside and renamed, so a concurrent query never sees a partial file
+        df.to_parquet(f'{path}.tmp', index=False)
+        os.replace(f'{path}.tmp', path)
+        return True
+    except Exception:
+        return False
+
+# Function to load a pinned snapshot of the dataset (immutable, so cached for good)
+@st.cache_data
+def load_snapshot(version):
+    return read_snapshot_table(version, 'dataset')
+
+# Function to get the processed dataset, or a pinned snapshot of it
+def build_dataset(growth_policy=GROWTH_POLICY, imputation=IMPUTATION_METHOD, pinned_version=None):
+    if pinned_version is not None:
+        snapshot = load_snapshot(pinned_version)
+        if snapshot is not None:
+            return snapshot
+    return load_data(growth_policy, imputation)[0]
+
+# Peer results kept in memory for every session (the least recently used are dropped first)
+PEER_CACHE_ENTRIES = 256
+
+# Function to load the quarterly metrics of a set of peers of the current dataset
+@st.cache_data(max_entries=PEER_CACHE_ENTRIES)
+def load_entities_metrics(version, entities, growth_policy=GROWTH_POLICY, imputation=IMPUTATION_METHOD,
+                          pinned_version=None):
+    """Cached per dataset version and entity set (a tuple), shared by every session"""
+    combined = build_dataset(growth_policy, imputation, pinned_version)
+    return calculate_entities_metrics(combined, list(entities), growth_policy)
+
+# Function to load the comparison table of an entity and its peers in the current dataset
+@st.cache_data(max_entries=PEER_CACHE_ENTRIES)
+def load_peer_comparison(version, entity, peers, window, metrics, growth_policy=GROWTH_POLICY,
+                         imputation=IMPUTATION_METHOD, pinned_version=None):
+    """Cached per dataset version, entity set, period window and metric set, shared by every session
+    
+    A new dataset version changes the key, so only a rebuild invalidates the
+    results; entries of older versions age out of the LRU bound.
+    """
+    combined = build_dataset(growth_policy, imputation, pinned_version)
+    return peer_comparison_table(combined, entity, peers, window, metrics, growth_policy)
+
+# Raw inputs larger than this on disk are processed in entity batches by build_dataset_chunked
+CHUNKED_INPUT_BYTES = 64 * 1024 * 1024
+
+# Memory budget of the chunked pipeline (MB)
+PIPELINE_MEMORY_BUDGET_MB = 512
+
+# Peak memory of the pipeline stages per byte of raw rows in a batch (measured with benchmark.py memory)
+PIPELINE_MEMORY_FACTOR = 25
+
+# Raw rows read at a time when a raw file is staged
+RAW_CHUNK_ROWS = 20_000
+
+# Function to iterate over the rows of the raw file of a source in chunks
+def iter_raw_chunks(source, chunk_rows=RAW_CHUNK_ROWS):
+    """Frames of at most chunk_rows rows with the raw column names and types (Excel is streamed in read-only mode)"""
+    path, columns = source['path'], source['columns']
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        for chunk in pd.read_csv(path, chunksize=chunk_rows):
+            yield normalize_raw_types(chunk, columns)
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield normalize_raw_types(batch.to_pandas(), columns)
+    else:
+        from openpyxl import load_workbook
+        
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = next(rows)
+            while chunk := list(itertools.islice(rows, chunk_rows)):
+                yield normalize_raw_types(pd.DataFrame(chunk, columns=header), columns)
+        finally:
+            workbook.close()
+
+# Function to append a frame to a Parquet file as one row group, opening its writer on first use
+def append_parquet(writers, path, df):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    if path not in writers:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        writers[path] = pq.ParquetWriter(path, table.schema)
+    else:
+        table = pa.Table.from_pandas(df, schema=writers[path].schema, preserve_index=False)
+    writers[path].write_table(table, row_group_size=max(len(table), 1))
+
+# Function to read staging files back (optionally the rows whose column value is in keys), indexed by row number
+def read_staged_rows(paths, column=None, keys=None, order='_orden'):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    
+    dataset = ds.dataset(paths)
+    condition = None
+    if column is not None:
+        condition = ds.field(column).isin(pa.array(list(keys), type=dataset.schema.field(column).type))
+    table = dataset.to_table(filter=condition)
+    rows = table.to_pandas().set_index(order).rename_axis(None).sort_index(kind='stable')
+    # Return the scan buffers to the system rather than keeping them in Arrow's pool
+    del table
+    pa.default_memory_pool().release_unused()
+    return rows
+
+# Function to split entities (sorted by key) into consecutive batches of about max_rows rows
+def plan_entity_batches(row_counts, max_rows):
+    """Lists of keys; a batch goes over max_rows by at most its last entity"""
+    batch = (row_counts.cumsum() - row_counts) // max(int(max_rows), 1)
+    return [keys.index.tolist() for _, keys in row_counts.groupby(batch.to_numpy())]
+
+# Function to split a staging file into one file per batch of keys
+def partition_staged_rows(path, column, batches, prefix):
+    """Returns the file of each batch; rows keep their order, one row group of the source at a time"""
+    import pyarrow.parquet as pq
+    
+    batch_of = {key: i for i, keys in enumerate(batches) for key in keys}
+    paths = [f'{prefix}_{i}.parquet' for i in range(len(batches))]
+    writers = {}
+    try:
+        source = pq.ParquetFile(path)
+        for group in range(source.num_row_groups):
+            rows = source.read_row_group(group).to_pandas()
+            for i, part in rows.groupby(rows[column].map(batch_of)):
+                append_parquet(writers, paths[int(i)], part)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return paths
+
+# Function to copy the raw file of a source into a Parquet staging file with its row number and entity key
+def stage_raw_file(source, target, chunk_rows=RAW_CHUNK_ROWS):
+    """Returns (rows per entity key, in-memory bytes per raw row)"""
+    writers, counts, rows, size = {}, [], 0, 0
+    try:
+        for chunk in iter_raw_chunks(source, chunk_rows):
+            chunk = chunk.assign(_orden=np.arange(rows, rows + len(chunk)),
+                                 _clave=chunk['Denominación'].map(clean_entity_name).astype('str'))
+            append_parquet(writers, target, chunk)
+            counts.append(chunk['_clave'].value_counts())
+            rows += len(chunk)
+            size += chunk.memory_usage(deep=True).sum()
+    finally:
+        for writer in writers.values():
+            writer.close()
+    counts = pd.concat(counts).groupby(level=0).sum() if counts else pd.Series(dtype=int)
+    return counts[counts.index != ''], size / max(rows, 1)
+
+# Function to build and store the dataset processing whole entities in memory-bounded batches
+def build_dataset_chunked(sources=ENTITY_SOURCES, growth_policy=GROWTH_POLICY, imputation=IMPUTATION_METHOD,
+                          memory_budget_mb=PIPELINE_MEMORY_BUDGET_MB, chunk_rows=RAW_CHUNK_ROWS):
+    """Same tables and snapshot as load_data, without holding the raw inputs or the dataset in memory
+    
+    The raw files of the sources (tipo -> source, see register_source) are streamed into Parquet staging files. Each
+    file then goes through prepare_entities in batches of whole entities, and
+    after the name merge (planned on per-entity summaries) every batch of
+    canonical entities goes through combine_entities. Results are appended to
+    the snapshot tables as batches finish; the anomaly stage, which compares
+    entities within each quarter, reads back only the columns it scores.
+    Batches are sized so that their raw rows times PIPELINE_MEMORY_FACTOR fit
+    memory_budget_mb. Returns the snapshot version.
+    """
+    os.makedirs(STORE_DIR, exist_ok=True)
+    work = tempfile.mkdtemp(prefix='lotes_', dir=STORE_DIR)
+    snapshot = os.path.join(work, 'snapshot')
+    os.makedirs(snapshot)
+    writers = {}
+    try:
+        # Stage the raw files and size the batches from the largest rows
+        staged, row_counts, row_bytes = {}, {}, 1
+        for tipo, source in sources.items():
+            staged[tipo] = os.path.join(work, f'bruto_{len(staged)}.parquet')
+            row_counts[tipo], size = stage_raw_file(source, staged[tipo], chunk_rows)
+            row_bytes = max(row_bytes, size)
+        max_rows = memory_budget_mb * 1024 * 1024 / (row_bytes * PIPELINE_MEMORY_FACTOR)
+        
+        # Per-file stages, batch by batch, keeping the per-entity summaries for the name merge
+        checks, removed, names, audits, first_files = [], [], [], [], {}
+        for n, (tipo, path) in enumerate(staged.items()):
+            raw_files = partition_staged_rows(path, '_clave', plan_entity_batches(row_counts[tipo], max_rows),
+                                              os.path.join(work, f'bruto_{n}'))
+            os.remove(path)
+            ytd_columns = sources[tipo]['ytd_columns']
+            peer_profiles = None
+            if imputation == 'estacional':
+                learning = [seasonal_learning_rows(read_staged_rows(part).drop(columns='_clave'), ytd_columns)
+                            for part in raw_files]
+                peer_profiles = peer_seasonal_profiles(pd.concat(learning))
+            
+            quality, rows = [], 0
+            for i, part in enumerate(raw_files):
+                raw = read_staged_rows(part).drop(columns='_clave')
+                entities, batch_checks, batch_removed = prepare_entities(raw, tipo, imputation, peer_profiles,
+                                                                         ytd_columns)
+                prepared = os.path.join(work, f'entidades_{n}_{i}.parquet')
+                entities.assign(_orden=np.arange(rows, rows + len(entities))).to_parquet(prepared, index=False)
+                rows += len(entities)
+                checks.append(batch_checks)
+                removed.append(batch_removed)
+                quality.append(entity_quality_scores(entities).assign(
+                    filas=entities.groupby('entidad').size().to_numpy(), archivo=prepared))
+            
+            quality = pd.concat(quality, ignore_index=True)
+            mapping, audit = match_entity_names(quality['entidad'].tolist(), quality['quality_score'].tolist())
+            audits.append(audit.assign(tipo=tipo))
+            names.append(quality[['entidad', 'filas', 'archivo']].assign(
+                tipo=tipo, canonica=quality['entidad'].replace(mapping)))
+            first_files[tipo] = os.path.join(work, f'entidades_{n}_0.parquet')
+        names = pd.concat(names, ignore_index=True)
+        renamed = names[names['entidad'] != names['canonica']]
+        mappings = {tipo: dict(zip(group['entidad'], group['canonica'])) for tipo, group in renamed.groupby('tipo')}
+        
+        # Stages after the merge, in batches of canonical entities of every tipo, reading only
+        # the per-file batches that hold their name variants
+        type_changes, period_rows, metric_rows, entity_count, last_period = [], [], 0, 0, None
+        staged_dataset = os.path.join(work, 'dataset.parquet')
+        staged_sector = os.path.join(work, 'sector.parquet')
+        for keys in plan_entity_batches(names.groupby('canonica')['filas'].sum(), max_rows):
+            members = names[names['canonica'].isin(keys)]
+            entities = {}
+            for tipo, first_file in first_files.items():
+                variants = members[members['tipo'] == tipo]
+                files = variants['archivo'].unique().tolist() or [first_file]
+                entities[tipo] = read_staged_rows(files, 'entidad', variants['entidad'])
+            _, combined, metrics, batch_changes = combine_entities(
+                entities, {tipo: mappings.get(tipo, {}) for tipo in entities}, growth_policy)
+            type_changes.append(batch_changes)
+            if combined.empty:
+                continue
+            append_parquet(writers, staged_dataset, combined)
+            append_parquet(writers, os.path.join(snapshot, 'metrics.parquet'), metrics)
+            append_parquet(writers, staged_sector, metrics[['tipo', 'periodo'] + SECTOR_ANOMALY_METRICS].assign(
+                _orden=np.arange(metric_rows, metric_rows + len(metrics))))
+            metric_rows += len(metrics)
+            period_rows.append(metrics['periodo'].value_counts())
+            entity_count += combined['entidad'].nunique()
+            last_period = max(last_period or '', combined['periodo'].max())
+        for writer in writers.values():
+            writer.close()
+        writers.clear()
+        
+        # Anomalies: sector z-scores in batches of quarters (kept on disk), then the flags per entity batch
+        import pyarrow.parquet as pq
+        
+        period_rows = pd.concat(period_rows).groupby(level=0).sum()
+        z_sector = np.lib.format.open_memmap(os.path.join(work, 'z_sector.npy'), mode='w+', dtype=float,
+                                             shape=(period_rows.sum(), len(SECTOR_ANOMALY_METRICS)))
+        for keys in plan_entity_batches(period_rows, max_rows):
+            quarters = read_staged_rows(staged_sector, 'periodo', keys)
+            z_sector[quarters.index.to_numpy()] = sector_z_scores(quarters).to_numpy()
+        
+        metrics_file, flagged, start = pq.ParquetFile(os.path.join(snapshot, 'metrics.parquet')), [], 0
+        for i in range(metrics_file.num_row_groups):
+            scored = metrics_file.read_row_group(i, columns=['entidad', 'tipo', 'periodo'] + ANOMALY_METRICS).to_pandas()
+            batch_z = pd.DataFrame(z_sector[start:start + len(scored)], columns=SECTOR_ANOMALY_METRICS)
+            flagged.append(flag_anomalies(scored, batch_z))
+            start += len(scored)
+        del z_sector
+        anomalies = pd.concat([part for part in flagged if not part.empty] or flagged[:1], ignore_index=True)
+        anomalies = anomalies.sort_values('puntuacion', ascending=False).reset_index(drop=True)
+        
+        # Quarantine in load_data's order: raw checks, removed entities, then type changes per tipo
+        tipo_order = {tipo: i for i, tipo in enumerate(sources)}
+        type_changes = pd.concat(type_changes, ignore_index=True)
+        type_changes = type_changes.sort_values('tipo', key=lambda t: t.map(tipo_order), kind='stable')
+        quarantine = pd.concat(checks + removed + [type_changes], ignore_index=True).astype({'valor': float})
+        merge_audit = pd.concat(audits, ignore_index=True)
+        
+        # Final pass: anomaly counts and the snapshot's dataset table, hashed as it is written
+        staged_file, final = pq.ParquetFile(staged_dataset), os.path.join(snapshot, 'final.parquet')
+        
+        def final_chunks():
+            for i in range(staged_file.num_row_groups):
+                dataset = staged_file.read_row_group(i).to_pandas()
+                dataset['n_anomalias'] = anomaly_counts(dataset, anomalies)
+                append_parquet(writers, final, dataset)
+                yield dataset
+        
+        version = dataset_version(final_chunks())
+        writers.pop(final).close()
+        
+        for name, table in [('merge_audit', merge_audit), ('quarantine', quarantine), ('anomalies', anomalies)]:
+            table.to_parquet(os.path.join(snapshot, f'{name}.parquet'), index=False)
+        os.replace(os.path.join(snapshot, 'final.parquet'), os.path.join(snapshot, 'dataset.parquet'))
+        
+        # Publish the snapshot unless an identical build already exists
+        target = os.path.join(SNAPSHOT_DIR, version)
+        if not os.path.exists(os.path.join(target, 'dataset.parquet')):
+            shutil.rmtree(target, ignore_errors=True)
+            os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+            os.replace(snapshot, target)
+            register_snapshot(version, staged_file.metadata.num_rows, entity_count, last_period,
+                              politica_crecimiento=growth_policy, imputacion=imputation)
+        return version
+    finally:
+        for writer in writers.values():
+            writer.close()
+        shutil.rmtree(work, ignore_errors=True)
+
+# Columns compared by diff_snapshots when none are given
+DIFF_COLUMNS = ['tipo', 'fondos_propios', 'activos_totales', 'comisiones_percibidas', 'comisiones_netas',
+                'margen_bruto', 'gastos_explotacion', 'resultados_antes_impuestos']
+
+# Function to compute the row-level changes between two snapshots
+def diff_snapshots(old, new, columns=None, keys=('entidad', 'periodo'), rtol=1e-9):
+    """Compare two datasets joined on (entidad, periodo)
+    
+    Returns (rows, changes): rows has one row per key that was added, removed or
+    modified, with its 'estado'. changes has one row per modified cell (columna,
+    anterior, nuevo). Numeric columns are compared with a relative tolerance.
+    NaN equals NaN.
+    """
+    keys = list(keys)
+    columns = [col for col in (columns or DIFF_COLUMNS) if col in old.columns and col in new.columns]
+    joined = old[keys + columns].merge(new[keys + columns], on=keys, how='outer',
+                                       suffixes=('_anterior', '_nuevo'), indicator=True)
+    
+    changed = pd.DataFrame(False, index=joined.index, columns=columns)
+    for col in columns:
+        before, after = joined[f'{col}_anterior'], joined[f'{col}_nuevo']
+        same = (before == after) | (before.isna() & after.isna())
+        if pd.api.types.is_numeric_dtype(before) and pd.api.types.is_numeric_dtype(after):
+            same |= np.isclose(before.to_numpy(dtype=float), after.to_numpy(dtype=float), rtol=rtol)
+        changed[col] = ~same.to_numpy()
+    
+    both = (joined['_merge'] == 'both').to_numpy()
+    status = np.select(
+        [joined['_merge'] == 'right_only', joined['_merge'] == 'left_only', both & changed.any(axis=1)],
+        ['nueva', 'eliminada', 'modificada'],
+        default=''
+    )
+    rows = joined[keys].assign(estado=status)
+    rows = rows[rows['estado'] != ''].sort_values(keys).reset_index(drop=True)
+    
+    # One row per modified cell
+    parts = [pd.DataFrame(columns=keys + ['columna', 'anterior', 'nuevo'])]
+    for col in columns:
+        mask = both & changed[col].to_numpy()
+        if mask.any():
+            parts.append(joined.loc[mask, keys].assign(
+                columna=col,
+                anterior=joined.loc[mask, f'{col}_anterior'].astype(object),
+                nuevo=joined.loc[mask, f'{col}_nuevo'].astype(object)
+            ))
+    changes = pd.concat(parts, ignore_index=True)
+    return rows, changes.sort_values(keys + ['columna']).reset_index(drop=True)
+
+# SQL views over the tables of a snapshot: view name -> snapshot table
+QUERY_SNAPSHOT_VIEWS = {
+    'datos': 'dataset',
+    'metricas': 'metrics',
+    'anomalias': 'anomalies',
+    'cuarentena': 'quarantine',
+    'fusiones': 'merge_audit',
+    'sector': 'sector_aggregates',
+    'cuotas': 'market_shares',
+    'concentracion': 'concentration',
+    'bandas_pares': 'peer_bands'
+}
+
+# SQL views over the tables shared by every build: view name -> store table
+QUERY_STORE_VIEWS = {
+    'versiones': 'snapshots'
+}
+
+# Maximum number of rows returned by a query
+QUERY_MAX_ROWS = 10_000
+
+# Function to locate the Parquet file behind every SQL view of a dataset version
+def query_sources(version):
+    """Existing files only: older snapshots may lack some tables, and the derived ones
+    (SNAPSHOT_DERIVED_TABLES) only exist once they have been computed for that version"""
+    paths = {view: os.path.join(SNAPSHOT_DIR, version, f'{table}.parquet')
+             for view, table in QUERY_SNAPSHOT_VIEWS.items()}
+    paths.update({view: os.path.join(STORE_DIR, f'{table}.parquet') for view, table in QUERY_STORE_VIEWS.items()})
+    return {view: path for view, path in paths.items() if os.path.exists(path)}
+
+# Function to name the SQL columns of a table
+def query_column_names(names):
+    """SQL identifiers are case-insensitive, so a column that only differs in case from a
+    lowercase one (the raw 'Periodo' label next to 'periodo') gets an '_original' suffix"""
+    lowercase = {name for name in names if name == name.lower()}
+    return [f'{name}_original' if name != name.lower() and name.lower() in lowercase else name for name in names]
+
+# Function to describe the SQL views of a dataset version (rows and columns)
+def describe_query_sources(version):
+    import pyarrow.parquet as pq
+    
+    rows = []
+    for view, path in query_sources(version).items():
+        metadata = pq.read_metadata(path)
+        rows.append({'tabla': view, 'filas': metadata.num_rows,
+                     'columnas': ', '.join(query_column_names(metadata.schema.to_arrow_schema().names))})
+    return pd.DataFrame(rows, columns=['tabla', 'filas', 'columnas'])
+
+# Function to open the embedded SQL engine over the persisted tables of a dataset version
+def connect_query_engine(version):
+    """In-process DuckDB connection with one view per persisted table
+    
+    Tables are registered as Arrow datasets over the Parquet files, so DuckDB
+    pushes the selected columns and WHERE filters down into the scan instead of
+    loading whole tables. Access to any other file is disabled.
+    """
+    import duckdb
+    import pyarrow.dataset as ds
+    
+    connection = duckdb.connect()
+    for view, path in query_sources(version).items():
+        dataset = ds.dataset(path, format='parquet')
+        connection.register(f'_{view}', dataset)
+        select = ', '.join(f'"{engine_name}" AS "{name}"' for engine_name, name in zip(
+            connection.table(f'_{view}').columns, query_column_names(dataset.schema.names)
+        ))
+        connection.execute(f'CREATE VIEW {view} AS SELECT {select} FROM _{view}')
+    connection.execute("SET enable_external_access = false")
+    connection.execute("SET lock_configuration = true")
+    return connection
+
+# Function to run a SQL query over the persisted tables of a dataset version
+def run_query(sql, version, max_rows=QUERY_MAX_ROWS):
+    """Result of the query as a DataFrame, truncated to max_rows
+    
+    Raises ValueError for statements that return no rows.
+    """
+    connection = connect_query_engine(version)
+    try:
+        relation = connection.sql(sql)
+        if relation is None:
+            raise ValueError("La consulta no devuelve filas")
+        return relation.limit(max_rows).df()
+    finally:
+        connection.close()
+
+# Export formats: label and MIME type
+EXPORT_FORMATS = {
+    'csv': ('CSV', 'text/csv'),
+    'parquet': ('Parquet', 'application/vnd.apache.parquet'),
+    'xlsx': ('Excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+}
+
+# Rows converted and written at a time by the export engine
+EXPORT_CHUNK_ROWS = 50_000
+
+# Rows per Excel sheet (the format allows 1,048,576 including the header)
+XLSX_MAX_ROWS = 1_048_575
+
+# Function to iterate over the selected rows of a frame in chunks
+def iter_export_chunks(df, entities=None, periods=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Yield the rows of the given entities and periods (None = all), chunk_rows at a time
+    
+    Only the positions of the selected rows are materialized; each chunk is
+    copied out of df when it is written. At least one (possibly empty) chunk is
+    yielded so writers always see the columns.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    if entities is not None:
+        mask &= df['entidad'].isin(entities).to_numpy()
+    if periods is not None:
+        mask &= df['periodo'].isin(periods).to_numpy()
+    positions = np.flatnonzero(mask)
+    
+    yield df.iloc[positions[:chunk_rows]]
+    for start in range(chunk_rows, len(positions), chunk_rows):
+        yield df.iloc[positions[start:start + chunk_rows]]
+
+# Function to stream chunks to CSV
+def write_csv_chunks(chunks, target):
+    for i, chunk in enumerate(chunks):
+        target.write(chunk.to_csv(header=(i == 0), index=False).encode('utf-8'))
+
+# Function to stream chunks to Parquet, one row group per chunk
+def write_parquet_chunks(chunks, target):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    writer = None
+    for chunk in chunks:
+        if writer is None:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            writer = pq.ParquetWriter(target, table.schema)
+        else:
+            table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+        writer.write_table(table)
+    writer.close()
+
+# Function to stream chunks to Excel with openpyxl's write-only mode
+def write_xlsx_chunks(chunks, target):
+    from openpyxl import Workbook
+    
+    workbook = Workbook(write_only=True)
+    sheet, sheet_rows, columns = None, XLSX_MAX_ROWS, None
+    for chunk in chunks:
+        columns = list(chunk.columns)
+        values = chunk.astype(object).where(chunk.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            if sheet_rows >= XLSX_MAX_ROWS:
+                sheet = workbook.create_sheet(f'datos_{len(workbook.worksheets) + 1}')
+                sheet.append(columns)
+                sheet_rows = 0
+            sheet.append(row)
+            sheet_rows += 1
+    if sheet is None:
+        workbook.create_sheet('datos_1').append(columns)
+    workbook.save(target)
+
+EXPORT_WRITERS = {
+    'csv': write_csv_chunks,
+    'parquet': write_parquet_chunks,
+    'xlsx': write_xlsx_chunks
+}
+
+# Function to export the selected rows of a frame in any supported format
+def export_dataset(df, fmt, entities=None, periods=None, path=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Write df (filtered to entities/periods) as CSV, Parquet or XLSX
+    
+    Rows are converted and written chunk by chunk. With a path the file is
+    written to disk; otherwise a rewound io.BytesIO is returned, one of the
+    types st.download_button accepts from a callable.
+    """
+    if fmt not in EXPORT_WRITERS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    chunks = iter_export_chunks(df, entities, periods, chunk_rows)
+    if path is not None:
+        with open(path, 'wb') as target:
+            EXPORT_WRITERS[fmt](chunks, target)
+        return path
+    
+    target = io.BytesIO()
+    EXPORT_WRITERS[fmt](chunks, target)
+    target.seek(0)
+    return target
+
+# Columns whose values define the content of a sector aggregate row
+SECTOR_SOURCE_COLUMNS = ['entidad', 'comisiones_percibidas', 'activos_totales',
+                         'fondos_propios', 'resultados_antes_impuestos']
+
+# Function to fingerprint the input rows of each (periodo, tipo) group
+def sector_group_signatures(df):
+    """Order-independent hash of the rows feeding each (periodo, tipo) aggregate"""
+    row_hash = pd.util.hash_pandas_object(df[SECTOR_SOURCE_COLUMNS], index=False) % (2 ** 31)
+    return row_hash.astype('int64').groupby([df['periodo'], df['tipo']]).sum().rename('firma')
+
+# Function to compute sector-wide aggregates per quarter and entity type
+def compute_sector_aggregates(df):
+    """Total commissions and assets, median ROE and HHI per (periodo, tipo) in a single groupby"""
+    columns = ['periodo', 'tipo', 'fecha', 'n_entidades', 'total_comisiones', 'total_activos',
+               'total_fondos_propios', 'total_resultados', 'roe_mediano', 'hhi_comisiones', 'firma']
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+    
+    commissions = df['comisiones_percibidas'].clip(lower=0)
+    frame = df.assign(
+        roe=np.where(df['fondos_propios'] > 0,
+                     df['resultados_antes_impuestos'] / df['fondos_propios'] * 100, 0),
+        comisiones_pos=commissions,
+        comisiones_sq=commissions ** 2
+    )
+    
+    aggregates = frame.groupby(['periodo', 'tipo']).agg(
+        fecha=('fecha', 'max'),
+        n_entidades=('entidad', 'nunique'),
+        total_comisiones=('comisiones_percibidas', 'sum'),
+        total_activos=('activos_totales', 'sum'),
+        total_fondos_propios=('fondos_propios', 'sum'),
+        total_resultados=('resultados_antes_impuestos', 'sum'),
+        roe_mediano=('roe', 'median'),
+        comisiones_pos=('comisiones_pos', 'sum'),
+        comisiones_sq=('comisiones_sq', 'sum')
+    )
+    
+    # HHI = sum of squared market shares (0-10,000), derived from the same group sums
+    total_pos = aggregates['comisiones_pos']
+    aggregates['hhi_comisiones'] = (aggregates['comisiones_sq'] / total_pos.pow(2) * 10000).where(total_pos > 0)
+    aggregates['firma'] = sector_group_signatures(df)
+    
+    return aggregates.reset_index()[columns]
+
+# Function to refresh only the aggregate rows whose input quarter changed
+def update_sector_aggregates(aggregates, df):
+    """Recompute aggregates only for (periodo, tipo) groups that are new or whose rows changed"""
+    if aggregates is None or aggregates.empty or 'firma' not in aggregates.columns:
+        return compute_sector_aggregates(df)
+    
+    current = sector_group_signatures(df).reset_index()
+    stored = aggregates[['periodo', 'tipo', 'firma']]
+    merged = current.merge(stored, on=['periodo', 'tipo'], how='left', suffixes=('', '_stored'))
+    stale = merged[merged['firma'] != merged['firma_stored']][['periodo', 'tipo']]
+    
+    # Drop groups that changed or no longer exist, then append the recomputed ones
+    keep = aggregates.merge(current[['periodo', 'tipo']], on=['periodo', 'tipo'], how='inner')
+    keep = keep.merge(stale, on=['periodo', 'tipo'], how='left', indicator=True)
+    keep = keep[keep['_merge'] == 'left_only'].drop(columns='_merge')
+    
+    if stale.empty:
+        return keep.sort_values(['periodo', 'tipo']).reset_index(drop=True)
+    
+    affected = df.merge(stale, on=['periodo', 'tipo'], how='inner')
+    refreshed = compute_sector_aggregates(affected)
+    return pd.concat([keep, refreshed], ignore_index=True).sort_values(['periodo', 'tipo']).reset_index(drop=True)
+
+# Function to load the materialized sector aggregate table
+@st.cache_data
+def load_sector_aggregates(growth_policy=GROWTH_POLICY, imputation=IMPUTATION_METHOD, pinned_version=None):
+    """Sector aggregates kept in the store and refreshed incrementally on each new dataset"""
+    combined = build_dataset(growth_policy, imputation, pinned_version)
+    if pinned_version is not None:
+        aggregates = compute_sector_aggregates(combined)
+    else:
+        stored = read_store_table('sector_aggregates')
+        aggregates = update_sector_aggregates(stored, combined)
+        if stored is None or not aggregates.equals(stored):
+            write_store_table(aggregates, 'sector_aggregates')
+    save_snapshot_table(pinned_version or load_data(growth_policy, imputation)[1], 'sector_aggregates', aggregates)
+    return aggregates
+
+# Figures whose market shares are tracked: column -> label
+MARKET_SHARE_METRICS = {
+    'comisiones_percibidas': 'Comisiones',
+    'activos_totales': 'Activos'
+}
+
+# Market covering every entity type (the other markets are each tipo)
+WHOLE_MARKET = 'Total'
+
+# Number of largest entities whose combined share is reported
+TOP_N_SHARES = [1, 5, 10]
+
+# Function to fingerprint the input rows of each quarter's market shares
+def market_share_signatures(df):
+    """Order-independent hash of the rows feeding each periodo's shares"""
+    columns = ['entidad', 'tipo'] + list(MARKET_SHARE_METRICS)
+    row_hash = pd.util.hash_pandas_object(df[columns], index=False) % (2 ** 31)
+    return row_hash.astype('int64').groupby(df['periodo']).sum().rename('firma')
+
+# Function to compute market shares and concentration per quarter, market and metric
+def compute_market_shares(df):
+    """Returns (shares, concentration)
+    
+    shares has one row per (periodo, mercado, metrica, entidad) with the share,
+    the rank (1 = largest) and the cumulative share of the entities down to that
+    rank. All quarters are ranked with a single sort, and the cumulative sums
+    give the Lorenz curve, the top-N shares and the Gini index. concentration
+    has one row per (periodo, mercado, metrica) with n, total, hhi (0-10,000),
+    gini (0-1), the top-N shares and the 'firma' of the quarter's input rows.
+    Negative figures count as zero.
+    """
+    share_columns = ['periodo', 'mercado', 'metrica', 'entidad', 'valor', 'cuota', 'rango', 'cuota_acumulada']
+    concentration_columns = (['periodo', 'mercado', 'metrica', 'n', 'total', 'hhi', 'gini']
+                             + [f'top{n}' for n in TOP_N_SHARES] + ['firma'])
+    if df.empty:
+        return pd.DataFrame(columns=share_columns), pd.DataFrame(columns=concentration_columns)
+    
+    long = df.melt(id_vars=['periodo', 'tipo', 'entidad'], value_vars=list(MARKET_SHARE_METRICS),
+                   var_name='metrica', value_name='valor')
+    long['valor'] = long['valor'].clip(lower=0)
+    stacked = pd.concat([long.assign(mercado=WHOLE_MARKET), long.assign(mercado=long['tipo'])], ignore_index=True)
+    stacked = stacked.sort_values(['periodo', 'mercado', 'metrica', 'valor'], ascending=[True, True, True, False],
+                                  kind='stable', ignore_index=True)
+    
+    keys = ['periodo', 'mercado', 'metrica']
+    grouped = stacked.groupby(keys, sort=False)
+    total = grouped['valor'].transform('sum').to_numpy()
+    stacked['rango'] = grouped.cumcount().to_numpy() + 1
+    stacked['cuota'] = np.divide(stacked['valor'].to_numpy() * 100, total, out=np.zeros(len(stacked)), where=total > 0)
+    stacked['cuota_acumulada'] = stacked.groupby(keys, sort=False)['cuota'].cumsum()
+    
+    # Group sums for HHI, Gini and top-N shares
+    stacked['cuota_sq'] = stacked['cuota'] ** 2
+    stacked['rango_valor'] = stacked['rango'] * stacked['valor']
+    for n in TOP_N_SHARES:
+        stacked[f'top{n}'] = stacked['cuota'].where(stacked['rango'] <= n, 0)
+    concentration = stacked.groupby(keys, sort=False).agg(
+        n=('valor', 'size'),
+        total=('valor', 'sum'),
+        hhi=('cuota_sq', 'sum'),
+        rango_valor=('rango_valor', 'sum'),
+        **{f'top{n}': (f'top{n}', 'sum') for n in TOP_N_SHARES}
+    ).reset_index()
+    
+    # Gini from the ranked values: (n + 1) / n - 2 * sum(rank * value) / (n * total)
+    n, total = concentration['n'], concentration['total']
+    concentration['gini'] = ((n + 1) / n - 2 * concentration['rango_valor'] / (n * total)).where(total > 0)
+    concentration['hhi'] = concentration['hhi'].where(total > 0)
+    concentration['firma'] = concentration['periodo'].map(market_share_signatures(df))
+    return stacked[share_columns], concentration[concentration_columns]
+
+# Function to refresh only the quarters whose input rows changed
+def update_market_shares(shares, concentration, df):
+    """Recompute shares and concentration only for quarters that are new or whose rows changed"""
+    if shares is None or concentration is None or concentration.empty or 'firma' not in concentration.columns:
+        return compute_market_shares(df)
+    
+    current = market_share_signatures(df)
+    stored = concentration.groupby('periodo')['firma'].first()
+    stale = current.index[current.ne(stored.reindex(current.index))]
+    
+    # Drop quarters that changed or no longer exist, then append the recomputed ones
+    keep_shares = shares[shares['periodo'].isin(current.index) & ~shares['periodo'].isin(stale)]
+    keep_concentration = concentration[concentration['periodo'].isin(current.index) &
+                                       ~concentration['periodo'].isin(stale)]
+    refreshed_shares, refreshed_concentration = compute_market_shares(df[df['periodo'].isin(stale)])
+    keys = ['periodo', 'mercado', 'metrica']
+    shares = pd.concat([keep_shares, refreshed_shares], ignore_index=True)
+    concentration = pd.concat([keep_concentration, refreshed_concentration], ignore_index=True)
+    return (shares.sort_values(keys + ['rango'], ignore_index=True),
+            concentration.sort_values(keys, ignore_index=True))
+
+# Function to load the materialized market share tables
+@st.cache_data
+def load_market_shares(growth_policy=GROWTH_POLICY, imputation=IMPUTATION_METHOD, pinned_version=None):
+    """Market shares kept in the store and refreshed incrementally on each new dataset"""
+    combined = build_dataset(growth_policy, imputation, pinned_version)
+    if pinned_version is not None:
+        shares, concentration = compute_market_shares(combined)
+    else:
+        stored_shares, stored_concentration = read_store_table('market_shares'), read_store_table('concentration')
+        shares, concentration = update_market_shares(stored_shares, stored_concentration, combined)
+        if stored_concentration is None or not concentration.equals(stored_concentration):
+            write_store_table(shares, 'market_shares')
+            write_store_table(concentration, 'concentration')
+    version = pinned_version or load_data(growth_policy, imputation)[1]
+    save_snapshot_table(version, 'market_shares', shares)
+    save_snapshot_table(version, 'concentration', concentration)
+    return shares, concentration
+
+# Peer groups available for the distribution bands in tabs 1-3
+PEER_BAND_GROUPS = {
+    'ninguna': 'Sin bandas',
+    'tipo': 'Mismo tipo',
+    'tamaño': 'Mismo tipo y tamaño'
+}
+
+# Size classes (terciles of median assets within each tipo)
+SIZE_CLASSES = ['Pequeña', 'Mediana', 'Grande']
+
+# Percentiles of each band
+PEER_BAND_QUANTILES = {'p10': 0.1, 'p50': 0.5, 'p90': 0.9}
+
+# Metrics charted in tabs 1-3, plus their rolling version for the TTM view
+PEER_BAND_METRICS = ['comisiones_percibidas', 'resultados_antes_impuestos', 'fondos_propios',
+                     'activos_totales', 'ROA', 'ROE', 'ratio_eficiencia', 'margen_neto',
+                     'apalancamiento', 'var_ingresos', 'var_activos']
+
+# Function to classify every entity by size within its tipo
+def entity_size_classes(df):
+    """Size class per entity from the tercile of its median total assets within its tipo"""
+    size = df.groupby(['entidad', 'tipo'])['activos_totales'].median().reset_index()
+    rank = size.groupby('tipo')['activos_totales'].rank(pct=True, method='first')
+    size['clase'] = pd.cut(rank, bins=[0, 1 / 3, 2 / 3, 1], labels=SIZE_CLASSES).astype(str)
+    return size.set_index('entidad')['clase']
+
+# Function to name the peer group of an entity
+def peer_group_name(tipo, size_class=None):
+    """Works on scalars and on aligned Series"""
+    return tipo if size_class is None else tipo + ' · ' + size_class
+
+# Function to compute the percentile bands of every metric per peer group and quarter
+def compute_peer_bands(metrics):
+    """Long table (grupo, periodo, metrica, p10, p50, p90, n) for the tipo and tipo+size groups
+    
+    metrics is the output of compute_quarterly_metrics for every entity. Quantiles
+    are computed in one grouped call over both kinds of group.
+    """
+    columns = PEER_BAND_METRICS + [TTM_VIEW_COLUMNS[col] for col in PEER_BAND_METRICS
+                                   if TTM_VIEW_COLUMNS.get(col) in metrics.columns]
+    sizes = metrics['entidad'].map(entity_size_classes(metrics))
+    stacked = pd.concat([
+        metrics[['periodo'] + columns].assign(grupo=metrics['tipo']),
+        metrics[['periodo'] + columns].assign(grupo=peer_group_name(metrics['tipo'], sizes))
+    ], ignore_index=True)
+    
+    grouped = stacked.groupby(['grupo', 'periodo'])[columns]
+    quantiles = grouped.quantile(list(PEER_BAND_QUANTILES.values()))
+    quantiles.index = quantiles.index.set_levels(list(PEER_BAND_QUANTILES), level=2)
+    bands = quantiles.rename_axis(columns='metrica').stack().unstack(level=2).reset_index()
+    counts = grouped.count().rename_axis(columns='metrica').stack().rename('n').reset_index()
+    bands = bands.merge(counts, on=['grupo', 'periodo', 'metrica'], how='left')
+    return bands[['grupo', 'periodo', 'metrica'] + list(PEER_BAND_QUANTILES) + ['n']]
+
+# Function to load the peer band table of the current dataset
+@st.cache_data
+def load_peer_bands(growth_policy=GROWTH_POLICY, imputation=IMPUTATION_METHOD, pinned_version=None):
+    """Percentile bands computed once per dataset and kept with its snapshot"""
+    combined = build_dataset(growth_policy, imputation, pinned_version)
+    bands = compute_peer_bands(compute_quarterly_metrics(combined, growth_policy))
+    save_snapshot_table(pinned_version or load_data(growth_policy, imputation)[1], 'peer_bands', bands)
+    return bands
+
+# Function to add the p10-p90 ribbon and the median of a metric's peer group to a subplot
+def add_peer_band(fig, bands, group, metric, periods, row, col, view='Trimestral',
+                  color='rgba(160, 174, 192, 0.15)', secondary_y=None, render_mode='auto'):
+    """Look up the precomputed band and draw it under the entity's traces (no-op without bands)
+    
+    The three lines follow the rendering mode like the entity's own; when they are
+    downsampled they keep the same quarters (those of the median), so the ribbon
+    between p10 and p90 stays aligned.
+    """
+    if bands is None or group is None:
+        return
+    if view == 'TTM':
+        metric = TTM_VIEW_COLUMNS.get(metric, metric)
+    band = bands[(bands['grupo'] == group) & (bands['metrica'] == metric)]
+    band = band.set_index('periodo').reindex(list(periods))
+    if band['p50'].isna().all():
+        return
+    
+    x = list(periods)
+    if use_light_rendering(len(x), render_mode) and len(x) > MAX_LINE_POINTS:
+        keep = lttb_indices(band['p50'], MAX_LINE_POINTS)
+        band, x = band.iloc[keep], [x[i] for i in keep]
+    hover = f'{group}<br>p10–p90: %{{customdata[0]:,.1f}} – %{{customdata[1]:,.1f}}<extra></extra>'
+    customdata = band[['p10', 'p90']].to_numpy()
+    traces = [
+        line_trace(x, band['p90'], render_mode, mode='lines', line=dict(width=0), hoverinfo='skip',
+                   showlegend=False),
+        line_trace(x, band['p10'], render_mode, mode='lines', line=dict(width=0), fill='tonexty',
+                   fillcolor=color, customdata=customdata, hovertemplate=hover,
+                   name='Pares p10–p90', legendgroup='peer_band', showlegend=False),
+        line_trace(x, band['p50'], render_mode, mode='lines', line=dict(color='#a0aec0', width=1, dash='dot'),
+                   name='Mediana pares', legendgroup='peer_band', showlegend=False)
+    ]
+    for trace in traces:
+        if secondary_y is None:
+            fig.add_trace(trace, row=row, col=col)
+        else:
+            fig.add_trace(trace, row=row, col=col, secondary_y=secondary_y)
+
+# Quarterly metrics whose trajectories define an entity's profile for clustering
+CLUSTER_METRICS = ['var_ingresos', 'ROE', 'ratio_eficiencia', 'apalancamiento']
+
+# Minimum quarters of history to cluster an entity or correlate two series
+MIN_PROFILE_QUARTERS = 4
+
+# Maximum number of entities drawn in the correlation heatmap (largest by revenue)
+CORRELATION_MAX_ENTITIES = 60
+
+# Function to pivot a metric into an entity x quarter matrix
+def entity_quarter_matrix(metrics, column):
+    return metrics.pivot(index='entidad', columns='periodo', values=column).sort_index(axis=1)
+
+# Function to build the clustering features of every entity with enough history
+def profile_features(metrics):
+    """Entity index and (entities x metrics*quarters) matrix of scaled trajectories
+    
+    Each metric is winsorized at its 5th/95th percentile and scaled by that
+    range, so ratios with extreme values do not dominate the distances. Missing
+    quarters take the entity's own mean.
+    """
+    counts = metrics.groupby('entidad').size()
+    data = metrics[metrics['entidad'].isin(counts.index[counts >= MIN_PROFILE_QUARTERS])]
+    
+    blocks = []
+    for col in CLUSTER_METRICS:
+        matrix = entity_quarter_matrix(data, col)
+        entities = matrix.index
+        values = matrix.to_numpy(dtype=float)
+        low, high = np.nanpercentile(values, [5, 95])
+        values = (np.clip(values, low, high) - np.nanmedian(values)) / ((high - low) or 1.0)
+        row_mean = np.nanmean(values, axis=1, keepdims=True)
+        blocks.append(np.nan_to_num(np.where(np.isnan(values), row_mean, values)))
+    return entities, np.hstack(blocks)
+
+# Function to run k-means (Lloyd's algorithm with k-means++ seeding) in NumPy
+def kmeans(X, k, n_init=4, max_iter=100, seed=0):
+    """Labels, centers and inertia of the best of n_init runs
+    
+    Distances use ||x||^2 - 2x.c + ||c||^2 and centers are updated with a one-hot
+    matrix product, so each iteration is two matrix multiplications. Labels are
+    numbered by cluster size, largest first.
+    """
+    n = len(X)
+    k = max(1, min(k, n))
+    rng = np.random.default_rng(seed)
+    sq_norms = (X ** 2).sum(axis=1)
+    best = None
+    
+    for _ in range(n_init):
+        # k-means++ seeding
+        centers = [X[rng.integers(n)]]
+        closest = ((X - centers[0]) ** 2).sum(axis=1)
+        for _ in range(1, k):
+            total = closest.sum()
+            idx = rng.choice(n, p=closest / total) if total > 0 else rng.integers(n)
+            centers.append(X[idx])
+            closest = np.minimum(closest, ((X - X[idx]) ** 2).sum(axis=1))
+        centers = np.vstack(centers)
+        
+        labels = None
+        for _ in range(max_iter):
+            distances = sq_norms[:, np.newaxis] - 2 * X @ centers.T + (centers ** 2).sum(axis=1)
+            new_labels = distances.argmin(axis=1)
+            if labels is not None and np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+            onehot = np.eye(k)[labels]
+            sizes = onehot.sum(axis=0)
+            centers = np.where(sizes[:, np.newaxis] > 0, onehot.T @ X / np.maximum(sizes, 1)[:, np.newaxis], centers)
+        
+        inertia = np.maximum(distances[np.arange(n), labels], 0).sum()
+        if best is None or inertia < best[2]:
+            best = (labels, centers, inertia)
+    
+    labels, centers, inertia = best
+    order = np.argsort(-np.bincount(labels, minlength=k), kind='stable')
+    rank = np.empty(k, dtype=int)
+    rank[order] = np.arange(k)
+    return rank[labels], centers[order], inertia
+
+# Function to correlate the rows of two matrices over the columns both rows have
+def pairwise_correlation(a, b=None, min_periods=MIN_PROFILE_QUARTERS):
+    """Pearson correlation of every row of a with every row of b (NaN = missing)
+    
+    Pairwise-complete like DataFrame.corr, but computed with six matrix
+    products, so it scales to thousands of series. Pairs sharing fewer than
+    min_periods columns are NaN.
+    """
+    b = a if b is None else b
+    a = a - np.nanmean(a, axis=1, keepdims=True)
+    b = b - np.nanmean(b, axis=1, keepdims=True)
+    mask_a, mask_b = (~np.isnan(a)).astype(float), (~np.isnan(b)).astype(float)
+    xa, xb = np.nan_to_num(a), np.nan_to_num(b)
     
-    # Merge duplicate entities (this handles variations like ACTIVOTRADE VALOR... and ACTIVOTRADE VALORES...)
-    sociedades = merge_duplicate_entities(sociedades)
-    agencias = merge_duplicate_entities(agencias)
+    n = mask_a @ mask_b.T
+    sum_a, sum_b = xa @ mask_b.T, mask_a @ xb.T
+    sq_a, sq_b = n * ((xa ** 2) @ mask_b.T), n * (mask_a @ (xb ** 2).T)
+    var_a, var_b = sq_a - sum_a ** 2, sq_b - sum_b ** 2
     
-    # Remove any remaining NaN or infinite values in key columns
-    key_cols = ['comisiones_percibidas', 'activos_totales', 'fondos_propios', 
-                'gastos_explotacion', 'resultados_antes_impuestos', 'margen_bruto', 'comisiones_netas']
+    # Constant series over the overlap (up to rounding) have no correlation
+    constant = (var_a <= 1e-12 * sq_a) | (var_b <= 1e-12 * sq_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = n * (xa @ xb.T) - sum_a * sum_b
+        corr = np.clip(cov / np.sqrt(var_a * var_b), -1, 1)
+    corr[(n < min_periods) | constant] = np.nan
+    return corr
+
+# Function to cluster every entity by its metric trajectories
+def cluster_entity_profiles(metrics, n_clusters):
+    """Per-entity cluster and 2-D projection, plus a per-cluster summary of the metrics"""
+    entities, X = profile_features(metrics)
+    if len(entities) == 0:
+        return pd.DataFrame(columns=['entidad', 'tipo', 'cluster', 'pc1', 'pc2']), pd.DataFrame()
+    labels, _, _ = kmeans(X, n_clusters)
     
-    for col in key_cols:
-        if col in sociedades.columns:
-            sociedades[col] = sociedades[col].fillna(0)
-            sociedades = sociedades[~sociedades[col].isin([float('inf'), float('-inf')])]
-        if col in agencias.columns:
-            agencias[col] = agencias[col].fillna(0)
-            agencias = agencias[~agencias[col].isin([float('inf'), float('-inf')])]
+    # Projection on the first two principal components for the scatter plot
+    centered = X - X.mean(axis=0)
+    u, singular, _ = np.linalg.svd(centered, full_matrices=False)
+    coords = u[:, :2] * singular[:2]
+    if coords.shape[1] < 2:
+        coords = np.hstack([coords, np.zeros((len(coords), 2 - coords.shape[1]))])
     
-    # Add type column
-    sociedades['tipo'] = 'Sociedad'
-    agencias['tipo'] = 'Agencia'
+    tipos = metrics.groupby('entidad')['tipo'].first()
+    profiles = pd.DataFrame({
+        'entidad': entities,
+        'tipo': tipos.reindex(entities).to_numpy(),
+        'cluster': labels + 1,
+        'pc1': coords[:, 0],
+        'pc2': coords[:, 1]
+    })
     
-    # Ensure fecha is datetime
-    sociedades['fecha'] = pd.to_datetime(sociedades['fecha'])
-    agencias['fecha'] = pd.to_datetime(agencias['fecha'])
+    clustered = metrics.merge(profiles[['entidad', 'cluster']], on='entidad')
+    summary = clustered.groupby('cluster').agg(
+        entidades=('entidad', 'nunique'),
+        **{f'{col}_mediana': (col, 'median') for col in CLUSTER_METRICS}
+    )
+    summary['tipo_principal'] = profiles.groupby('cluster')['tipo'].agg(lambda t: t.value_counts().idxmax())
+    summary['pct_tipo_principal'] = profiles.groupby('cluster')['tipo'].agg(lambda t: t.value_counts(normalize=True).max() * 100)
+    return profiles, summary.reset_index()
+
+# Function to load the clustering and the revenue matrix of the current dataset
+@st.cache_data
+def load_entity_profiles(version, n_clusters, growth_policy=GROWTH_POLICY, imputation=IMPUTATION_METHOD,
+                         pinned_version=None):
+    """Clusters and revenue series cached per dataset version and number of clusters"""
+    combined = build_dataset(growth_policy, imputation, pinned_version)
+    metrics = compute_quarterly_metrics(combined, growth_policy)
+    profiles, summary = cluster_entity_profiles(metrics, n_clusters)
+    revenue = entity_quarter_matrix(metrics, 'comisiones_percibidas')
+    return profiles, summary, revenue
+
+# Metrics forecast for every entity: column -> label
+FORECAST_METRICS = {
+    'comisiones_percibidas': 'Comisiones',
+    'resultados_antes_impuestos': 'Resultado'
+}
+
+# Forecasting models
+FORECAST_MODELS = {
+    'naive_estacional': 'Naive estacional',
+    'suavizado': 'Suavizado exponencial (Holt-Winters amortiguado)'
+}
+
+# Quarters forecast ahead
+FORECAST_HORIZON = 4
+
+# Quarters per seasonal cycle
+SEASON_LENGTH = 4
+
+# Quarters of history each model needs
+FORECAST_MIN_QUARTERS = {'naive_estacional': SEASON_LENGTH, 'suavizado': 2 * SEASON_LENGTH}
+
+# Smoothing parameters (level, trend, season) tried for every entity
+SMOOTHING_GRID = [(alpha, beta, gamma) for alpha in (0.2, 0.4, 0.6, 0.8)
+                  for beta in (0.0, 0.1, 0.2) for gamma in (0.1, 0.3)]
+
+# Trend damping: each quarter ahead adds this fraction of the previous quarter's trend
+# (an undamped trend overshoots on these short, noisy series)
+TREND_DAMPING = 0.7
+
+# Function to lay out every entity's quarterly series from its first quarter
+def aligned_series(df, column):
+    """(entities, values, last, last_quarter) for the entities in df
     
-    # Combine datasets
-    combined = pd.concat([sociedades, agencias], ignore_index=True)
+    values[i, t] is the value t quarters after the entity's first quarter (NaN
+    where it did not report), last[i] the position of its last quarter and
+    last_quarter[i] that quarter as year * 4 + quarter - 1.
+    """
+    quarter = (df['fecha'].dt.year * 4 + (df['fecha'].dt.month - 1) // 3).to_numpy()
+    codes, entities = pd.factorize(df['entidad'], sort=True)
+    first = np.full(len(entities), np.iinfo(np.int64).max)
+    np.minimum.at(first, codes, quarter)
+    last_quarter = np.zeros(len(entities), dtype=np.int64)
+    np.maximum.at(last_quarter, codes, quarter)
     
-    # Final check: remove any entity that appears with inconsistent type
-    entity_types = combined.groupby('entidad')['tipo'].nunique()
-    consistent_entities = entity_types[entity_types == 1].index
-    combined = combined[combined['entidad'].isin(consistent_entities)]
+    position = quarter - first[codes]
+    values = np.full((len(entities), position.max() + 1 if len(position) else 0), np.nan)
+    values[codes, position] = df[column].to_numpy(dtype=float)
+    return entities, values, last_quarter - first, last_quarter
+
+# Function to forecast every series with the seasonal naive model
+def seasonal_naive_forecast(values, last, horizon=FORECAST_HORIZON):
+    """Each quarter repeats the same quarter of the last year (a missing one takes the
+    previous reported value). Returns (entities, horizon), NaN without a full year."""
+    filled = pd.DataFrame(values).ffill(axis=1).to_numpy()
+    steps = np.arange(1, horizon + 1)
+    source = last[:, None] + steps - SEASON_LENGTH * np.ceil(steps / SEASON_LENGTH).astype(int)
+    forecast = filled[np.arange(len(values))[:, None], np.maximum(source, 0)]
+    forecast[last + 1 < FORECAST_MIN_QUARTERS['naive_estacional']] = np.nan
+    return forecast
+
+# Function to forecast every series with additive Holt-Winters smoothing
+def holt_winters_forecast(values, last, horizon=FORECAST_HORIZON, grid=SMOOTHING_GRID, damping=TREND_DAMPING):
+    """Fit every entity and every parameter set of the grid at once, with a damped trend
     
-    # Final duplicate check after combination
-    combined = consolidate_duplicates(combined)
+    The recursion walks the quarters with (parameters, entities) state arrays.
+    A missing quarter takes its one-step prediction, and the state stops at each
+    entity's last quarter. Each entity keeps the parameters with the lowest
+    one-step squared error. Returns (entities, horizon), NaN without two years.
+    """
+    n, m = len(values), SEASON_LENGTH
+    params = np.asarray(grid, dtype=float)
+    alpha, beta, gamma = params[:, [0]], params[:, [1]], params[:, [2]]
     
-    return sociedades, agencias, combined
-
-# Calculate quarterly metrics (same as original)
-def calculate_quarterly_metrics(df, entity):
-    entity_data = df[df['entidad'] == entity].sort_values('fecha')
+    # Initial state from the first two years
+    first_year = values[:, :m]
+    second_year = values[:, m:2 * m]
+    first_count = np.maximum((~np.isnan(first_year)).sum(axis=1), 1)
+    second_count = (~np.isnan(second_year)).sum(axis=1)
+    level = np.nansum(first_year, axis=1) / first_count
+    second_level = np.nansum(second_year, axis=1) / np.maximum(second_count, 1)
+    trend = np.where(second_count > 0, (second_level - level) / m, 0)
+    season = np.nan_to_num(first_year - level[:, None])
     
-    if len(entity_data) < 1:
-        return None
+    level = np.tile(level, (len(params), 1))
+    trend = np.tile(trend, (len(params), 1))
+    season = np.tile(season, (len(params), 1, 1))
+    sse = np.zeros((len(params), n))
     
-    metrics = []
-    for i in range(len(entity_data)):
-        row = entity_data.iloc[i]
-        metrics_dict = {
-            'periodo': row['periodo'],
-            'fecha': row['fecha'],
-            'tipo': row['tipo'],
-            'fondos_propios': row['fondos_propios'],
-            'activos_totales': row['activos_totales'],
-            'comisiones_percibidas': row['comisiones_percibidas'],
-            'comisiones_netas': row['comisiones_netas'],
-            'margen_bruto': row['margen_bruto'],
-            'gastos_explotacion': row['gastos_explotacion'],
-            'resultados_antes_impuestos': row['resultados_antes_impuestos'],
-            'ROA': (row['resultados_antes_impuestos'] / row['activos_totales'] * 100) if row['activos_totales'] > 0 else 0,
-            'ROE': (row['resultados_antes_impuestos'] / row['fondos_propios'] * 100) if row['fondos_propios'] > 0 else 0,
-            'ratio_eficiencia': (row['gastos_explotacion'] / row['margen_bruto'] * 100) if row['margen_bruto'] > 0 else 0,
-            'margen_neto': (row['resultados_antes_impuestos'] / row['comisiones_percibidas'] * 100) if row['comisiones_percibidas'] > 0 else 0,
-            'apalancamiento': (row['activos_totales'] / row['fondos_propios']) if row['fondos_propios'] > 0 else 0
-        }
+    for t in range(m, values.shape[1]):
+        y = values[:, t]
+        active = t <= last
+        observed = active & ~np.isnan(y)
+        slot = season[:, :, t % m]
+        prediction = level + damping * trend + slot
+        actual = np.where(observed, y, prediction)
+        sse += np.where(observed, actual - prediction, 0) ** 2
         
-        # Calculate quarter-to-quarter changes
-        if i > 0:
-            prev_row = entity_data.iloc[i-1]
-            metrics_dict['var_activos'] = ((row['activos_totales'] - prev_row['activos_totales']) / prev_row['activos_totales'] * 100) if prev_row['activos_totales'] > 0 else 0
-            metrics_dict['var_ingresos'] = ((row['comisiones_percibidas'] - prev_row['comisiones_percibidas']) / prev_row['comisiones_percibidas'] * 100) if prev_row['comisiones_percibidas'] > 0 else 0
-            metrics_dict['var_beneficio'] = ((row['resultados_antes_impuestos'] - prev_row['resultados_antes_impuestos']) / abs(prev_row['resultados_antes_impuestos']) * 100) if prev_row['resultados_antes_impuestos'] != 0 else 0
-        else:
-            metrics_dict['var_activos'] = 0
-            metrics_dict['var_ingresos'] = 0
-            metrics_dict['var_beneficio'] = 0
-        
-        metrics.append(metrics_dict)
+        new_level = alpha * (actual - slot) + (1 - alpha) * (level + damping * trend)
+        trend = np.where(active, beta * (new_level - level) + (1 - beta) * damping * trend, trend)
+        season[:, :, t % m] = np.where(active, gamma * (actual - new_level) + (1 - gamma) * slot, slot)
+        level = np.where(active, new_level, level)
+    
+    best = sse.argmin(axis=0)
+    rows = np.arange(n)
+    steps = np.arange(1, horizon + 1)
+    damped_steps = np.cumsum(damping ** steps)
+    forecast = (level[best, rows][:, None] + trend[best, rows][:, None] * damped_steps
+                + season[best[:, None], rows[:, None], (last[:, None] + steps) % m])
+    forecast[last + 1 < FORECAST_MIN_QUARTERS['suavizado']] = np.nan
+    return forecast
+
+# Forecast functions per model
+FORECASTERS = {
+    'naive_estacional': seasonal_naive_forecast,
+    'suavizado': holt_winters_forecast
+}
+
+# Function to forecast the next quarters of every entity with every model
+def compute_forecasts(df, horizon=FORECAST_HORIZON):
+    """Long table (entidad, metrica, modelo, h, periodo, prevision)
+    
+    periodo is the quarter h steps after the entity's last reported quarter.
+    Entities without enough history for a model are left out of it.
+    """
+    steps = np.arange(1, horizon + 1)
+    parts = []
+    for metric in FORECAST_METRICS:
+        entities, values, last, last_quarter = aligned_series(df, metric)
+        target = (last_quarter[:, None] + steps).ravel()
+        periods = pd.Series(target // 4).astype(str) + ' Q' + pd.Series(target % 4 + 1).astype(str)
+        for model, forecaster in FORECASTERS.items():
+            parts.append(pd.DataFrame({
+                'entidad': np.repeat(entities, horizon),
+                'metrica': metric,
+                'modelo': model,
+                'h': np.tile(steps, len(entities)),
+                'periodo': periods.to_numpy(),
+                'prevision': forecaster(values, last, horizon).ravel()
+            }))
+    forecasts = pd.concat(parts, ignore_index=True)
+    return forecasts[forecasts['prevision'].notna()].reset_index(drop=True)
+
+# Function to load the forecasts of the current dataset
+@st.cache_data
+def load_forecasts(version, growth_policy=GROWTH_POLICY, imputation=IMPUTATION_METHOD, pinned_version=None):
+    """Forecasts cached per dataset version"""
+    return compute_forecasts(build_dataset(growth_policy, imputation, pinned_version))
+
+# Function to draw a forecast as a dashed continuation of a series
+def add_forecast_trace(fig, periods, values, forecast, name, color, row, col, render_mode='auto'):
+    """forecast is indexed by periodo; the line starts at the last actual point"""
+    fig.add_trace(
+        line_trace(x=[periods.iloc[-1]] + list(forecast.index), y=[values.iloc[-1]] + list(forecast.to_numpy()),
+                   name=name, mode='lines+markers', line=dict(color=color, width=2, dash='dash'),
+                   marker=dict(size=6, symbol='circle-open'), render_mode=render_mode),
+        row=row, col=col
+    )
+
+# Metrics drawn as sparklines in the registry overview: column -> label
+SPARKLINE_METRICS = {
+    'comisiones_percibidas': 'Comisiones',
+    'resultados_antes_impuestos': 'Resultado',
+    'ROE': 'ROE'
+}
+
+# Function to build the sparkline grid of every entity
+def build_sparkline_grid(metrics):
+    """One row per entity with its latest value and quarterly series of each sparkline metric
     
-    return pd.DataFrame(metrics)
+    Series are lists over the quarters of the whole registry, with NaN where the
+    entity did not report, so every sparkline shares the same period axis. The
+    registry is a single frame that the table draws and sorts in the browser.
+    """
+    data = metrics.sort_values(['entidad', 'fecha'])
+    grouped = data.groupby('entidad', sort=True)
+    grid = grouped[['tipo', 'periodo']].last().rename(columns={'periodo': 'ultimo_periodo'})
+    grid['trimestres'] = grouped.size()
+    for col in SPARKLINE_METRICS:
+        grid[col] = grouped[col].last()
+        series = entity_quarter_matrix(data, col).reindex(grid.index).round(2)
+        grid[f'serie_{col}'] = series.to_numpy().tolist()
+    return grid.reset_index()
+
+# Function to load the sparkline grid of the current dataset
+@st.cache_data
+def load_sparkline_grid(version, growth_policy=GROWTH_POLICY, imputation=IMPUTATION_METHOD, pinned_version=None):
+    """Grid cached per dataset version"""
+    combined = build_dataset(growth_policy, imputation, pinned_version)
+    return build_sparkline_grid(compute_quarterly_metrics(combined, growth_policy))
 
 # Professional dark theme for plotly
 professional_theme = {
@@ -606,26 +2960,162 @@ professional_theme = {
     }
 }
 
+# Rendering modes for the charts (key -> label)
+RENDER_MODES = {
+    'auto': 'Automático',
+    'estandar': 'Estándar (SVG)',
+    'ligero': 'Ligero (WebGL)'
+}
+
+# Number of points in a series above which 'auto' switches to the lightweight mode
+LARGE_SERIES_THRESHOLD = 400
+
+# Maximum points drawn per line series in the lightweight mode
+MAX_LINE_POINTS = 600
+
+# Function to select representative points of a series (Largest-Triangle-Three-Buckets)
+def lttb_indices(y, n_out):
+    """Indices of the n_out points kept by LTTB downsampling, always keeping first and last
+    
+    Points are assumed evenly spaced (quarters), so the x coordinate is the position.
+    """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    
+    x = np.arange(n, dtype=float)
+    y_filled = np.where(np.isnan(y), np.nanmean(y) if np.isfinite(y).any() else 0, y)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    
+    selected = np.empty(n_out, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    anchor = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start = edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y_filled[next_start:next_end].mean()
+        # Area of the triangle (anchor, candidate, average of the next bucket)
+        area = np.abs((x[anchor] - avg_x) * (y_filled[start:end] - y_filled[anchor]) -
+                      (x[anchor] - x[start:end]) * (avg_y - y_filled[anchor]))
+        anchor = start + int(np.argmax(area))
+        selected[i + 1] = anchor
+    return selected
+
+# Function to decide whether a series uses the lightweight rendering
+def use_light_rendering(n_points, render_mode):
+    if render_mode == 'ligero':
+        return True
+    if render_mode == 'estandar':
+        return False
+    return n_points > LARGE_SERIES_THRESHOLD
+
+# Function to build a line/scatter trace honoring the rendering mode
+def line_trace(x, y, render_mode='auto', **kwargs):
+    """go.Scatter for small series; downsampled go.Scattergl with compact arrays for large ones"""
+    if not use_light_rendering(len(y), render_mode):
+        return go.Scatter(x=x, y=y, **kwargs)
+    
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    if 'lines' in kwargs.get('mode', 'lines') and len(y) > MAX_LINE_POINTS:
+        keep = lttb_indices(y, MAX_LINE_POINTS)
+        x, y = x[keep], y[keep]
+    
+    # Per-point labels and markers are dropped; float32 arrays are sent as base64 typed arrays
+    kwargs.pop('text', None)
+    kwargs.pop('textposition', None)
+    if 'mode' in kwargs:
+        kwargs['mode'] = kwargs['mode'].replace('+markers', '').replace('+text', '')
+    kwargs.pop('marker', None)
+    return go.Scattergl(x=x, y=y.astype(np.float32), **kwargs)
+
+# Function to build a bar trace honoring the rendering mode
+def bar_trace(x, y, render_mode='auto', **kwargs):
+    """go.Bar that drops per-point text and uses compact arrays for large series"""
+    if not use_light_rendering(len(y), render_mode):
+        return go.Bar(x=x, y=y, **kwargs)
+    
+    kwargs.pop('text', None)
+    kwargs.pop('textposition', None)
+    return go.Bar(x=np.asarray(x), y=np.asarray(y, dtype=np.float32), **kwargs)
+
+# Maximum number of companies overlaid on the charts of tabs 1-3
+OVERLAY_MAX_ENTITIES = 5
+
+# Line colors of the overlaid companies
+OVERLAY_COLORS = ['#fbd38d', '#9ae6b4', '#feb2b2', '#90cdf4', '#d6bcfa']
+
+# Function to overlay the history of other companies on a subplot
+def add_overlay_traces(fig, overlay_metrics, metric, row, col, render_mode='auto',
+                       secondary_y=None, skip_first=False):
+    """One thin line per company on the subplot's own axes
+    
+    Traces of the same company share a legend group, so a single legend entry
+    toggles it in every subplot. skip_first drops each company's first quarter
+    (variations are 0 there).
+    """
+    if overlay_metrics is None or overlay_metrics.empty:
+        return
+    data = overlay_metrics
+    if skip_first:
+        data = data[data.groupby('entidad', sort=False).cumcount() > 0]
+    
+    in_legend = {trace.legendgroup for trace in fig.data if trace.showlegend is not False}
+    for i, (entity, entity_data) in enumerate(data.groupby('entidad', sort=False)):
+        trace = line_trace(x=entity_data['periodo'], y=entity_data[metric], render_mode=render_mode,
+                           name=entity[:25], legendgroup=entity, showlegend=entity not in in_legend,
+                           mode='lines', line=dict(color=OVERLAY_COLORS[i % len(OVERLAY_COLORS)], width=1.5))
+        in_legend.add(entity)
+        if secondary_y is None:
+            fig.add_trace(trace, row=row, col=col)
+        else:
+            fig.add_trace(trace, row=row, col=col, secondary_y=secondary_y)
+    
+    # Quarters of the overlaid companies may be missing for the selected one
+    fig.update_xaxes(categoryorder='category ascending', row=row, col=col)
+
 # Main application
 def main():
+    configure_page()
+    
     # Header
     st.markdown('<h1 class="main-header">Panel de Análisis Financiero</h1>', unsafe_allow_html=True)
-    st.markdown('<p class="sub-header">Sociedades de Valores y Agencias de Valores - Análisis Trimestral</p>', unsafe_allow_html=True)
+    labels = [source['label'] for source in ENTITY_SOURCES.values()]
+    subtitle = ', '.join(labels[:-1]) + ' y ' + labels[-1] if len(labels) > 1 else ''.join(labels)
+    st.markdown(f'<p class="sub-header">{subtitle} - Análisis Trimestral</p>', unsafe_allow_html=True)
     st.markdown('<p style="text-align: center; color: #4a5568; font-size: 12px; margin-bottom: 30px;">Desarrollado por @Gsnchez | bquantfinance.com</p>', unsafe_allow_html=True)
     
+    # Growth policy chosen in the sidebar (read from session state so the data loads with it)
+    growth_policy = st.session_state.get('growth_policy', GROWTH_POLICY)
+    imputation = st.session_state.get('imputation', IMPUTATION_METHOD)
+    pinned_version = st.session_state.get('pinned_version')
+    
     # Load data
     with st.spinner('Cargando datos financieros...'):
         try:
-            sociedades, agencias, combined = load_data()
+            # The version is hashed once per build (cached with the data), not on every rerun
+            combined, data_version = load_data(growth_policy, imputation)
             
-            # Show loaded data info
-            col1, col2, col3 = st.columns(3)
-            with col1:
+            # Replace the current build by a pinned snapshot (a snapshot's version is its content hash)
+            if pinned_version is not None:
+                pinned = load_snapshot(pinned_version)
+                if pinned is not None:
+                    combined, data_version = pinned, pinned_version
+                else:
+                    st.warning(f"La versión {pinned_version} ya no está disponible; se muestran los datos actuales")
+                    pinned_version = None
+            
+            # Show loaded data info (entities per registered type, in one pass)
+            entity_counts = combined.groupby('tipo')['entidad'].nunique()
+            columns = st.columns(1 + len(ENTITY_SOURCES))
+            with columns[0]:
                 st.metric(label="📊 Total Registros", value=f"{len(combined):,}")
-            with col2:
-                st.metric(label="🏢 Sociedades", value=f"{sociedades['entidad'].nunique()}")
-            with col3:
-                st.metric(label="🏦 Agencias", value=f"{agencias['entidad'].nunique()}")
+            for column, (tipo, source) in zip(columns[1:], ENTITY_SOURCES.items()):
+                with column:
+                    st.metric(label=f"{source['icon']} {source['label']}", value=f"{entity_counts.get(tipo, 0)}")
             
         except Exception as e:
             st.error(f"Error al cargar los datos: {str(e)}")
@@ -642,15 +3132,14 @@ def main():
         if tipo_filter:
             tipo_filtro = st.radio(
                 "Tipo de entidad:",
-                ["Todas", "Sociedades", "Agencias"],
+                ["Todas"] + list(ENTITY_SOURCES),
+                format_func=lambda tipo: source_attribute(tipo, 'label') if tipo != "Todas" else tipo,
                 horizontal=True,
                 label_visibility="visible"
             )
             
-            if tipo_filtro == "Sociedades":
-                filtered_entities = sorted(combined[combined['tipo'] == 'Sociedad']['entidad'].unique())
-            elif tipo_filtro == "Agencias":
-                filtered_entities = sorted(combined[combined['tipo'] == 'Agencia']['entidad'].unique())
+            if tipo_filtro != "Todas":
+                filtered_entities = sorted(combined[combined['tipo'] == tipo_filtro]['entidad'].unique())
             else:
                 filtered_entities = sorted(combined['entidad'].unique())
         else:
@@ -667,15 +3156,69 @@ def main():
         # Get company type and show badge
         if selected_company:
             company_type = combined[combined['entidad'] == selected_company]['tipo'].iloc[0]
-            if company_type == 'Sociedad':
-                st.markdown(f"<span style='background: linear-gradient(135deg, #b794f6 0%, #9f7aea 100%); color: white; padding: 2px 8px; border-radius: 12px; font-size: 11px; font-weight: 600;'>SOCIEDAD DE VALORES</span>", unsafe_allow_html=True)
-            else:
-                st.markdown(f"<span style='background: linear-gradient(135deg, #00d4ff 0%, #0091ff 100%); color: white; padding: 2px 8px; border-radius: 12px; font-size: 11px; font-weight: 600;'>AGENCIA DE VALORES</span>", unsafe_allow_html=True)
+            st.markdown(f"<span style='background: {type_badge_background(company_type)}; color: white; padding: 2px 8px; border-radius: 12px; font-size: 11px; font-weight: 600;'>{source_attribute(company_type, 'title').upper()}</span>", unsafe_allow_html=True)
         else:
             company_type = None
         
         st.markdown("---")
         
+        # Metric view for the charts in tabs 1-3 (rolling columns are precomputed in load_data)
+        metric_view_label = st.radio(
+            "📅 Vista de métricas",
+            ["Trimestral", "TTM (últimos 12 meses)"],
+            horizontal=True,
+            help="TTM suma los últimos 4 trimestres; ROE/ROA usan el patrimonio y activos medios de 4 trimestres"
+        )
+        metric_view = 'TTM' if metric_view_label.startswith('TTM') else 'Trimestral'
+        
+        # Growth-rate policy shared by every tab and export
+        st.selectbox(
+            "📐 Cálculo de variaciones",
+            list(GROWTH_POLICIES),
+            format_func=GROWTH_POLICIES.get,
+            key='growth_policy',
+            help="Cómo se calculan las variaciones cuando el valor anterior es negativo o cambia de signo"
+        )
+        
+        # Imputation of quarters whose earlier YTD filings are missing
+        st.selectbox(
+            "🧩 Trimestres sin datos previos",
+            list(IMPUTATION_METHODS),
+            format_func=IMPUTATION_METHODS.get,
+            key='imputation',
+            help="Cómo se reparte el acumulado del año cuando faltan declaraciones anteriores; los trimestres estimados se marcan en los gráficos"
+        )
+        
+        # Pin the dashboard to a stored snapshot of the data
+        snapshots = list_snapshots()
+        snapshot_labels = {row['version']: f"{row['version']} · {row['creado']:%d/%m/%Y %H:%M} · {row['ultimo_periodo']}"
+                           for _, row in snapshots.iterrows()}
+        st.selectbox(
+            "📌 Versión de datos",
+            [None] + list(snapshot_labels),
+            format_func=lambda version: "Actual" if version is None else snapshot_labels.get(version, version),
+            key='pinned_version',
+            help="Fija el panel a una versión anterior de los datos procesados"
+        )
+        
+        # Chart rendering mode (WebGL and downsampling for long series)
+        render_mode = st.selectbox(
+            "🖥️ Renderizado de gráficos",
+            list(RENDER_MODES),
+            format_func=RENDER_MODES.get,
+            help="Automático usa WebGL, sin etiquetas por punto y con submuestreo cuando las series son largas"
+        )
+        
+        # Peer distribution bands overlaid in tabs 1-3
+        peer_band_mode = st.selectbox(
+            "👥 Bandas de pares (p10–p90)",
+            list(PEER_BAND_GROUPS),
+            format_func=PEER_BAND_GROUPS.get,
+            help="Superpone el rango p10–p90 y la mediana de las entidades del mismo tipo (o del mismo tipo y tamaño) en cada trimestre"
+        )
+        
+        st.markdown("---")
+        
         # MODIFICATION: The "Período de Análisis" section has been completely removed.
         # The analysis will now always use the full available history for the selected company.
         
@@ -693,44 +3236,53 @@ def main():
                 
                 if len(same_type_entities) > 0:
                     # Calculate similar companies by size
-                    company_data_for_size = combined[combined['entidad'] == selected_company]
-                    if not company_data_for_size.empty:
-                        company_size = company_data_for_size['activos_totales'].mean()
-                        
-                        # Get size data for all companies of same type
-                        size_data = []
-                        for entity in same_type_entities:
-                            entity_data = combined[combined['entidad'] == entity]
-                            if not entity_data.empty:
-                                avg_size = entity_data['activos_totales'].mean()
-                                size_data.append({
-                                    'entidad': entity,
-                                    'size': avg_size,
-                                    'diff': abs(avg_size - company_size)
-                                })
+                    top3 = find_similar_entities(combined, selected_company, n=3)
+                    
+                    if top3:
+                        use_auto = st.checkbox("Usar Top 3 similares", value=True)
                         
-                        if size_data:
-                            # Sort by similarity (smallest difference)
-                            size_df = pd.DataFrame(size_data).sort_values('diff')
-                            top3 = size_df.head(3)['entidad'].tolist()
-                            
-                            use_auto = st.checkbox("Usar Top 3 similares", value=True)
-                            
-                            if use_auto:
-                                comparison_companies = top3
-                                st.caption(f"Comparando con: {', '.join([c[:20] + '...' if len(c) > 20 else c for c in comparison_companies])}")
-                            else:
-                                comparison_companies = st.multiselect(
-                                    "Seleccionar manualmente:",
-                                    list(same_type_entities),
-                                    max_selections=5
-                                )
+                        if use_auto:
+                            comparison_companies = top3
+                            st.caption(f"Comparando con: {', '.join([c[:20] + '...' if len(c) > 20 else c for c in comparison_companies])}")
                         else:
-                            st.warning("No hay suficientes datos para comparar")
+                            comparison_companies = st.multiselect(
+                                "Seleccionar manualmente:",
+                                list(same_type_entities),
+                                max_selections=OVERLAY_MAX_ENTITIES
+                            )
+                    else:
+                        st.warning("No hay suficientes datos para comparar")
                 else:
                     st.warning("No hay otras empresas del mismo tipo")
             else:
                 st.info("Selecciona una empresa para activar comparación")
+            
+            # Draw the competitors' full history in tabs 1-3 as well
+            overlay_enabled = st.checkbox(
+                "Superponer en gráficos (pestañas 1–3)",
+                value=False,
+                disabled=not comparison_companies,
+                help=f"Añade la serie trimestral completa de hasta {OVERLAY_MAX_ENTITIES} competidores a los gráficos de evolución"
+            )
+        
+        # Most anomalous figures of the latest quarter (scored in load_data, kept in the snapshot of the version shown)
+        latest_period = combined['periodo'].max()
+        with st.expander(f"🚨 **Anomalías {latest_period}**"):
+            anomalies = read_snapshot_table(data_version, 'anomalies')
+            if anomalies is not None:
+                anomalies = anomalies[anomalies['periodo'] == latest_period].head(10)
+            if anomalies is None:
+                st.caption("Puntuaciones de anomalías no disponibles (no se pudo guardar la versión de los datos)")
+            elif not anomalies.empty:
+                anomaly_display = pd.DataFrame({
+                    'Entidad': anomalies['entidad'].str[:22],
+                    'Métrica': anomalies['metrica'],
+                    'z': anomalies['puntuacion'].round(1)
+                })
+                st.dataframe(anomaly_display, use_container_width=True, hide_index=True)
+                st.caption(f"z-score robusto (mediana/MAD) ≥ {ANOMALY_THRESHOLD} frente a su historial o a su tipo en el trimestre")
+            else:
+                st.caption("Sin anomalías en el último trimestre")
         
         # Enable comparison flag
         enable_comparison = len(comparison_companies) > 0
@@ -766,18 +3318,30 @@ def main():
     if not company_data.empty:
         # Company name and type
         company_type = company_data.iloc[0]['tipo']
-        badge_class = "type-badge-sociedad" if company_type == "Sociedad" else "type-badge-agencia"
-        type_label = "SOCIEDAD DE VALORES" if company_type == "Sociedad" else "AGENCIA DE VALORES"
+        type_label = source_attribute(company_type, 'title').upper()
         
         st.markdown(f"""
         <div style="text-align: center; margin-bottom: 30px;">
             <h2 style="color: white; font-size: 28px; font-weight: 700; margin-bottom: 10px;">{selected_company}</h2>
-            <span class="{badge_class}">{type_label}</span>
+            <span class="type-badge" style="background: {type_badge_background(company_type)};">{type_label}</span>
         </div>
         """, unsafe_allow_html=True)
         
         # Calculate quarterly metrics
-        quarterly_metrics = calculate_quarterly_metrics(combined, selected_company)
+        quarterly_metrics = calculate_quarterly_metrics(combined, selected_company, growth_policy)
+        
+        # Metrics of every competitor in one batched call (overlays), cached per dataset version and peer set
+        peer_history = None
+        if comparison_companies:
+            peer_history = load_entities_metrics(data_version, tuple(comparison_companies), growth_policy, imputation,
+                                                 pinned_version)
+        
+        # Peer band table (precomputed per dataset) and the group of the selected company
+        peer_bands, band_group = None, None
+        if peer_band_mode != 'ninguna':
+            peer_bands = load_peer_bands(growth_policy, imputation, pinned_version)
+            size_class = entity_size_classes(combined).get(selected_company) if peer_band_mode == 'tamaño' else None
+            band_group = peer_group_name(company_type, size_class)
         
         if quarterly_metrics is not None and not quarterly_metrics.empty:
             # KPIs from latest quarter
@@ -791,14 +3355,14 @@ def main():
                 st.metric(
                     label="💰 Comisiones Percibidas (Últ. Trim.)",
                     value=f"€{latest['comisiones_percibidas']:,.0f}K",
-                    delta=f"{latest['var_ingresos']:.1f}% vs trim. anterior" if len(quarterly_metrics) > 1 else None
+                    delta=f"{latest['var_ingresos']:.1f}% vs trim. anterior" if len(quarterly_metrics) > 1 and pd.notna(latest['var_ingresos']) else None
                 )
             
             with col2:
                 st.metric(
                     label="📊 Resultado (Últ. Trim.)",
                     value=f"€{latest['resultados_antes_impuestos']:,.0f}K",
-                    delta=f"{latest['var_beneficio']:.1f}% vs trim. anterior" if len(quarterly_metrics) > 1 else None
+                    delta=f"{latest['var_beneficio']:.1f}% vs trim. anterior" if len(quarterly_metrics) > 1 and pd.notna(latest['var_beneficio']) else None
                 )
             
             with col3:
@@ -816,14 +3380,29 @@ def main():
                     delta_color="inverse"
                 )
             
+            # Charts in tabs 1-3 follow the selected metric view (quarterly until a 4-quarter window is complete)
+            chart_metrics = select_metric_view(quarterly_metrics, metric_view)
+            if chart_metrics.empty:
+                st.caption(f"{selected_company} aún no tiene {TTM_WINDOW} trimestres consecutivos: "
+                           "los gráficos muestran la vista trimestral")
+                metric_view = 'Trimestral'
+                chart_metrics = select_metric_view(quarterly_metrics, metric_view)
+            overlay_metrics = select_metric_view(peer_history, metric_view) if overlay_enabled else None
+            growth_label = "Interanual" if metric_view == 'TTM' else "Intertrimestral"
+            
+            # The header, KPIs and sidebar are already on screen; charts start here
+            load_plotting()
+            
             # Tabs for different views
-            tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
+            tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs([
                 "📊 Rendimiento Trimestral", 
                 "📈 Análisis de Crecimiento", 
                 "⚡ Métricas de Eficiencia",
                 "🏆 Comparación con Competidores",
-                "⚖️ Sociedades vs Agencias",
-                "📉 Salud Financiera"
+                "⚖️ Comparación por Tipo",
+                "📉 Salud Financiera",
+                "🏛️ Visión Sectorial",
+                "🧬 Perfiles y Correlación"
             ])
             
             with tab1:
@@ -833,64 +3412,88 @@ def main():
                 fig = make_subplots(
                     rows=2, cols=2,
                     subplot_titles=("Evolución de Ingresos y Beneficio", "Crecimiento de Activos y Patrimonio", 
-                                   "Tasas de Crecimiento Intertrimestral", "Análisis de Márgenes"),
+                                   f"Tasas de Crecimiento {growth_label}", "Análisis de Márgenes"),
                     vertical_spacing=0.12,
                     horizontal_spacing=0.10,
                     specs=[[{'secondary_y': True}, {'secondary_y': True}],
                            [{'secondary_y': False}, {'secondary_y': False}]]
                 )
                 
+                # Peer bands under the company's lines
+                band_periods = chart_metrics['periodo']
+                add_peer_band(fig, peer_bands, band_group, 'resultados_antes_impuestos', band_periods, 1, 1, metric_view, secondary_y=True, render_mode=render_mode)
+                add_peer_band(fig, peer_bands, band_group, 'fondos_propios', band_periods, 1, 2, metric_view, secondary_y=True, render_mode=render_mode)
+                add_peer_band(fig, peer_bands, band_group, 'var_ingresos', band_periods[1:], 2, 1, metric_view, render_mode=render_mode)
+                add_peer_band(fig, peer_bands, band_group, 'margen_neto', band_periods, 2, 2, metric_view, render_mode=render_mode)
+                
                 # Income and Profit
                 fig.add_trace(
-                    go.Bar(x=quarterly_metrics['periodo'], y=quarterly_metrics['comisiones_percibidas'],
+                    bar_trace(x=chart_metrics['periodo'], y=chart_metrics['comisiones_percibidas'],
                           name='Comisiones', marker_color='#00d4ff', opacity=0.7,
-                          text=quarterly_metrics['comisiones_percibidas'].round(0),
-                          textposition='outside'),
+                          text=chart_metrics['comisiones_percibidas'].round(0),
+                          textposition='outside', render_mode=render_mode),
                     row=1, col=1, secondary_y=False
                 )
                 fig.add_trace(
-                    go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['resultados_antes_impuestos'],
+                    line_trace(x=chart_metrics['periodo'], y=chart_metrics['resultados_antes_impuestos'],
                               name='Beneficio', line=dict(color='#f687b3', width=3),
-                              mode='lines+markers', marker=dict(size=10)),
+                              mode='lines+markers', marker=dict(size=10), render_mode=render_mode),
                     row=1, col=1, secondary_y=True
                 )
                 
+                # Mark quarters estimated from a multi-quarter YTD difference
+                imputed = chart_metrics[chart_metrics['imputado']] if 'imputado' in chart_metrics.columns else chart_metrics.iloc[0:0]
+                if not imputed.empty:
+                    fig.add_trace(
+                        go.Scatter(x=imputed['periodo'], y=imputed['resultados_antes_impuestos'],
+                                  name='Estimado', mode='markers',
+                                  marker=dict(symbol='circle-open', size=18, color='#fbd38d', line=dict(width=2)),
+                                  hovertemplate='%{x}: trimestre estimado<extra></extra>'),
+                        row=1, col=1, secondary_y=True
+                    )
+                
                 # Assets and Equity
                 fig.add_trace(
-                    go.Bar(x=quarterly_metrics['periodo'], y=quarterly_metrics['activos_totales'],
-                          name='Activos', marker_color='#4299e1', opacity=0.7),
+                    bar_trace(x=chart_metrics['periodo'], y=chart_metrics['activos_totales'],
+                          name='Activos', marker_color='#4299e1', opacity=0.7, render_mode=render_mode),
                     row=1, col=2, secondary_y=False
                 )
                 fig.add_trace(
-                    go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['fondos_propios'],
+                    line_trace(x=chart_metrics['periodo'], y=chart_metrics['fondos_propios'],
                               name='Patrimonio', line=dict(color='#48bb78', width=3),
-                              mode='lines+markers', marker=dict(size=10)),
+                              mode='lines+markers', marker=dict(size=10), render_mode=render_mode),
                     row=1, col=2, secondary_y=True
                 )
                 
                 # Growth rates
-                if len(quarterly_metrics) > 1:
+                if len(chart_metrics) > 1:
                     fig.add_trace(
-                        go.Scatter(x=quarterly_metrics['periodo'][1:], y=quarterly_metrics['var_ingresos'][1:],
+                        line_trace(x=chart_metrics['periodo'][1:], y=chart_metrics['var_ingresos'][1:],
                                   name='Crec. Ingresos', line=dict(color='#00d4ff', width=2),
-                                  mode='lines+markers', marker=dict(size=8)),
+                                  mode='lines+markers', marker=dict(size=8), render_mode=render_mode),
                         row=2, col=1
                     )
                     fig.add_trace(
-                        go.Scatter(x=quarterly_metrics['periodo'][1:], y=quarterly_metrics['var_activos'][1:],
+                        line_trace(x=chart_metrics['periodo'][1:], y=chart_metrics['var_activos'][1:],
                                   name='Crec. Activos', line=dict(color='#b794f6', width=2),
-                                  mode='lines+markers', marker=dict(size=8)),
+                                  mode='lines+markers', marker=dict(size=8), render_mode=render_mode),
                         row=2, col=1
                     )
                 
                 # Margins
                 fig.add_trace(
-                    go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['margen_neto'],
+                    line_trace(x=chart_metrics['periodo'], y=chart_metrics['margen_neto'],
                               name='Margen Neto', line=dict(color='#ed8936', width=2),
-                              mode='lines+markers', fill='tozeroy', opacity=0.3),
+                              mode='lines+markers', fill='tozeroy', opacity=0.3, render_mode=render_mode),
                     row=2, col=2
                 )
                 
+                # Overlaid competitors
+                add_overlay_traces(fig, overlay_metrics, 'resultados_antes_impuestos', 1, 1, render_mode, secondary_y=True)
+                add_overlay_traces(fig, overlay_metrics, 'fondos_propios', 1, 2, render_mode, secondary_y=True)
+                add_overlay_traces(fig, overlay_metrics, 'var_ingresos', 2, 1, render_mode, skip_first=True)
+                add_overlay_traces(fig, overlay_metrics, 'margen_neto', 2, 2, render_mode)
+                
                 # Update layout
                 fig.update_layout(**professional_theme['layout'], height=700, showlegend=True)
                 fig.update_yaxes(title_text="Importe (€K)", row=1, col=1, secondary_y=False)
@@ -904,14 +3507,40 @@ def main():
                 
                 # Summary table
                 st.markdown("### 📋 Resumen de Rendimiento")
-                summary_df = quarterly_metrics[['periodo', 'comisiones_percibidas', 'resultados_antes_impuestos', 
+                summary_df = chart_metrics[['periodo', 'comisiones_percibidas', 'resultados_antes_impuestos', 
                                                'ROA', 'ROE', 'ratio_eficiencia']].round(2)
                 summary_df.columns = ['Trimestre', 'Comisiones (€K)', 'RAI (€K)', 'ROA (%)', 'ROE (%)', 'Eficiencia (%)']
                 st.dataframe(summary_df.sort_values('Trimestre', ascending=False), use_container_width=True)
+                if not imputed.empty:
+                    st.caption(f"Trimestres estimados por falta de declaraciones previas: {', '.join(imputed['periodo'])}")
             
             with tab2:
                 st.markdown("### 📈 Análisis de Trayectoria de Crecimiento")
                 
+                # Forecast of the next quarters (precomputed for every entity per dataset version)
+                col1, col2 = st.columns([2, 1])
+                with col1:
+                    forecast_model = st.selectbox(
+                        "🔮 Previsión",
+                        [None] + list(FORECAST_MODELS),
+                        index=1,
+                        format_func=lambda model: "Sin previsión" if model is None else FORECAST_MODELS[model]
+                    )
+                with col2:
+                    forecast_horizon = st.slider("Trimestres a prever", min_value=1, max_value=FORECAST_HORIZON,
+                                                 value=FORECAST_HORIZON, disabled=forecast_model is None)
+                company_forecast = None
+                if forecast_model is not None:
+                    forecasts = load_forecasts(data_version, growth_policy, imputation, pinned_version)
+                    company_forecast = forecasts[
+                        (forecasts['entidad'] == selected_company) & (forecasts['modelo'] == forecast_model) &
+                        (forecasts['h'] <= forecast_horizon)
+                    ].pivot(index='periodo', columns='metrica', values='prevision').sort_index()
+                    if company_forecast.empty:
+                        company_forecast = None
+                        st.caption(f"Sin historial suficiente para la previsión "
+                                   f"(mínimo {FORECAST_MIN_QUARTERS[forecast_model]} trimestres)")
+                
                 fig_growth = make_subplots(
                     rows=2, cols=2,
                     subplot_titles=("Crecimiento Acumulado", "Rendimiento Indexado (Base 100)",
@@ -920,43 +3549,55 @@ def main():
                     horizontal_spacing=0.10
                 )
                 
+                # Peer bands for the per-quarter charts
+                add_peer_band(fig_growth, peer_bands, band_group, 'comisiones_percibidas', chart_metrics['periodo'], 2, 1, metric_view, render_mode=render_mode)
+                add_peer_band(fig_growth, peer_bands, band_group, 'var_ingresos', chart_metrics['periodo'][1:], 2, 2, metric_view, render_mode=render_mode)
+                
                 # Accumulated growth
-                quarterly_metrics['cum_ingresos'] = quarterly_metrics['comisiones_percibidas'].cumsum()
-                quarterly_metrics['cum_beneficio'] = quarterly_metrics['resultados_antes_impuestos'].cumsum()
+                chart_metrics['cum_ingresos'] = quarterly_metrics['comisiones_percibidas'].cumsum()
+                chart_metrics['cum_beneficio'] = quarterly_metrics['resultados_antes_impuestos'].cumsum()
                 
                 fig_growth.add_trace(
-                    go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['cum_ingresos'],
+                    line_trace(x=chart_metrics['periodo'], y=chart_metrics['cum_ingresos'],
                               name='Ingresos Acum.', line=dict(color='#00d4ff', width=3),
-                              mode='lines+markers', fill='tonexty'),
+                              mode='lines+markers', fill='tonexty', render_mode=render_mode),
                     row=1, col=1
                 )
                 
                 fig_growth.add_trace(
-                    go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['cum_beneficio'],
+                    line_trace(x=chart_metrics['periodo'], y=chart_metrics['cum_beneficio'],
                               name='Beneficio Acum.', line=dict(color='#f687b3', width=3),
-                              mode='lines+markers', fill='tozeroy'),
+                              mode='lines+markers', fill='tozeroy', render_mode=render_mode),
                     row=1, col=1
                 )
                 
+                # Forecasts continue the accumulated totals
+                if company_forecast is not None:
+                    for metric, cum_col, color in [('comisiones_percibidas', 'cum_ingresos', '#00d4ff'),
+                                                   ('resultados_antes_impuestos', 'cum_beneficio', '#f687b3')]:
+                        add_forecast_trace(fig_growth, chart_metrics['periodo'], chart_metrics[cum_col],
+                                           chart_metrics[cum_col].iloc[-1] + company_forecast[metric].cumsum(),
+                                           f'Previsión {FORECAST_METRICS[metric]} Acum.', color, 1, 1, render_mode)
+                
                 # Indexed performance
-                if len(quarterly_metrics) > 0:
-                    base_revenue = quarterly_metrics['comisiones_percibidas'].iloc[0]
-                    base_assets = quarterly_metrics['activos_totales'].iloc[0]
+                if len(chart_metrics) > 0:
+                    base_revenue = chart_metrics['comisiones_percibidas'].iloc[0]
+                    base_assets = chart_metrics['activos_totales'].iloc[0]
                     
-                    quarterly_metrics['indice_ingresos'] = (quarterly_metrics['comisiones_percibidas'] / base_revenue * 100) if base_revenue > 0 else 100
-                    quarterly_metrics['indice_activos'] = (quarterly_metrics['activos_totales'] / base_assets * 100) if base_assets > 0 else 100
+                    chart_metrics['indice_ingresos'] = (chart_metrics['comisiones_percibidas'] / base_revenue * 100) if base_revenue > 0 else 100
+                    chart_metrics['indice_activos'] = (chart_metrics['activos_totales'] / base_assets * 100) if base_assets > 0 else 100
                     
                     fig_growth.add_trace(
-                        go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['indice_ingresos'],
+                        line_trace(x=chart_metrics['periodo'], y=chart_metrics['indice_ingresos'],
                                   name='Índice Ingresos', line=dict(color='#00d4ff', width=2),
-                                  mode='lines+markers'),
+                                  mode='lines+markers', render_mode=render_mode),
                         row=1, col=2
                     )
                     
                     fig_growth.add_trace(
-                        go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['indice_activos'],
+                        line_trace(x=chart_metrics['periodo'], y=chart_metrics['indice_activos'],
                                   name='Índice Activos', line=dict(color='#4299e1', width=2, dash='dash'),
-                                  mode='lines+markers'),
+                                  mode='lines+markers', render_mode=render_mode),
                         row=1, col=2
                     )
                     
@@ -965,42 +3606,78 @@ def main():
                 
                 # Quarterly evolution
                 fig_growth.add_trace(
-                    go.Bar(x=quarterly_metrics['periodo'], y=quarterly_metrics['comisiones_percibidas'],
-                          name='Comisiones', marker_color='#00d4ff', opacity=0.6),
+                    bar_trace(x=chart_metrics['periodo'], y=chart_metrics['comisiones_percibidas'],
+                          name='Comisiones', marker_color='#00d4ff', opacity=0.6, render_mode=render_mode),
                     row=2, col=1
                 )
                 
+                # Forecast revenue, summed with the last actual quarters in the TTM view
+                if company_forecast is not None:
+                    revenue_forecast = company_forecast['comisiones_percibidas']
+                    if metric_view == 'TTM':
+                        history = quarterly_metrics['comisiones_percibidas'].to_numpy()[-(SEASON_LENGTH - 1):]
+                        window = pd.Series(np.concatenate([history, revenue_forecast.to_numpy()]))
+                        revenue_forecast = pd.Series(window.rolling(SEASON_LENGTH).sum().to_numpy()[len(history):],
+                                                     index=revenue_forecast.index)
+                    add_forecast_trace(fig_growth, chart_metrics['periodo'], chart_metrics['comisiones_percibidas'],
+                                       revenue_forecast, 'Previsión Comisiones', '#fbd38d', 2, 1, render_mode)
+                
                 # Percentage variation
-                if len(quarterly_metrics) > 1:
-                    colors = ['#48bb78' if x > 0 else '#ff3366' for x in quarterly_metrics['var_ingresos'][1:]]
+                if len(chart_metrics) > 1:
+                    colors = ['#48bb78' if x > 0 else '#ff3366' for x in chart_metrics['var_ingresos'][1:]]
                     
                     fig_growth.add_trace(
-                        go.Bar(x=quarterly_metrics['periodo'][1:], y=quarterly_metrics['var_ingresos'][1:],
-                              name='Var. Ingresos', marker_color=colors, opacity=0.7),
+                        bar_trace(x=chart_metrics['periodo'][1:], y=chart_metrics['var_ingresos'][1:],
+                              name='Var. Ingresos', marker_color=colors, opacity=0.7, render_mode=render_mode),
                         row=2, col=2
                     )
                 
+                # Overlaid competitors (revenue index against each company's own first quarter)
+                if overlay_metrics is not None and not overlay_metrics.empty:
+                    base_revenues = overlay_metrics.groupby('entidad', sort=False)['comisiones_percibidas'].transform('first')
+                    overlay_index = overlay_metrics.assign(
+                        indice_ingresos=np.where(base_revenues > 0, overlay_metrics['comisiones_percibidas'] / base_revenues * 100, 100)
+                    )
+                    add_overlay_traces(fig_growth, overlay_index, 'indice_ingresos', 1, 2, render_mode)
+                add_overlay_traces(fig_growth, overlay_metrics, 'comisiones_percibidas', 2, 1, render_mode)
+                add_overlay_traces(fig_growth, overlay_metrics, 'var_ingresos', 2, 2, render_mode, skip_first=True)
+                
                 fig_growth.update_layout(**professional_theme['layout'], height=700, showlegend=True)
                 st.plotly_chart(fig_growth, use_container_width=True)
                 
                 # Growth metrics
                 col1, col2, col3 = st.columns(3)
                 
+                # In the TTM view growth is year over year, and the volatility is the stored one of the
+                # quarterly growth over the last 4 quarters
                 with col1:
-                    avg_growth = quarterly_metrics['var_ingresos'][1:].mean() if len(quarterly_metrics) > 1 else 0
-                    st.metric("Crecimiento Trimestral Promedio", f"{avg_growth:.1f}%")
+                    avg_growth = chart_metrics['var_ingresos'][1:].mean() if len(chart_metrics) > 1 else 0
+                    if metric_view == 'TTM':
+                        st.metric("Crecimiento Interanual Promedio", f"{avg_growth:.1f}%")
+                    else:
+                        st.metric("Crecimiento Trimestral Promedio", f"{avg_growth:.1f}%")
                 
                 with col2:
-                    volatility = quarterly_metrics['var_ingresos'][1:].std() if len(quarterly_metrics) > 1 else 0
-                    st.metric("Volatilidad Crecimiento", f"{volatility:.1f}%")
+                    if metric_view == 'TTM':
+                        volatility = chart_metrics['vol_ingresos_4q'].iloc[-1]
+                        st.metric(f"Volatilidad Crec. Trimestral ({TTM_WINDOW} trim.)",
+                                  f"{volatility:.1f}%" if pd.notna(volatility) else "N/D")
+                    else:
+                        volatility = chart_metrics['var_ingresos'][1:].std() if len(chart_metrics) > 1 else 0
+                        st.metric("Volatilidad Crecimiento", f"{volatility:.1f}%")
                 
                 with col3:
-                    if len(quarterly_metrics) > 0:
-                        total_growth = ((quarterly_metrics['comisiones_percibidas'].iloc[-1] / 
-                                       quarterly_metrics['comisiones_percibidas'].iloc[0] - 1) * 100) if quarterly_metrics['comisiones_percibidas'].iloc[0] > 0 else 0
+                    if len(chart_metrics) > 0:
+                        total_growth = ((chart_metrics['comisiones_percibidas'].iloc[-1] / 
+                                       chart_metrics['comisiones_percibidas'].iloc[0] - 1) * 100) if chart_metrics['comisiones_percibidas'].iloc[0] > 0 else 0
                     else:
                         total_growth = 0
                     st.metric("Crecimiento Total del Período", f"{total_growth:.1f}%")
+                
+                if company_forecast is not None:
+                    st.markdown(f"**Previsión ({FORECAST_MODELS[forecast_model]}, K€):**")
+                    st.dataframe(company_forecast.rename(columns=FORECAST_METRICS).round(0).rename_axis('Trimestre').reset_index(),
+                                 use_container_width=True, hide_index=True)
             
             with tab3:
                 st.markdown("### ⚡ Análisis de Eficiencia Operativa")
@@ -1013,46 +3690,58 @@ def main():
                     horizontal_spacing=0.10
                 )
                 
+                # Peer bands (ROE for the first chart)
+                add_peer_band(fig_eff, peer_bands, band_group, 'ROE', chart_metrics['periodo'], 1, 1, metric_view, render_mode=render_mode)
+                add_peer_band(fig_eff, peer_bands, band_group, 'ratio_eficiencia', chart_metrics['periodo'], 1, 2, metric_view, render_mode=render_mode)
+                add_peer_band(fig_eff, peer_bands, band_group, 'apalancamiento', chart_metrics['periodo'], 2, 1, metric_view, render_mode=render_mode)
+                add_peer_band(fig_eff, peer_bands, band_group, 'margen_neto', chart_metrics['periodo'], 2, 2, metric_view, render_mode=render_mode)
+                
                 # ROA vs ROE
                 fig_eff.add_trace(
-                    go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['ROA'],
+                    line_trace(x=chart_metrics['periodo'], y=chart_metrics['ROA'],
                               name='ROA', line=dict(color='#00d4ff', width=3),
-                              mode='lines+markers', marker=dict(size=10)),
+                              mode='lines+markers', marker=dict(size=10), render_mode=render_mode),
                     row=1, col=1
                 )
                 fig_eff.add_trace(
-                    go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['ROE'],
+                    line_trace(x=chart_metrics['periodo'], y=chart_metrics['ROE'],
                               name='ROE', line=dict(color='#f687b3', width=3),
-                              mode='lines+markers', marker=dict(size=10)),
+                              mode='lines+markers', marker=dict(size=10), render_mode=render_mode),
                     row=1, col=1
                 )
                 
                 # Cost-Income Ratio
                 fig_eff.add_trace(
-                    go.Bar(x=quarterly_metrics['periodo'], y=quarterly_metrics['ratio_eficiencia'],
+                    bar_trace(x=chart_metrics['periodo'], y=chart_metrics['ratio_eficiencia'],
                           name='Coste/Ingreso', marker_color='#ed8936', opacity=0.7,
-                          text=quarterly_metrics['ratio_eficiencia'].round(1),
-                          textposition='outside'),
+                          text=chart_metrics['ratio_eficiencia'].round(1),
+                          textposition='outside', render_mode=render_mode),
                     row=1, col=2
                 )
                 
                 # Leverage
                 fig_eff.add_trace(
-                    go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['apalancamiento'],
+                    line_trace(x=chart_metrics['periodo'], y=chart_metrics['apalancamiento'],
                               name='Apalancamiento', line=dict(color='#9f7aea', width=3),
-                              mode='lines+markers', fill='tozeroy', opacity=0.3),
+                              mode='lines+markers', fill='tozeroy', opacity=0.3, render_mode=render_mode),
                     row=2, col=1
                 )
                 
                 # Net margin
                 fig_eff.add_trace(
-                    go.Scatter(x=quarterly_metrics['periodo'], y=quarterly_metrics['margen_neto'],
+                    line_trace(x=chart_metrics['periodo'], y=chart_metrics['margen_neto'],
                               name='Margen Neto', line=dict(color='#48bb78', width=3),
                               mode='lines+markers', marker=dict(size=12),
-                              fill='tozeroy', opacity=0.3),
+                              fill='tozeroy', opacity=0.3, render_mode=render_mode),
                     row=2, col=2
                 )
                 
+                # Overlaid competitors (ROE in the first chart)
+                add_overlay_traces(fig_eff, overlay_metrics, 'ROE', 1, 1, render_mode)
+                add_overlay_traces(fig_eff, overlay_metrics, 'ratio_eficiencia', 1, 2, render_mode)
+                add_overlay_traces(fig_eff, overlay_metrics, 'apalancamiento', 2, 1, render_mode)
+                add_overlay_traces(fig_eff, overlay_metrics, 'margen_neto', 2, 2, render_mode)
+                
                 fig_eff.update_layout(**professional_theme['layout'], height=700, showlegend=True)
                 st.plotly_chart(fig_eff, use_container_width=True)
                 
@@ -1060,44 +3749,24 @@ def main():
                 col1, col2, col3 = st.columns(3)
                 
                 with col1:
-                    st.metric("ROA Promedio", f"{quarterly_metrics['ROA'].mean():.2f}%")
+                    st.metric("ROA Promedio", f"{chart_metrics['ROA'].mean():.2f}%")
                 
                 with col2:
-                    st.metric("ROE Promedio", f"{quarterly_metrics['ROE'].mean():.2f}%")
+                    st.metric("ROE Promedio", f"{chart_metrics['ROE'].mean():.2f}%")
                 
                 with col3:
-                    st.metric("Eficiencia Promedio", f"{quarterly_metrics['ratio_eficiencia'].mean():.1f}%")
+                    st.metric("Eficiencia Promedio", f"{chart_metrics['ratio_eficiencia'].mean():.1f}%")
             
             with tab4:
                 st.markdown("### 🏆 Análisis Comparativo con Competidores")
                 
                 if comparison_companies and not comparison_data.empty:
-                    # Prepare comparison data
-                    peer_metrics = []
-                    for comp in comparison_companies:
-                        comp_metrics = calculate_quarterly_metrics(combined, comp)
-                        if comp_metrics is not None and not comp_metrics.empty:
-                            latest_comp = comp_metrics.iloc[-1]
-                            peer_metrics.append({
-                                'Empresa': comp,
-                                'Ingresos': latest_comp['comisiones_percibidas'],
-                                'Beneficio': latest_comp['resultados_antes_impuestos'],
-                                'ROA': latest_comp['ROA'],
-                                'ROE': latest_comp['ROE'],
-                                'Eficiencia': latest_comp['ratio_eficiencia']
-                            })
-                    
-                    # Add selected company
-                    peer_metrics.append({
-                        'Empresa': selected_company,
-                        'Ingresos': latest['comisiones_percibidas'],
-                        'Beneficio': latest['resultados_antes_impuestos'],
-                        'ROA': latest['ROA'],
-                        'ROE': latest['ROE'],
-                        'Eficiencia': latest['ratio_eficiencia']
-                    })
-                    
-                    peer_df = pd.DataFrame(peer_metrics)
+                    # Latest quarter of the competitors and the company (cached across reruns and sessions)
+                    peer_df = load_peer_comparison(
+                        data_version, selected_company, tuple(comparison_companies),
+                        (selected_periods[0], selected_periods[-1]), tuple(PEER_COMPARISON_METRICS),
+                        growth_policy, imputation, pinned_version
+                    )
                     
                     # Comparative bar chart
                     fig_comp = go.Figure()
@@ -1129,32 +3798,22 @@ def main():
                     st.warning("Active la comparación en el panel lateral para ver este análisis")
             
             with tab5:
-                st.markdown("### ⚖️ Comparación entre Sociedades y Agencias de Valores")
-                
-                # Separate data by type
-                sociedades_data = combined[combined['tipo'] == 'Sociedad']
-                agencias_data = combined[combined['tipo'] == 'Agencia']
-                
-                if len(sociedades_data) > 0 and len(agencias_data) > 0:
-                    # Calculate average metrics by type and period
-                    sociedades_avg = sociedades_data.groupby('periodo').agg({
-                        'comisiones_percibidas': 'mean',
-                        'resultados_antes_impuestos': 'mean',
-                        'activos_totales': 'mean',
-                        'fondos_propios': 'mean',
-                        'gastos_explotacion': 'mean',
-                        'margen_bruto': 'mean'
-                    }).round(0)
-                    
-                    agencias_avg = agencias_data.groupby('periodo').agg({
-                        'comisiones_percibidas': 'mean',
-                        'resultados_antes_impuestos': 'mean',
-                        'activos_totales': 'mean',
-                        'fondos_propios': 'mean',
-                        'gastos_explotacion': 'mean',
-                        'margen_bruto': 'mean'
-                    }).round(0)
-                    
+                st.markdown("### ⚖️ Comparación entre Tipos de Entidad")
+                
+                # Average metrics by type and period, in one pass whatever the number of types
+                type_avg = combined.groupby(['tipo', 'periodo']).agg({
+                    'comisiones_percibidas': 'mean',
+                    'resultados_antes_impuestos': 'mean',
+                    'activos_totales': 'mean',
+                    'fondos_propios': 'mean',
+                    'gastos_explotacion': 'mean',
+                    'margen_bruto': 'mean'
+                }).round(0)
+                type_avg['eficiencia'] = (type_avg['gastos_explotacion'] / type_avg['margen_bruto'] * 100).fillna(0)
+                present_types = set(type_avg.index.get_level_values('tipo'))
+                tipos = [tipo for tipo in ENTITY_SOURCES if tipo in present_types] + sorted(present_types - set(ENTITY_SOURCES))
+                
+                if len(tipos) > 1:
                     # Comparative chart
                     fig_comp = make_subplots(
                         rows=2, cols=2,
@@ -1164,65 +3823,39 @@ def main():
                         horizontal_spacing=0.10
                     )
                     
-                    # Average income
-                    fig_comp.add_trace(
-                        go.Scatter(x=sociedades_avg.index, y=sociedades_avg['comisiones_percibidas'],
-                                  name='Sociedades', line=dict(color='#b794f6', width=3),
-                                  mode='lines+markers', marker=dict(size=10)),
-                        row=1, col=1
-                    )
-                    fig_comp.add_trace(
-                        go.Scatter(x=agencias_avg.index, y=agencias_avg['comisiones_percibidas'],
-                                  name='Agencias', line=dict(color='#00d4ff', width=3),
-                                  mode='lines+markers', marker=dict(size=10)),
-                        row=1, col=1
-                    )
-                    
-                    # Profitability
-                    fig_comp.add_trace(
-                        go.Bar(x=sociedades_avg.index, y=sociedades_avg['resultados_antes_impuestos'],
-                              name='Sociedades', marker_color='#b794f6', opacity=0.7),
-                        row=1, col=2
-                    )
-                    fig_comp.add_trace(
-                        go.Bar(x=agencias_avg.index, y=agencias_avg['resultados_antes_impuestos'],
-                              name='Agencias', marker_color='#00d4ff', opacity=0.7),
-                        row=1, col=2
-                    )
-                    
-                    # Assets
-                    fig_comp.add_trace(
-                        go.Scatter(x=sociedades_avg.index, y=sociedades_avg['activos_totales'],
-                                  name='Sociedades', line=dict(color='#b794f6', width=3),
-                                  mode='lines+markers', fill='tonexty'),
-                        row=2, col=1
-                    )
-                    fig_comp.add_trace(
-                        go.Scatter(x=agencias_avg.index, y=agencias_avg['activos_totales'],
-                                  name='Agencias', line=dict(color='#00d4ff', width=3),
-                                  mode='lines+markers', fill='tozeroy'),
-                        row=2, col=1
-                    )
-                    
-                    # Efficiency
-                    if len(sociedades_avg) > 0:
-                        sociedades_avg['eficiencia'] = (sociedades_avg['gastos_explotacion'] / 
-                                                       sociedades_avg['margen_bruto'] * 100).fillna(0)
-                    
-                    if len(agencias_avg) > 0:
-                        agencias_avg['eficiencia'] = (agencias_avg['gastos_explotacion'] / 
-                                                     agencias_avg['margen_bruto'] * 100).fillna(0)
-                    
-                    fig_comp.add_trace(
-                        go.Bar(x=sociedades_avg.index, y=sociedades_avg['eficiencia'],
-                              name='Sociedades', marker_color='#b794f6', opacity=0.7),
-                        row=2, col=2
-                    )
-                    fig_comp.add_trace(
-                        go.Bar(x=agencias_avg.index, y=agencias_avg['eficiencia'],
-                              name='Agencias', marker_color='#00d4ff', opacity=0.7),
-                        row=2, col=2
-                    )
+                    for tipo in tipos:
+                        avg = type_avg.loc[tipo]
+                        name, color = source_attribute(tipo), TIPO_COLORS.get(tipo, '#48bb78')
+                        
+                        # Average income
+                        fig_comp.add_trace(
+                            line_trace(x=avg.index, y=avg['comisiones_percibidas'],
+                                      name=name, line=dict(color=color, width=3),
+                                      mode='lines+markers', marker=dict(size=10), render_mode=render_mode),
+                            row=1, col=1
+                        )
+                        
+                        # Profitability
+                        fig_comp.add_trace(
+                            bar_trace(x=avg.index, y=avg['resultados_antes_impuestos'],
+                                  name=name, marker_color=color, opacity=0.7, render_mode=render_mode),
+                            row=1, col=2
+                        )
+                        
+                        # Assets
+                        fig_comp.add_trace(
+                            line_trace(x=avg.index, y=avg['activos_totales'],
+                                      name=name, line=dict(color=color, width=3),
+                                      mode='lines+markers', fill='tozeroy', render_mode=render_mode),
+                            row=2, col=1
+                        )
+                        
+                        # Efficiency
+                        fig_comp.add_trace(
+                            bar_trace(x=avg.index, y=avg['eficiencia'],
+                                  name=name, marker_color=color, opacity=0.7, render_mode=render_mode),
+                            row=2, col=2
+                        )
                     
                     fig_comp.update_layout(**professional_theme['layout'], height=700, showlegend=True)
                     fig_comp.update_yaxes(title_text="Comisiones (€K)", row=1, col=1)
@@ -1233,37 +3866,121 @@ def main():
                     st.plotly_chart(fig_comp, use_container_width=True)
                     
                     # Comparative statistics
-                    st.markdown("### 📊 Estadísticas Comparativas: Sociedades vs Agencias")
+                    st.markdown("### 📊 Estadísticas Comparativas por Tipo")
+                    type_stats = combined.groupby('tipo').agg(
+                        entidades=('entidad', 'nunique'),
+                        comisiones=('comisiones_percibidas', 'mean'),
+                        activos=('activos_totales', 'mean')
+                    )
                     
-                    col1, col2 = st.columns(2)
+                    for column, tipo in zip(st.columns(len(tipos)), tipos):
+                        with column:
+                            st.markdown(f"##### {source_attribute(tipo, 'icon', '🏛️')} {source_attribute(tipo)}")
+                            st.metric("Número de Entidades", type_stats.loc[tipo, 'entidades'])
+                            st.metric("Comisiones Promedio", f"€{type_stats.loc[tipo, 'comisiones']:,.0f}K")
+                            st.metric("Activos Promedio", f"€{type_stats.loc[tipo, 'activos']:,.0f}K")
+                else:
+                    st.warning("No hay suficientes datos para comparar tipos de entidad")
+                
+                # Market shares and concentration (stored per quarter, refreshed incrementally)
+                st.markdown("### 🥧 Cuotas de Mercado y Concentración")
+                market_shares, concentration = load_market_shares(growth_policy, imputation, pinned_version)
+                
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    share_metric = st.radio("Magnitud:", list(MARKET_SHARE_METRICS), format_func=MARKET_SHARE_METRICS.get,
+                                            horizontal=True)
+                with col2:
+                    markets = [WHOLE_MARKET] + sorted(set(concentration['mercado']) - {WHOLE_MARKET})
+                    share_market = st.radio("Mercado:", markets, horizontal=True,
+                                            index=markets.index(company_type) if company_type in markets else 0)
+                with col3:
+                    share_periods = sorted(concentration['periodo'].unique(), reverse=True)
+                    share_period = st.selectbox("Trimestre:", share_periods)
+                
+                market_history = concentration[(concentration['metrica'] == share_metric) &
+                                               (concentration['mercado'] == share_market)].sort_values('periodo')
+                period_shares = market_shares[(market_shares['metrica'] == share_metric) &
+                                              (market_shares['mercado'] == share_market) &
+                                              (market_shares['periodo'] == share_period)].sort_values('rango')
+                
+                if not period_shares.empty:
+                    fig_shares = make_subplots(
+                        rows=2, cols=2,
+                        subplot_titles=(f"Curva de Lorenz ({share_period})", "Índice de Gini",
+                                        "Índice Herfindahl-Hirschman (HHI)", "Cuota de las Mayores Entidades"),
+                        vertical_spacing=0.12,
+                        horizontal_spacing=0.10
+                    )
                     
-                    with col1:
-                        st.markdown("##### 📈 Sociedades de Valores")
-                        st.metric("Número de Entidades", sociedades_data['entidad'].nunique())
-                        st.metric("Comisiones Promedio", f"€{sociedades_data['comisiones_percibidas'].mean():,.0f}K")
-                        st.metric("Activos Promedio", f"€{sociedades_data['activos_totales'].mean():,.0f}K")
+                    # Lorenz curve from the stored cumulative shares: the bottom j entities hold 100 - top (n - j)
+                    n_entities = len(period_shares)
+                    top_cumulative = np.concatenate([[0], period_shares['cuota_acumulada'].to_numpy()])
+                    fig_shares.add_trace(
+                        line_trace(x=np.arange(n_entities + 1) / n_entities * 100, y=100 - top_cumulative[::-1],
+                                   name='Lorenz', line=dict(color='#00d4ff', width=3), fill='tozeroy',
+                                   mode='lines', render_mode=render_mode),
+                        row=1, col=1
+                    )
+                    fig_shares.add_trace(
+                        line_trace(x=[0, 100], y=[0, 100], name='Igualdad', mode='lines',
+                                   line=dict(color='gray', width=1, dash='dot'), render_mode=render_mode),
+                        row=1, col=1
+                    )
                     
-                    with col2:
-                        st.markdown("##### 🏦 Agencias de Valores")
-                        st.metric("Número de Entidades", agencias_data['entidad'].nunique())
-                        st.metric("Comisiones Promedio", f"€{agencias_data['comisiones_percibidas'].mean():,.0f}K")
-                        st.metric("Activos Promedio", f"€{agencias_data['activos_totales'].mean():,.0f}K")
+                    fig_shares.add_trace(
+                        line_trace(x=market_history['periodo'], y=market_history['gini'], name='Gini',
+                                   line=dict(color='#b794f6', width=3), mode='lines+markers', render_mode=render_mode),
+                        row=1, col=2
+                    )
+                    fig_shares.add_trace(
+                        bar_trace(x=market_history['periodo'], y=market_history['hhi'], name='HHI',
+                                  marker_color='#f687b3', opacity=0.7, render_mode=render_mode),
+                        row=2, col=1
+                    )
+                    # Thresholds of the US merger guidelines: unconcentrated < 1,500 < moderate < 2,500 < high
+                    fig_shares.add_hline(y=1500, line_width=1, line_dash="dot", line_color="#ed8936", row=2, col=1)
+                    fig_shares.add_hline(y=2500, line_width=1, line_dash="dot", line_color="#ff3366", row=2, col=1)
+                    for n, color in zip(TOP_N_SHARES, ['#48bb78', '#4299e1', '#fbd38d']):
+                        fig_shares.add_trace(
+                            line_trace(x=market_history['periodo'], y=market_history[f'top{n}'], name=f'Top {n}',
+                                       line=dict(color=color, width=2), mode='lines+markers', render_mode=render_mode),
+                            row=2, col=2
+                        )
+                    
+                    fig_shares.update_layout(**professional_theme['layout'], height=700, showlegend=True)
+                    fig_shares.update_xaxes(title_text="% de entidades (de menor a mayor)", row=1, col=1)
+                    fig_shares.update_yaxes(title_text=f"% de {MARKET_SHARE_METRICS[share_metric].lower()}", row=1, col=1)
+                    fig_shares.update_yaxes(title_text="Cuota (%)", row=2, col=2)
+                    st.plotly_chart(fig_shares, use_container_width=True)
+                    
+                    latest_concentration = market_history[market_history['periodo'] == share_period].iloc[0]
+                    col1, col2, col3, col4 = st.columns(4)
+                    col1.metric("Entidades", int(latest_concentration['n']))
+                    col2.metric("HHI", f"{latest_concentration['hhi']:,.0f}")
+                    col3.metric("Gini", f"{latest_concentration['gini']:.2f}")
+                    col4.metric(f"Cuota Top {TOP_N_SHARES[1]}", f"{latest_concentration[f'top{TOP_N_SHARES[1]}']:.1f}%")
+                    
+                    company_share = period_shares[period_shares['entidad'] == selected_company]
+                    if not company_share.empty:
+                        st.info(f"**{selected_company}** ocupa el puesto {int(company_share['rango'].iloc[0])} de "
+                                f"{n_entities} con una cuota del {company_share['cuota'].iloc[0]:.2f}%")
+                    
+                    ranking = period_shares.head(20)[['rango', 'entidad', 'valor', 'cuota', 'cuota_acumulada']].round(2)
+                    ranking.columns = ['Puesto', 'Entidad', f'{MARKET_SHARE_METRICS[share_metric]} (€K)', 'Cuota (%)',
+                                       'Cuota Acumulada (%)']
+                    st.dataframe(ranking, use_container_width=True, hide_index=True)
                 else:
-                    st.warning("No hay suficientes datos para comparar Sociedades y Agencias")
+                    st.warning("No hay datos de cuotas de mercado para este trimestre")
             
             with tab6:
                 st.markdown("### 📉 Evaluación de Salud Financiera")
                 
                 # Calculate health components
-                health_components = {
-                    'Rentabilidad': min(100, max(-100, (latest['ROE'] / 20 * 100))),
-                    'Calidad de Activos': min(100, max(-100, (latest['ROA'] / 10 * 100))),
-                    'Eficiencia': max(0, (100 - latest['ratio_eficiencia'])),
-                    'Margen': min(100, max(-100, latest['margen_neto'] * 5)),
-                    'Solvencia': min(100, 100 / latest['apalancamiento']) if latest['apalancamiento'] > 0 else 100
-                }
+                latest_health = compute_health_scores(quarterly_metrics.iloc[[-1]]).iloc[0]
+                health_components = latest_health[HEALTH_COMPONENTS].to_dict()
                 
-                overall_health = sum(health_components.values()) / len(health_components)
+                overall_health = latest_health['salud_global']
                 
                 # Financial health gauge
                 fig_health = go.Figure(go.Indicator(
@@ -1297,24 +4014,287 @@ def main():
                 for idx, (component, score) in enumerate(health_components.items()):
                     with cols[idx]:
                         st.metric(component, f"{score:.0f}/100")
-        
+                
+                # What-if shocks applied to every entity of the latest quarter
+                st.markdown("### 🧪 Escenarios de Estrés (Todo el Registro)")
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    shock_comisiones = st.slider("Comisiones percibidas (%)", -50, 50, -20, step=5)
+                with col2:
+                    shock_gastos = st.slider("Gastos de explotación (%)", -30, 30, 5, step=5)
+                with col3:
+                    shock_fondos = st.slider("Fondos propios (%)", -50, 50, 0, step=5)
+                
+                stress_entities = stress_base(combined)
+                stress_summary, stress_detail = run_stress_scenarios(stress_entities, pd.DataFrame([{
+                    'comisiones_percibidas': shock_comisiones / 100,
+                    'gastos_explotacion': shock_gastos / 100,
+                    'fondos_propios': shock_fondos / 100
+                }]))
+                scenario = stress_summary.iloc[0]
+                
+                st.caption(f"Aplicado a {int(scenario['entidades'])} entidades con datos en {stress_entities['periodo'].max()}")
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    st.metric("Entidades en Pérdidas", f"{int(scenario['en_perdidas'])}")
+                with col2:
+                    st.metric("Nuevas Pérdidas", f"{int(scenario['nuevas_perdidas'])}")
+                with col3:
+                    st.metric(f"Salud -{STRESS_HEALTH_DROP} pts o más", f"{int(scenario['deterioradas'])}")
+                with col4:
+                    st.metric("ROE Mediano Estresado", f"{scenario['roe_mediano']:.1f}%")
+                
+                company_idx = np.flatnonzero(stress_entities['entidad'].to_numpy() == selected_company)
+                if len(company_idx) > 0:
+                    idx = company_idx[0]
+                    stressed_health = stress_detail['salud_global'][0, idx]
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.metric(f"ROE Estresado - {selected_company[:25]}", f"{stress_detail['ROE'][0, idx]:.1f}%")
+                    with col2:
+                        st.metric(f"Salud Estresada - {selected_company[:25]}", f"{stressed_health:.0f}/100",
+                                  delta=f"{stress_detail['delta_salud'][0, idx]:.1f} pts")
+                
+                # Distribution of the health change and sensitivity grid (one batched call)
+                sensitivity = scenario_grid(
+                    comisiones_percibidas=np.round(np.arange(-0.5, 0.21, 0.1), 2),
+                    gastos_explotacion=np.round(np.arange(-0.1, 0.31, 0.05), 2)
+                )
+                sensitivity_summary, _ = run_stress_scenarios(stress_entities, sensitivity)
+                loss_share = sensitivity_summary.pivot(index='gastos_explotacion', columns='comisiones_percibidas',
+                                                       values='en_perdidas') / max(int(scenario['entidades']), 1) * 100
+                
+                fig_stress = make_subplots(rows=1, cols=2,
+                                           subplot_titles=("Cambio en la Puntuación de Salud",
+                                                           "% de Entidades en Pérdidas"),
+                                           horizontal_spacing=0.12)
+                fig_stress.add_trace(
+                    go.Histogram(x=stress_detail['delta_salud'][0], nbinsx=30, marker_color='#f687b3',
+                                 opacity=0.8, name='Δ Salud'),
+                    row=1, col=1
+                )
+                fig_stress.add_trace(
+                    go.Heatmap(x=[f"{v:+.0%}" for v in loss_share.columns], y=[f"{v:+.0%}" for v in loss_share.index],
+                               z=loss_share.to_numpy(), colorscale='RdYlGn_r', name='% pérdidas',
+                               colorbar=dict(title='%', x=1.02)),
+                    row=1, col=2
+                )
+                fig_stress.update_layout(**professional_theme['layout'], height=420, showlegend=False)
+                fig_stress.update_xaxes(title_text="Δ Puntos", row=1, col=1)
+                fig_stress.update_xaxes(title_text="Shock Comisiones", row=1, col=2)
+                fig_stress.update_yaxes(title_text="Shock Gastos", row=1, col=2)
+                st.plotly_chart(fig_stress, use_container_width=True)
+            
+            with tab7:
+                st.markdown("### 🏛️ Agregados del Sector por Trimestre")
+                
+                sector_aggregates = load_sector_aggregates(growth_policy, imputation, pinned_version)
+                
+                if not sector_aggregates.empty:
+                    fig_sector = make_subplots(
+                        rows=2, cols=2,
+                        subplot_titles=("Comisiones Totales", "Activos Totales",
+                                       "ROE Mediano", "Concentración (HHI Comisiones)"),
+                        vertical_spacing=0.12,
+                        horizontal_spacing=0.10
+                    )
+                    
+                    for tipo, tipo_data in sector_aggregates.sort_values('periodo').groupby('tipo'):
+                        color = TIPO_COLORS.get(tipo, '#48bb78')
+                        fig_sector.add_trace(
+                            bar_trace(x=tipo_data['periodo'], y=tipo_data['total_comisiones'],
+                                  name=tipo, marker_color=color, opacity=0.7, legendgroup=tipo, render_mode=render_mode),
+                            row=1, col=1
+                        )
+                        fig_sector.add_trace(
+                            line_trace(x=tipo_data['periodo'], y=tipo_data['total_activos'],
+                                      name=tipo, line=dict(color=color, width=3),
+                                      mode='lines+markers', legendgroup=tipo, showlegend=False, render_mode=render_mode),
+                            row=1, col=2
+                        )
+                        fig_sector.add_trace(
+                            line_trace(x=tipo_data['periodo'], y=tipo_data['roe_mediano'],
+                                      name=tipo, line=dict(color=color, width=3),
+                                      mode='lines+markers', legendgroup=tipo, showlegend=False, render_mode=render_mode),
+                            row=2, col=1
+                        )
+                        fig_sector.add_trace(
+                            line_trace(x=tipo_data['periodo'], y=tipo_data['hhi_comisiones'],
+                                      name=tipo, line=dict(color=color, width=3),
+                                      mode='lines+markers', legendgroup=tipo, showlegend=False, render_mode=render_mode),
+                            row=2, col=2
+                        )
+                    
+                    fig_sector.update_layout(**professional_theme['layout'], height=700, showlegend=True, barmode='stack')
+                    fig_sector.update_yaxes(title_text="Comisiones (€K)", row=1, col=1)
+                    fig_sector.update_yaxes(title_text="Activos (€K)", row=1, col=2)
+                    fig_sector.update_yaxes(title_text="ROE (%)", row=2, col=1)
+                    fig_sector.update_yaxes(title_text="HHI (0-10.000)", row=2, col=2)
+                    
+                    st.plotly_chart(fig_sector, use_container_width=True)
+                    
+                    # Aggregate table
+                    st.markdown("### 📋 Tabla de Agregados Sectoriales")
+                    sector_display = sector_aggregates[['periodo', 'tipo', 'n_entidades', 'total_comisiones',
+                                                        'total_activos', 'roe_mediano', 'hhi_comisiones']].round(2)
+                    sector_display.columns = ['Trimestre', 'Tipo', 'Entidades', 'Comisiones (€K)',
+                                              'Activos (€K)', 'ROE Mediano (%)', 'HHI']
+                    st.dataframe(sector_display.sort_values(['Trimestre', 'Tipo'], ascending=[False, True]),
+                                 use_container_width=True)
+                else:
+                    st.warning("No hay datos suficientes para los agregados sectoriales")
+                
+                # Audit of entity names merged while loading the data
+                with st.expander("🔗 Auditoría de fusión de entidades"):
+                    merge_audit = read_snapshot_table(data_version, 'merge_audit')
+                    if merge_audit is None:
+                        st.info("Auditoría no disponible (no se pudo guardar la versión de los datos)")
+                    elif not merge_audit.empty:
+                        st.dataframe(merge_audit, use_container_width=True)
+                    else:
+                        st.info("No se han fusionado variantes de nombres")
+                
+                # Data-quality issues found while loading the data
+                with st.expander("🧾 Calidad de datos (cuarentena)"):
+                    quarantine = read_snapshot_table(data_version, 'quarantine')
+                    if quarantine is None:
+                        st.info("Cuarentena no disponible (no se pudo guardar la versión de los datos)")
+                    elif not quarantine.empty:
+                        rule_counts = quarantine.groupby(['regla', 'accion']).size().reset_index(name='filas')
+                        st.dataframe(rule_counts, use_container_width=True)
+                        selected_rules = st.multiselect("Filtrar por regla:", sorted(quarantine['regla'].unique()))
+                        if selected_rules:
+                            quarantine = quarantine[quarantine['regla'].isin(selected_rules)]
+                        st.dataframe(quarantine, use_container_width=True)
+                    else:
+                        st.info("No se han detectado incidencias de calidad")
+                
+                # Changes between two stored versions of the data
+                with st.expander("🕒 Versiones y cambios"):
+                    if len(snapshots) >= 2:
+                        st.dataframe(snapshots, use_container_width=True, hide_index=True)
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            old_version = st.selectbox("Versión anterior", list(snapshot_labels), index=1,
+                                                       format_func=snapshot_labels.get)
+                        with col2:
+                            new_version = st.selectbox("Versión nueva", list(snapshot_labels), index=0,
+                                                       format_func=snapshot_labels.get)
+                        old_data, new_data = load_snapshot(old_version), load_snapshot(new_version)
+                        if old_data is not None and new_data is not None:
+                            changed_rows, changed_cells = diff_snapshots(old_data, new_data)
+                            old_entities, new_entities = set(old_data['entidad']), set(new_data['entidad'])
+                            col1, col2, col3, col4 = st.columns(4)
+                            col1.metric("Entidades nuevas", len(new_entities - old_entities))
+                            col2.metric("Entidades eliminadas", len(old_entities - new_entities))
+                            col3.metric("Filas nuevas / eliminadas", f"{(changed_rows['estado'] == 'nueva').sum()} / "
+                                                                     f"{(changed_rows['estado'] == 'eliminada').sum()}")
+                            col4.metric("Filas revisadas", int((changed_rows['estado'] == 'modificada').sum()))
+                            if new_entities ^ old_entities:
+                                st.markdown("**Entidades nuevas:** " + (', '.join(sorted(new_entities - old_entities)) or '—'))
+                                st.markdown("**Entidades eliminadas o renombradas:** " + (', '.join(sorted(old_entities - new_entities)) or '—'))
+                            st.dataframe(changed_cells, use_container_width=True, hide_index=True)
+                    else:
+                        st.info("Se necesitan al menos dos versiones guardadas para comparar")
+            
+            with tab8:
+                st.markdown("### 🧬 Entidades con Comportamiento Similar")
+                st.caption("Agrupación k-means de las trayectorias trimestrales de crecimiento de ingresos, ROE, "
+                           f"eficiencia y apalancamiento (entidades con al menos {MIN_PROFILE_QUARTERS} trimestres)")
+                
+                n_clusters = st.slider("Número de grupos", min_value=2, max_value=8, value=4)
+                profiles, cluster_summary, revenue_matrix = load_entity_profiles(
+                    data_version, n_clusters, growth_policy, imputation, pinned_version
+                )
+                
+                if not profiles.empty:
+                    # 2-D projection of the profiles, colored by cluster
+                    fig_clusters = go.Figure()
+                    for cluster, cluster_data in profiles.groupby('cluster'):
+                        fig_clusters.add_trace(go.Scatter(
+                            x=cluster_data['pc1'], y=cluster_data['pc2'], mode='markers',
+                            name=f'Grupo {cluster}', text=cluster_data['entidad'],
+                            marker=dict(size=9, symbol=cluster_data['tipo'].map(lambda tipo: source_attribute(tipo, 'symbol', 'x')),
+                                        color=OVERLAY_COLORS[(cluster - 1) % len(OVERLAY_COLORS)], opacity=0.8),
+                            hovertemplate='%{text}<extra>Grupo ' + str(cluster) + '</extra>'
+                        ))
+                    selected_profile = profiles[profiles['entidad'] == selected_company]
+                    if not selected_profile.empty:
+                        fig_clusters.add_trace(go.Scatter(
+                            x=selected_profile['pc1'], y=selected_profile['pc2'], mode='markers',
+                            name=selected_company[:25], marker=dict(size=18, symbol='star', color='#00d4ff',
+                                                                    line=dict(width=1, color='white'))
+                        ))
+                    fig_clusters.update_layout(**professional_theme['layout'], height=500,
+                                               title="Mapa de perfiles (componentes principales; " + ', '.join(
+                                                   f"{TIPO_SYMBOLS[source['symbol']]} {tipo}" for tipo, source in ENTITY_SOURCES.items()) + ")")
+                    fig_clusters.update_layout(hovermode='closest')
+                    st.plotly_chart(fig_clusters, use_container_width=True)
+                    
+                    # Median metrics of each cluster
+                    summary_display = cluster_summary.round(2)
+                    summary_display.columns = ['Grupo', 'Entidades', 'Crec. Ingresos Mediano (%)', 'ROE Mediano (%)',
+                                               'Eficiencia Mediana (%)', 'Apalancamiento Mediano', 'Tipo Principal',
+                                               '% Tipo Principal']
+                    st.dataframe(summary_display, use_container_width=True, hide_index=True)
+                    
+                    if not selected_profile.empty:
+                        company_cluster = selected_profile['cluster'].iloc[0]
+                        cluster_peers = profiles[(profiles['cluster'] == company_cluster) &
+                                                 (profiles['entidad'] != selected_company)]['entidad']
+                        st.info(f"**{selected_company}** pertenece al grupo {company_cluster} "
+                                f"junto a {len(cluster_peers)} entidades")
+                else:
+                    st.warning("No hay entidades con historial suficiente para agrupar")
+                
+                # Correlation of revenue series across the sector
+                st.markdown("### 🔗 Correlación de Ingresos entre Entidades")
+                largest = revenue_matrix.mean(axis=1).nlargest(CORRELATION_MAX_ENTITIES).index
+                shown = list(largest)
+                if selected_company in revenue_matrix.index and selected_company not in shown:
+                    shown[-1] = selected_company
+                order = profiles.set_index('entidad')['cluster'].reindex(shown).fillna(0).sort_values(kind='stable').index
+                correlations = pairwise_correlation(revenue_matrix.loc[order].to_numpy(dtype=float))
+                
+                fig_corr = go.Figure(go.Heatmap(
+                    z=correlations, x=[e[:20] for e in order], y=[e[:20] for e in order],
+                    colorscale='RdBu', zmid=0, zmin=-1, zmax=1,
+                    hovertemplate='%{y}<br>%{x}<br>ρ = %{z:.2f}<extra></extra>'
+                ))
+                fig_corr.update_layout(**professional_theme['layout'], height=700,
+                                       title=f"Comisiones percibidas: {len(order)} mayores entidades, ordenadas por grupo")
+                st.plotly_chart(fig_corr, use_container_width=True)
+                
+                # Entities whose revenue moves most like the selected company's
+                if selected_company in revenue_matrix.index:
+                    company_corr = pairwise_correlation(
+                        revenue_matrix.loc[[selected_company]].to_numpy(dtype=float),
+                        revenue_matrix.to_numpy(dtype=float)
+                    )[0]
+                    most_correlated = pd.Series(company_corr, index=revenue_matrix.index).drop(selected_company).dropna()
+                    most_correlated = most_correlated.sort_values(ascending=False).head(5)
+                    if not most_correlated.empty:
+                        st.markdown(f"**Ingresos más correlacionados con {selected_company}:**")
+                        st.dataframe(most_correlated.round(2).rename('Correlación').rename_axis('Entidad').reset_index(),
+                                     use_container_width=True, hide_index=True)
+            
         # Export options
         st.divider()
         st.markdown("### 💾 Opciones de Exportación")
         
         col1, col2, col3 = st.columns(3)
         
+        # Files are generated only when a button is clicked
         with col1:
-            csv = quarterly_metrics.to_csv(index=False) if quarterly_metrics is not None else ""
             st.download_button(
                 label="📊 Descargar Métricas Trimestrales",
-                data=csv,
+                data=lambda: export_dataset(quarterly_metrics, 'csv') if quarterly_metrics is not None else b"",
                 file_name=f"{selected_company}_metricas_{datetime.now().strftime('%Y%m%d')}.csv",
                 mime="text/csv"
             )
         
         with col2:
-            summary_text = f"""
+            summary_text = lambda: f"""
 RESUMEN EJECUTIVO - {selected_company}
 Fecha: {datetime.now().strftime('%d/%m/%Y')}
 
@@ -1341,10 +4321,112 @@ Puntuación Global: {overall_health:.1f}/100
         with col3:
             st.download_button(
                 label="📁 Descargar Datos Completos",
-                data=company_data.to_csv(index=False),
+                data=lambda: export_dataset(company_data, 'csv'),
                 file_name=f"{selected_company}_datos_{datetime.now().strftime('%Y%m%d')}.csv",
                 mime="text/csv"
             )
+        
+        # Bulk export of any set of entities and periods, or the whole dataset
+        with st.expander("📦 Exportación masiva"):
+            col1, col2 = st.columns(2)
+            with col1:
+                export_all = st.checkbox("Todo el conjunto de datos", value=False)
+                export_entities = st.multiselect(
+                    "Entidades:",
+                    sorted(combined['entidad'].unique()),
+                    default=[selected_company] if selected_company else [],
+                    disabled=export_all
+                )
+                export_periods = st.multiselect(
+                    "Trimestres (vacío = todos):",
+                    sorted(combined['periodo'].unique(), reverse=True),
+                    disabled=export_all
+                )
+            with col2:
+                export_content = st.radio("Contenido:", ["Datos", "Métricas"], horizontal=True)
+                export_format = st.radio("Formato:", list(EXPORT_FORMATS), format_func=lambda fmt: EXPORT_FORMATS[fmt][0],
+                                         horizontal=True)
+            
+            entities = None if export_all else export_entities
+            periods = None if export_all or not export_periods else export_periods
+            
+            # Metrics are computed in one batched call, and only when the file is requested
+            def build_export():
+                if export_content == "Métricas":
+                    source = compute_quarterly_metrics(
+                        combined if entities is None else combined[combined['entidad'].isin(entities)], growth_policy
+                    )
+                else:
+                    source = combined
+                return export_dataset(source, export_format, entities, periods)
+            
+            scope = "todo" if export_all else f"{len(export_entities)}_entidades"
+            st.download_button(
+                label=f"⬇️ Generar y descargar ({EXPORT_FORMATS[export_format][0]})",
+                data=build_export,
+                file_name=f"{export_content.lower()}_{scope}_{datetime.now().strftime('%Y%m%d')}.{export_format}",
+                mime=EXPORT_FORMATS[export_format][1],
+                disabled=not export_all and not export_entities
+            )
+        
+        # Ad-hoc SQL over the persisted tables of the version on screen
+        with st.expander("🦆 Consultas SQL"):
+            query_version = pinned_version or data_version
+            sources = describe_query_sources(query_version)
+            if sources.empty:
+                st.info("No hay tablas guardadas para esta versión de los datos")
+            else:
+                st.dataframe(sources, use_container_width=True, hide_index=True)
+                sql = st.text_area(
+                    "Consulta:",
+                    value="SELECT entidad, periodo, ROE, activos_totales\n"
+                          "FROM metricas\n"
+                          f"WHERE tipo = 'Agencia' AND periodo = '{combined['periodo'].max()}' AND ROE > 15\n"
+                          "ORDER BY activos_totales DESC",
+                    height=120,
+                    key='sql_query'
+                )
+                if st.button("▶️ Ejecutar consulta"):
+                    try:
+                        result = run_query(sql, query_version)
+                        st.dataframe(result, use_container_width=True, hide_index=True)
+                        st.caption(f"{len(result):,} filas" + (f" (límite {QUERY_MAX_ROWS:,})"
+                                                                 if len(result) >= QUERY_MAX_ROWS else ""))
+                    except ImportError:
+                        st.warning("Las consultas SQL necesitan el paquete duckdb (pip install duckdb)")
+                    except Exception as e:
+                        st.error(f"Error en la consulta: {str(e)}")
+    
+    # Overview of every entity, shown with or without a selected company
+    st.divider()
+    st.markdown("### 🗂️ Panorama de Todas las Entidades")
+    st.caption("Evolución trimestral de cada entidad sobre los mismos trimestres (huecos donde no reportó). "
+               "Ordena pulsando en las columnas y busca por nombre con la búsqueda de la tabla.")
+    
+    overview_tipo = st.radio(
+        "Tipo de entidad:",
+        ["Todas"] + list(ENTITY_SOURCES),
+        format_func=lambda tipo: source_attribute(tipo, 'label') if tipo != "Todas" else tipo,
+        horizontal=True,
+        key='overview_tipo'
+    )
+    sparkline_grid = load_sparkline_grid(data_version, growth_policy, imputation, pinned_version)
+    if overview_tipo != "Todas":
+        sparkline_grid = sparkline_grid[sparkline_grid['tipo'] == overview_tipo]
+    grid_columns = {
+        'entidad': st.column_config.TextColumn("Entidad", width='medium'),
+        'tipo': st.column_config.TextColumn("Tipo"),
+        'ultimo_periodo': st.column_config.TextColumn("Últ. Trim."),
+        'trimestres': st.column_config.NumberColumn("Trim."),
+        'comisiones_percibidas': st.column_config.NumberColumn("Comisiones (K€)", format="%.0f"),
+        'serie_comisiones_percibidas': st.column_config.LineChartColumn("Comisiones"),
+        'resultados_antes_impuestos': st.column_config.NumberColumn("Resultado (K€)", format="%.0f"),
+        'serie_resultados_antes_impuestos': st.column_config.LineChartColumn("Resultado"),
+        'ROE': st.column_config.NumberColumn("ROE (%)", format="%.1f"),
+        'serie_ROE': st.column_config.LineChartColumn("ROE")
+    }
+    st.dataframe(sparkline_grid, column_config=grid_columns, column_order=list(grid_columns),
+                 use_container_width=True, hide_index=True, height=700)
     
     # Footer
     st.divider()
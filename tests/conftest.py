@@ -0,0 +1,29 @@
+"""Shared setup of the test suite: import path of the app modules and the timing report"""
+import os
+import sys
+from collections import defaultdict
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Seconds spent per stage by each implementation: stage -> [(reference, optimized), ...]
+TIMINGS = defaultdict(list)
+
+
+@pytest.fixture(scope='session')
+def timings():
+    return TIMINGS
+
+
+# Function to report the recorded timings after the test results
+def pytest_terminal_summary(terminalreporter):
+    if not TIMINGS:
+        return
+    terminalreporter.section('Tiempos: referencia vs optimizada')
+    terminalreporter.write_line(f"{'etapa':<36}{'casos':>8}{'ref ms':>12}{'opt ms':>12}{'x':>8}")
+    for stage, runs in sorted(TIMINGS.items()):
+        reference = sum(run[0] for run in runs)
+        optimized = sum(run[1] for run in runs)
+        terminalreporter.write_line(f"{stage:<36}{len(runs):>8}{reference * 1000:>12.1f}{optimized * 1000:>12.1f}"
+                                    f"{reference / optimized if optimized else float('nan'):>8.1f}")
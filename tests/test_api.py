@@ -0,0 +1,91 @@
+"""Conditional requests, validation and sector table of the metrics API"""
+import asyncio
+import os
+
+import pytest
+
+import api
+import main
+
+
+@pytest.fixture(scope='module', autouse=True)
+def dataset(tmp_path_factory):
+    """Load the dataset once, with the store in a temporary directory"""
+    store = tmp_path_factory.mktemp('store')
+    patch = pytest.MonkeyPatch()
+    patch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    patch.setattr(main, 'STORE_DIR', str(store))
+    patch.setattr(main, 'SNAPSHOT_DIR', os.path.join(store, 'snapshots'))
+    patch.setattr(api, 'cache', api.DatasetCache())
+    main.load_data.clear()
+    main.load_sector_aggregates.clear()
+    yield
+    patch.undo()
+    main.load_data.clear()
+    main.load_sector_aggregates.clear()
+
+
+# Function to send one GET request to the ASGI app: returns (status, headers, body)
+def get(path, query='', **headers):
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+             'headers': [(k.replace('_', '-').encode(), v.encode()) for k, v in headers.items()]}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request'}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(api.app(scope, receive, send))
+    return (messages[0]['status'], {k.decode(): v.decode() for k, v in messages[0]['headers']},
+            messages[1]['body'])
+
+
+def test_etag_differs_per_format_and_encoding():
+    tags = {get('/metricas', **headers)[1]['etag'] for headers in
+            [{}, {'accept_encoding': 'gzip'}, {'accept': api.ARROW_MEDIA_TYPE},
+             {'accept': api.ARROW_MEDIA_TYPE, 'accept_encoding': 'gzip'}]}
+    assert len(tags) == 4
+
+
+def test_not_modified_only_for_the_same_representation():
+    etag = get('/metricas')[1]['etag']
+    assert get('/metricas', if_none_match=etag)[0] == 304
+    assert get('/metricas', accept_encoding='gzip', if_none_match=etag)[0] == 200
+
+
+def test_unknown_entity_is_not_found_even_with_a_matching_etag():
+    etag = get('/metricas')[1]['etag']
+    assert get('/entidades/NO EXISTE/metricas', if_none_match=etag)[0] == 404
+
+
+@pytest.mark.parametrize('n', ['0', '-5', 'tres'])
+def test_peers_reject_invalid_n(n):
+    entity = api.cache.combined['entidad'].iloc[0]
+    assert get(f'/entidades/{entity}/competidores', f'n={n}')[0] == 400
+    assert get(f'/entidades/{entity}/competidores', 'n=2')[0] == 200
+
+
+def test_sector_serves_the_materialized_table():
+    status, _, body = get('/sector')
+    assert status == 200
+    assert api.cache.sector is not None
+    assert len(api.cache.sector) == len(main.compute_sector_aggregates(api.cache.combined))
+
+
+def test_metrics_are_the_snapshot_table():
+    assert api.cache.metrics.equals(main.read_snapshot_table(api.cache.version, 'metrics'))
+
+
+def test_refreshed_sources_are_reloaded_with_a_new_etag(monkeypatch):
+    monkeypatch.setattr(api, 'RELOAD_CHECK_SECONDS', 0)
+    etag = get('/metricas')[1]['etag']
+    with monkeypatch.context() as patch:
+        # A source removed from the registry changes the source files, hence the build
+        patch.setattr(main, 'ENTITY_SOURCES', {'Sociedad': main.ENTITY_SOURCES['Sociedad']})
+        status, headers, _ = get('/metricas', if_none_match=etag)
+        assert status == 200
+        assert headers['etag'] != etag
+        assert set(api.cache.combined['tipo']) == {'Sociedad'}
+    assert get('/metricas', if_none_match=etag)[0] == 304
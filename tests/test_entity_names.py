@@ -0,0 +1,74 @@
+"""Matching of entity name variants"""
+import pandas as pd
+import pytest
+
+import main
+
+
+@pytest.fixture(params=['todos_los_pares', 'subcadenas'], autouse=True)
+def legacy_lookup(request, monkeypatch):
+    """Run each test with the pairwise comparison and with the substring lookup of legacy_match_pairs"""
+    if request.param == 'subcadenas':
+        monkeypatch.setattr(main, 'LEGACY_PAIRWISE_MAX_NAMES', 0)
+
+
+def test_legacy_rules_match_names_that_differ_in_spaces():
+    mapping, audit = main.match_entity_names(['GVC GAESCO', 'GVCGAESCOVALORES'], [1, 2], threshold=None)
+    assert mapping == {'GVC GAESCO': 'GVCGAESCOVALORES'}
+    assert audit['regla'].tolist() == ['contenido']
+
+
+def test_containment_is_found_across_different_prefixes():
+    names = ['RENTA 4', 'BANCO RENTA4 VALORES', 'INVERSIS', 'ANDBANK INVERSIS GESTION']
+    mapping, _ = main.match_entity_names(names, [1, 2, 1, 2], threshold=None)
+    assert mapping == {'RENTA 4': 'BANCO RENTA4 VALORES', 'INVERSIS': 'ANDBANK INVERSIS GESTION'}
+
+
+def test_audit_rule_is_the_one_matching_the_canonical_name():
+    # B contains A and shares C's 10-char prefix, so A only reaches the canonical C through B
+    names = ['ALFA', 'ALFABETAGAMMA', 'ALFABETAGAXXXX']
+    mapping, audit = main.match_entity_names(names, [0, 0, 5], threshold=None)
+    assert mapping == {'ALFA': 'ALFABETAGAXXXX', 'ALFABETAGAMMA': 'ALFABETAGAXXXX'}
+    assert dict(zip(audit['entidad_original'], audit['regla'])) == {'ALFA': 'contenido', 'ALFABETAGAMMA': 'prefijo'}
+
+
+def test_chains_of_matches_do_not_merge_unrelated_entities():
+    names = ['BANCO SANTANDER', 'SANTANDER', 'SANTANDER CAPITAL MARKETS', 'CAPITAL MARKETS', 'MARKETS',
+             'BANKINTER MARKETS', 'BANKINTER']
+    for threshold in [None, main.FUZZY_MATCH_THRESHOLD]:
+        mapping, audit = main.match_entity_names(names, [1] * len(names), threshold=threshold)
+        assert mapping == {'SANTANDER': 'SANTANDER CAPITAL MARKETS', 'CAPITAL MARKETS': 'SANTANDER CAPITAL MARKETS',
+                           'MARKETS': 'SANTANDER CAPITAL MARKETS', 'BANKINTER': 'BANKINTER MARKETS'}
+        assert audit['regla'].isin(['contenido', 'prefijo', 'trigramas']).all()
+
+
+def test_fuzzy_rule_matches_legal_form_spellings():
+    names = ['ACME INVERSIONES, S.V., S.A.', 'ACME INVERSIONES SA SV', 'OTRA ENTIDAD, A.V.']
+    mapping, audit = main.match_entity_names(names, [5, 1, 3])
+    assert mapping == {'ACME INVERSIONES SA SV': 'ACME INVERSIONES, S.V., S.A.'}
+    assert audit['regla'].tolist() == ['prefijo']
+
+    mapping, audit = main.match_entity_names(['INVERSIS ACME SA SV', 'ACME INVERSIS, S.V., S.A.'], [1, 5])
+    assert mapping == {'INVERSIS ACME SA SV': 'ACME INVERSIS, S.V., S.A.'}
+    assert audit['regla'].tolist() == ['trigramas']
+
+
+def test_matching_does_not_depend_on_the_order_of_the_names():
+    names = ['ACME INVERSIONES, S.V., S.A.', 'ACME INVERSIONES SA SV', 'ACME INVERSIONES', 'BETA VALORES',
+             'BETA VALORES, A.V.', 'BETAVALORES GESTION', 'GAMMA', 'GAMMA CAPITAL']
+    scores = [3, 1, 2, 1, 4, 2, 1, 1]
+    expected = main.match_entity_names(names, scores)
+    for order in [list(reversed(range(len(names)))), [3, 0, 6, 1, 7, 2, 5, 4]]:
+        mapping, audit = main.match_entity_names([names[i] for i in order], [scores[i] for i in order])
+        assert mapping == expected[0]
+        assert audit.equals(expected[1])
+
+
+def test_group_size_is_bounded_on_chains_of_matches():
+    # Each joined name contains its two neighbours: one component of 41 names, but no name
+    # matches more than its neighbours, so no group can grow beyond three names
+    words = [f'ENTIDAD{chr(65 + i // 26)}{chr(65 + i % 26)}' for i in range(21)]
+    names = words + [a + b for a, b in zip(words, words[1:])]
+    mapping, _ = main.match_entity_names(names, [1] * len(names))
+    sizes = pd.Series(list(mapping.values())).value_counts()
+    assert sizes.max() + 1 <= 3
@@ -0,0 +1,599 @@
+"""Equivalence of the optimized pipeline stages with their reference implementations
+
+The references are the original row-by-row implementations of each stage,
+kept here so that any rewrite for speed can be checked against them. They run
+on Hypothesis-generated CNMV-like frames (missing months, name variants,
+duplicated filings, zeros, negative and missing values) and must give the
+same frame within a float tolerance. Timings of both implementations are
+reported at the end of the session:
+
+    python -m pytest tests -q
+"""
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('hypothesis')
+from hypothesis import HealthCheck, event, example, given, settings, strategies as st
+
+import main
+
+# Relative and absolute tolerance of the comparisons
+TOLERANCE = 1e-9
+
+SETTINGS = settings(max_examples=60, deadline=None, suppress_health_check=[HealthCheck.too_slow])
+
+
+# Reference implementations (original code; only the imports of helpers are qualified)
+
+def reference_accumulated_to_quarterly(df):
+    """Convert YTD accumulated data to quarterly data
+
+    The data comes in YTD format:
+    - MARZO: Q1 data (3 months: Jan-Mar)
+    - JUNIO: YTD through Q2 (6 months: Jan-Jun)
+    - SEPTIEMBRE: YTD through Q3 (9 months: Jan-Sep)
+    - DICIEMBRE: YTD through Q4 (12 months: Jan-Dec)
+
+    We need to convert to individual quarterly data.
+    """
+    # First, clean entity names
+    df['Denominación'] = df['Denominación'].apply(main.clean_entity_name)
+
+    # Remove rows where entity name is None
+    df = df[df['Denominación'].notna()]
+
+    df = df.sort_values(['Denominación', 'Año', 'Fecha'])
+
+    quarterly_data = []
+
+    for entity in df['Denominación'].unique():
+        if not entity:  # Skip empty entity names
+            continue
+
+        entity_data = df[df['Denominación'] == entity].copy()
+
+        for year in entity_data['Año'].unique():
+            year_data = entity_data[entity_data['Año'] == year].sort_values('Fecha')
+
+            if len(year_data) == 0:
+                continue
+
+            # Income statement columns that are accumulated YTD (need conversion)
+            ytd_cols = [
+                'Comisiones_Percibidas_Miles_EUR',
+                'Comisiones_Netas_Miles_EUR',
+                'Margen_Bruto_Miles_EUR',
+                'Gastos_Explotación_Miles_EUR',
+                'Resultados_Antes_Impuestos_Miles_EUR'
+            ]
+
+            # Balance sheet columns (point-in-time, not accumulated)
+            balance_cols = [
+                'Fondos_Propios_Miles_EUR',
+                'Activos_Totales_Miles_EUR'
+            ]
+
+            # Create a dictionary to store YTD values by month for easy access
+            ytd_values = {}
+            for _, row in year_data.iterrows():
+                ytd_values[row['Mes']] = row
+
+            # Process each quarter
+            for mes in ['MARZO', 'JUNIO', 'SEPTIEMBRE', 'DICIEMBRE']:
+                if mes not in ytd_values:
+                    continue
+
+                row = ytd_values[mes]
+                quarterly_row = row.copy()
+
+                # Determine quarter and calculate quarterly values
+                if mes == 'MARZO':
+                    quarter = 'Q1'
+                    # Q1 values are already quarterly (first 3 months)
+                    for col in ytd_cols:
+                        quarterly_row[col] = row[col]
+
+                elif mes == 'JUNIO':
+                    quarter = 'Q2'
+                    # Q2 = YTD June (6 months) - YTD March (3 months)
+                    if 'MARZO' in ytd_values:
+                        for col in ytd_cols:
+                            quarterly_row[col] = row[col] - ytd_values['MARZO'][col]
+                    else:
+                        # If no March data, June YTD represents Q1+Q2
+                        # We can't accurately separate, so we'll use half as estimate
+                        for col in ytd_cols:
+                            quarterly_row[col] = row[col] / 2
+
+                elif mes == 'SEPTIEMBRE':
+                    quarter = 'Q3'
+                    # Q3 = YTD September (9 months) - YTD June (6 months)
+                    if 'JUNIO' in ytd_values:
+                        for col in ytd_cols:
+                            quarterly_row[col] = row[col] - ytd_values['JUNIO'][col]
+                    else:
+                        # Fallback: estimate Q3 as 1/3 of YTD September
+                        for col in ytd_cols:
+                            quarterly_row[col] = row[col] / 3
+
+                elif mes == 'DICIEMBRE':
+                    quarter = 'Q4'
+                    # Q4 = YTD December (12 months) - YTD September (9 months)
+                    if 'SEPTIEMBRE' in ytd_values:
+                        for col in ytd_cols:
+                            quarterly_row[col] = row[col] - ytd_values['SEPTIEMBRE'][col]
+                    elif 'JUNIO' in ytd_values:
+                        # If no September, use June: Q4+Q3 = Dec - June
+                        for col in ytd_cols:
+                            quarterly_row[col] = (row[col] - ytd_values['JUNIO'][col]) / 2
+                    elif 'MARZO' in ytd_values:
+                        # If only March available: Q4+Q3+Q2 = Dec - March
+                        for col in ytd_cols:
+                            quarterly_row[col] = (row[col] - ytd_values['MARZO'][col]) / 3
+                    else:
+                        # Only December data: estimate Q4 as 1/4 of total
+                        for col in ytd_cols:
+                            quarterly_row[col] = row[col] / 4
+
+                # Balance sheet items remain as-is (point in time values)
+                for col in balance_cols:
+                    quarterly_row[col] = row[col]
+
+                quarterly_row['Quarter'] = quarter
+                quarterly_row['Periodo_Quarterly'] = f"{year} {quarter}"
+                quarterly_data.append(quarterly_row)
+
+    return pd.DataFrame(quarterly_data)
+
+
+def reference_merge_duplicate_entities(df):
+    """Detect and merge entities that are likely duplicates"""
+    if df.empty:
+        return df
+
+    # Group entities and calculate their data quality
+    entity_quality = df.groupby('entidad').agg({
+        'comisiones_percibidas': ['sum', 'count', 'max'],
+        'activos_totales': ['sum', 'max'],
+        'fondos_propios': ['sum', 'max']
+    }).reset_index()
+
+    # Flatten column names
+    entity_quality.columns = ['entidad'] + ['_'.join(col).strip() if col[0] != 'entidad' else col for col in entity_quality.columns[1:]]
+
+    # Calculate a quality score
+    entity_quality['quality_score'] = (
+        (entity_quality['comisiones_percibidas_sum'].abs() > 0).astype(int) * 10 +
+        (entity_quality['activos_totales_sum'] > 0).astype(int) * 5 +
+        entity_quality['comisiones_percibidas_count'] * 2
+    )
+
+    # Sort by entity name to group similar names together
+    entity_quality = entity_quality.sort_values('entidad')
+
+    # Dictionary to map duplicates to the best version
+    entity_mapping = {}
+    processed = set()
+
+    entities = entity_quality['entidad'].tolist()
+
+    for i, entity1 in enumerate(entities):
+        if entity1 in processed:
+            continue
+
+        # Check for potential duplicates
+        potential_duplicates = []
+        entity1_upper = entity1.upper().replace('.', '').replace(',', '').replace(' ', '')
+
+        for j, entity2 in enumerate(entities):
+            if i == j or entity2 in processed:
+                continue
+
+            entity2_upper = entity2.upper().replace('.', '').replace(',', '').replace(' ', '')
+
+            # Check if one is contained in the other or they're very similar
+            if (entity1_upper in entity2_upper or
+                entity2_upper in entity1_upper or
+                entity1_upper.startswith(entity2_upper[:min(10, len(entity2_upper))]) or
+                entity2_upper.startswith(entity1_upper[:min(10, len(entity1_upper))])):
+
+                potential_duplicates.append(entity2)
+
+        if potential_duplicates:
+            # Include the original entity in the list
+            all_versions = [entity1] + potential_duplicates
+
+            # Get quality scores for all versions
+            versions_with_scores = []
+            for version in all_versions:
+                score = entity_quality[entity_quality['entidad'] == version]['quality_score'].values
+                if len(score) > 0:
+                    versions_with_scores.append((version, score[0]))
+
+            # Sort by quality score (descending) and then by name length (longer is usually more complete)
+            versions_with_scores.sort(key=lambda x: (-x[1], -len(x[0])))
+
+            # The best version is the one with highest score
+            best_version = versions_with_scores[0][0]
+
+            # Map all versions to the best one
+            for version, _ in versions_with_scores:
+                if version != best_version:
+                    entity_mapping[version] = best_version
+                processed.add(version)
+
+    # Apply the mapping
+    if entity_mapping:
+        df['entidad'] = df['entidad'].replace(entity_mapping)
+
+    # After merging names, consolidate the data
+    # For duplicate entity-period combinations, keep the row with most data
+    df['data_completeness'] = (
+        (df['comisiones_percibidas'].abs() > 0).astype(int) * 3 +
+        (df['activos_totales'] > 0).astype(int) * 2 +
+        (df['fondos_propios'] != 0).astype(int)
+    )
+
+    df = df.sort_values(['entidad', 'periodo', 'data_completeness'], ascending=[True, True, False])
+    df = df.drop_duplicates(subset=['entidad', 'periodo'], keep='first')
+    df = df.drop('data_completeness', axis=1)
+
+    return df
+
+
+def reference_consolidate_duplicates(df):
+    # Calculate a "data quality score" for each entity
+    df['data_score'] = (
+        (df['comisiones_percibidas'].abs() > 0).astype(int) * 3 +  # Revenue is most important
+        (df['activos_totales'].abs() > 0).astype(int) * 2 +
+        (df['fondos_propios'].abs() > 0).astype(int) +
+        (df['resultados_antes_impuestos'].notna()).astype(int)
+    )
+
+    # For each entity-period combination, keep only the row with highest data score
+    df = df.sort_values(['entidad', 'periodo', 'data_score'], ascending=[True, True, False])
+    df = df.drop_duplicates(subset=['entidad', 'periodo'], keep='first')
+    df = df.drop('data_score', axis=1)
+
+    return df
+
+
+def reference_calculate_quarterly_metrics(df, entity):
+    entity_data = df[df['entidad'] == entity].sort_values('fecha')
+
+    if len(entity_data) < 1:
+        return None
+
+    metrics = []
+    for i in range(len(entity_data)):
+        row = entity_data.iloc[i]
+        metrics_dict = {
+            'periodo': row['periodo'],
+            'fecha': row['fecha'],
+            'tipo': row['tipo'],
+            'fondos_propios': row['fondos_propios'],
+            'activos_totales': row['activos_totales'],
+            'comisiones_percibidas': row['comisiones_percibidas'],
+            'comisiones_netas': row['comisiones_netas'],
+            'margen_bruto': row['margen_bruto'],
+            'gastos_explotacion': row['gastos_explotacion'],
+            'resultados_antes_impuestos': row['resultados_antes_impuestos'],
+            'ROA': (row['resultados_antes_impuestos'] / row['activos_totales'] * 100) if row['activos_totales'] > 0 else 0,
+            'ROE': (row['resultados_antes_impuestos'] / row['fondos_propios'] * 100) if row['fondos_propios'] > 0 else 0,
+            'ratio_eficiencia': (row['gastos_explotacion'] / row['margen_bruto'] * 100) if row['margen_bruto'] > 0 else 0,
+            'margen_neto': (row['resultados_antes_impuestos'] / row['comisiones_percibidas'] * 100) if row['comisiones_percibidas'] > 0 else 0,
+            'apalancamiento': (row['activos_totales'] / row['fondos_propios']) if row['fondos_propios'] > 0 else 0
+        }
+
+        # Calculate quarter-to-quarter changes
+        if i > 0:
+            prev_row = entity_data.iloc[i-1]
+            metrics_dict['var_activos'] = ((row['activos_totales'] - prev_row['activos_totales']) / prev_row['activos_totales'] * 100) if prev_row['activos_totales'] > 0 else 0
+            metrics_dict['var_ingresos'] = ((row['comisiones_percibidas'] - prev_row['comisiones_percibidas']) / prev_row['comisiones_percibidas'] * 100) if prev_row['comisiones_percibidas'] > 0 else 0
+            metrics_dict['var_beneficio'] = ((row['resultados_antes_impuestos'] - prev_row['resultados_antes_impuestos']) / abs(prev_row['resultados_antes_impuestos']) * 100) if prev_row['resultados_antes_impuestos'] != 0 else 0
+        else:
+            metrics_dict['var_activos'] = 0
+            metrics_dict['var_ingresos'] = 0
+            metrics_dict['var_beneficio'] = 0
+
+        metrics.append(metrics_dict)
+
+    return pd.DataFrame(metrics)
+
+
+# Strategies for CNMV-like frames
+
+MONTHS = list(main.MONTH_ORDER)
+
+# Processed (quarterly) value columns
+VALUE_COLUMNS = ['fondos_propios', 'activos_totales', 'comisiones_percibidas', 'comisiones_netas',
+                 'margen_bruto', 'gastos_explotacion', 'resultados_antes_impuestos']
+
+# Spellings of the same name that clean_entity_name normalizes
+NAME_SPELLINGS = ['{}', '{}.', ' {} ', '{},', '{}  ']
+
+# Names under which the same entity is filed
+NAME_VARIANTS = [
+    lambda base: base,
+    lambda base: base + ', S.V.',
+    lambda base: base + ', S.V., S.A.',
+    lambda base: base + ' SOCIEDAD DE VALORES',
+    # Match only once spaces are removed
+    lambda base: base.replace(' ', ''),
+    lambda base: base.replace(' ', '') + 'VALORES',
+    # Contains the name under another 10-char prefix
+    lambda base: 'GRUPO' + base.replace(' ', '') + ' VALORES',
+    # Matches only by trigram similarity (same words in another order)
+    lambda base: ' '.join(reversed(base.split())) + ' SA SV'
+]
+
+words = st.text(alphabet='ABCDEFGHIJKLMNOPQRSTUVWXYZ', min_size=2, max_size=9)
+base_names = st.lists(words, min_size=2, max_size=3).map(' '.join)
+amounts = st.one_of(st.just(0.0), st.integers(-2_000, 50_000).map(float))
+
+
+# Function to reduce a name as the legacy name-matching rules do
+def compact_name(name):
+    return name.upper().replace('.', '').replace(',', '').replace(' ', '')
+
+
+# Function to check whether the legacy rules match two names
+def legacy_names_match(a, b):
+    ca, cb = compact_name(a), compact_name(b)
+    return ca in cb or cb in ca or ca.startswith(cb[:10]) or cb.startswith(ca[:10])
+
+
+# Function to check whether two names match: legacy rules, or trigram similarity from threshold on
+def names_match(a, b, threshold=None):
+    if legacy_names_match(a, b):
+        return True
+    if threshold is None:
+        return False
+    trigrams_a, trigrams_b = (main.name_trigrams(main.entity_match_key(name)) for name in (a, b))
+    return main.trigram_similarity(trigrams_a, trigrams_b) >= threshold
+
+
+# Function to group names linked by the matching rules, directly or through other names
+def name_groups(names, threshold=None):
+    groups = []
+    for name in names:
+        linked = [group for group in groups if any(names_match(name, other, threshold) for other in group)]
+        groups = [group for group in groups if group not in linked] + [sorted({name}.union(*linked))]
+    return groups
+
+
+@st.composite
+def raw_filings(draw, complete_years=False):
+    """Raw YTD filings of a few entities: months may be missing, figures may be zero, negative or missing"""
+    raw_amounts = st.one_of(amounts, st.just(np.nan)) if not complete_years else amounts
+    bases = draw(st.lists(base_names, min_size=1, max_size=3, unique_by=main.clean_entity_name))
+    rows = []
+    for base in bases:
+        first_year = draw(st.integers(2018, 2023))
+        for year in range(first_year, first_year + draw(st.integers(1, 3))):
+            months = MONTHS if complete_years else draw(st.lists(st.sampled_from(MONTHS), min_size=1,
+                                                                 max_size=4, unique=True))
+            for month in months:
+                # Some filings come twice, under another spelling of the name
+                for spelling in draw(st.lists(st.sampled_from(NAME_SPELLINGS), min_size=1, max_size=2)):
+                    rows.append({
+                        'Tipo_Entidad': 'Sociedad de Valores', 'Periodo': f'{month} {year}', 'Año': year,
+                        'Mes': month, 'Denominación': spelling.format(base),
+                        **{col: draw(raw_amounts) for col in main.RAW_VALUE_COLUMNS},
+                        'Fecha': pd.Timestamp(year, 3 * main.MONTH_ORDER[month], 1)
+                    })
+    return main.normalize_raw_types(pd.DataFrame(rows))
+
+
+@st.composite
+def quarterly_frames(draw, variants=NAME_VARIANTS[:1], duplicates=False):
+    """Processed quarterly rows of a few entities, under one or more names each"""
+    periods = [f'{year} Q{quarter}' for year in range(2020, 2024) for quarter in range(1, 5)]
+    bases = draw(st.lists(base_names, min_size=1, max_size=4, unique_by=lambda name: compact_name(name)[:10]))
+    rows = []
+    for base in bases:
+        for variant in draw(st.lists(st.sampled_from(variants), min_size=1, max_size=len(variants), unique=True)):
+            if duplicates:
+                quarters = draw(st.lists(st.sampled_from(periods), min_size=1, max_size=8))
+            else:
+                quarters = draw(st.lists(st.sampled_from(periods), min_size=1, max_size=8, unique=True))
+            for period in quarters:
+                year, quarter = int(period[:4]), int(period[-1])
+                rows.append({
+                    'entidad': variant(base), 'periodo': period, 'tipo': 'Sociedad',
+                    'fecha': pd.Timestamp(year, 3 * quarter, 1),
+                    **{col: draw(amounts) for col in VALUE_COLUMNS}
+                })
+    return pd.DataFrame(rows)
+
+
+# Function to run the reference and the optimized implementation on copies of the same input
+def run_both(timings, stage, reference, optimized, df):
+    start = time.perf_counter()
+    expected = reference(df.copy())
+    middle = time.perf_counter()
+    result = optimized(df.copy())
+    timings[stage].append((middle - start, time.perf_counter() - middle))
+    return expected, result
+
+
+# Function to assert that two frames hold the same values (dtypes may differ)
+def assert_equivalent(expected, result):
+    expected = expected.infer_objects()
+    pd.testing.assert_frame_equal(expected, result[expected.columns], check_dtype=False,
+                                  rtol=TOLERANCE, atol=TOLERANCE)
+
+
+@SETTINGS
+@given(raw=raw_filings())
+def test_accumulated_to_quarterly_matches_reference(timings, raw):
+    expected, result = run_both(timings, 'accumulated_to_quarterly', reference_accumulated_to_quarterly,
+                                lambda df: main.accumulated_to_quarterly(df, imputation='proporcional'), raw)
+    assert_equivalent(expected, result)
+
+
+@SETTINGS
+@given(raw=raw_filings(complete_years=True))
+def test_seasonal_imputation_only_changes_incomplete_years(raw):
+    proportional = main.accumulated_to_quarterly(raw.copy(), imputation='proporcional')
+    seasonal = main.accumulated_to_quarterly(raw.copy(), imputation='estacional')
+    pd.testing.assert_frame_equal(proportional, seasonal, rtol=TOLERANCE, atol=TOLERANCE)
+    assert not seasonal['imputado'].any()
+
+
+# Function to build a frame with one quarter of activity per name (each in its own quarter)
+def named_frame(names):
+    return pd.DataFrame([{'entidad': name, 'periodo': f'{2000 + i} Q1', 'tipo': 'Sociedad',
+                          'fecha': pd.Timestamp(2000 + i, 3, 1), **{col: float(i + 1) for col in VALUE_COLUMNS}}
+                         for i, name in enumerate(names)])
+
+
+# Function to read which name each input name of a named_frame ended up under
+def merged_names(df, result):
+    return dict(zip(df['entidad'], result.set_index('periodo').loc[df['periodo'], 'entidad']))
+
+
+# Function to score the entities as the reference does when it picks a canonical name
+def reference_quality_scores(df):
+    entities = df.groupby('entidad')
+    return ((entities['comisiones_percibidas'].sum().abs() > 0).astype(int) * 10
+            + (entities['activos_totales'].sum() > 0).astype(int) * 5
+            + entities['comisiones_percibidas'].count() * 2)
+
+
+@SETTINGS
+@given(df=quarterly_frames(variants=NAME_VARIANTS), threshold=st.sampled_from([None, main.FUZZY_MATCH_THRESHOLD]))
+@example(df=named_frame(['GVC GAESCO', 'GVCGAESCOVALORES']), threshold=None)
+@example(df=named_frame(['RENTA 4', 'BANCO RENTA4 VALORES', 'INVERSIS', 'ANDBANK INVERSIS GESTION']),
+         threshold=None)
+@example(df=named_frame(['ACME INVERSIONES, S.V., S.A.', 'ACME INVERSIONES SA SV', 'OTRA ENTIDAD, A.V.']),
+         threshold=main.FUZZY_MATCH_THRESHOLD)
+def test_merge_duplicate_entities_matches_reference(timings, df, threshold):
+    # Where every name of a group matches every other one by the legacy rules (and the fuzzy
+    # rule links nothing more), the merge must be the reference's
+    names = sorted(df['entidad'].unique())
+    groups = name_groups(names, threshold)
+    direct = groups == name_groups(names) and all(legacy_names_match(a, b) for group in groups
+                                                  for a in group for b in group)
+    event('grupos directos' if direct else 'cadenas o coincidencias difusas')
+    stage = 'merge_duplicate_entities' if threshold is None else 'merge_duplicate_entities (difusa)'
+    expected, (result, audit) = run_both(
+        timings, stage, reference_merge_duplicate_entities,
+        lambda df: main.merge_duplicate_entities(df, threshold=threshold, return_audit=True), df
+    )
+    if direct:
+        assert_equivalent(expected, result)
+
+    # Always: each name is merged into a canonical name it matches directly, and the canonical
+    # name is the best of those merged into it
+    scores = reference_quality_scores(df)
+    for original, canonical in zip(audit['entidad_original'], audit['entidad_canonica']):
+        assert names_match(original, canonical, threshold)
+    assert not set(audit['entidad_original']) & set(audit['entidad_canonica'])
+    for canonical, originals in audit.groupby('entidad_canonica')['entidad_original']:
+        assert min([canonical, *originals], key=lambda name: (-scores[name], -len(name), name)) == canonical
+    assert set(result['entidad']) == set(names) - set(audit['entidad_original'])
+
+
+# Intended divergences of merge_duplicate_entities from the reference
+
+def test_merge_divergence_chains_of_matches():
+    # The reference merges each name, in alphabetical order, with the names not yet merged that
+    # match it; the optimized version merges each name into the best name it matches, in any order
+    df = named_frame(['BANCO SANTANDER', 'SANTANDER', 'SANTANDER CAPITAL MARKETS', 'CAPITAL MARKETS', 'MARKETS',
+                      'BANKINTER MARKETS', 'BANKINTER'])
+    assert merged_names(df, reference_merge_duplicate_entities(df.copy())) == {
+        'BANCO SANTANDER': 'BANCO SANTANDER', 'SANTANDER': 'BANCO SANTANDER',
+        'SANTANDER CAPITAL MARKETS': 'SANTANDER CAPITAL MARKETS', 'CAPITAL MARKETS': 'SANTANDER CAPITAL MARKETS',
+        'MARKETS': 'SANTANDER CAPITAL MARKETS', 'BANKINTER MARKETS': 'BANKINTER MARKETS',
+        'BANKINTER': 'BANKINTER MARKETS'
+    }
+    for threshold in [None, main.FUZZY_MATCH_THRESHOLD]:
+        assert merged_names(df, main.merge_duplicate_entities(df.copy(), threshold=threshold)) == {
+            'BANCO SANTANDER': 'BANCO SANTANDER', 'SANTANDER': 'SANTANDER CAPITAL MARKETS',
+            'SANTANDER CAPITAL MARKETS': 'SANTANDER CAPITAL MARKETS', 'CAPITAL MARKETS': 'SANTANDER CAPITAL MARKETS',
+            'MARKETS': 'SANTANDER CAPITAL MARKETS', 'BANKINTER MARKETS': 'BANKINTER MARKETS',
+            'BANKINTER': 'BANKINTER MARKETS'
+        }
+
+
+def test_merge_divergence_fuzzy_rule():
+    # Same words in another order and legal form: apart in the reference, merged by the trigram rule
+    df = named_frame(['INVERSIS ACME SA SV', 'ACME INVERSIS, S.V., S.A.'])
+    assert sorted(reference_merge_duplicate_entities(df.copy())['entidad']) == sorted(df['entidad'])
+    assert main.merge_duplicate_entities(df.copy(), threshold=None)['entidad'].nunique() == 2
+    assert set(main.merge_duplicate_entities(df.copy())['entidad']) == {'ACME INVERSIS, S.V., S.A.'}
+
+
+@SETTINGS
+@given(df=quarterly_frames(duplicates=True))
+def test_consolidate_duplicates_matches_reference(timings, df):
+    expected, result = run_both(timings, 'consolidate_duplicates', reference_consolidate_duplicates,
+                                main.consolidate_duplicates, df)
+    assert_equivalent(expected, result)
+
+
+# Variations the original only divided by a positive previous value (0 otherwise): source column
+POSITIVE_BASE_VARIATIONS = {'var_activos': 'activos_totales', 'var_ingresos': 'comisiones_percibidas'}
+
+
+# Function to compare the original metrics with the default 'abs' growth policy
+def assert_metrics_equivalent(expected, result):
+    """Equal, except that after a zero or negative value the original gives 0 for
+    POSITIVE_BASE_VARIATIONS where the 'abs' policy divides by |prev| (0 after a zero)"""
+    assert_equivalent(expected.drop(columns=list(POSITIVE_BASE_VARIATIONS)), result)
+    for target, col in POSITIVE_BASE_VARIATIONS.items():
+        current, previous = expected[col].to_numpy(dtype=float), expected[col].shift(1).to_numpy(dtype=float)
+        original = np.isnan(previous) | (previous > 0)
+        np.testing.assert_allclose(result[target].to_numpy()[original], expected[target].to_numpy()[original],
+                                   rtol=TOLERANCE, atol=TOLERANCE)
+        assert (expected[target].to_numpy()[~original] == 0).all()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            abs_rate = np.where(previous == 0, 0, (current - previous) / np.abs(previous) * 100)
+        np.testing.assert_allclose(result[target].to_numpy()[~original], abs_rate[~original],
+                                   rtol=TOLERANCE, atol=TOLERANCE)
+
+
+@SETTINGS
+@given(df=quarterly_frames())
+def test_calculate_quarterly_metrics_matches_reference(timings, df):
+    for entity in df['entidad'].unique():
+        expected, result = run_both(timings, 'calculate_quarterly_metrics',
+                                    lambda df: reference_calculate_quarterly_metrics(df, entity),
+                                    lambda df: main.calculate_quarterly_metrics(df, entity), df)
+        assert_metrics_equivalent(expected, result)
+
+
+# Larger inputs, so that the timings show how each implementation scales
+
+def test_accumulated_to_quarterly_matches_reference_at_scale(timings):
+    import benchmark
+
+    raw = main.normalize_raw_types(benchmark.synthetic_raw_filings(100, 5, 'Sociedad de Valores'))
+    expected, result = run_both(timings, 'accumulated_to_quarterly (2.000)', reference_accumulated_to_quarterly,
+                                lambda df: main.accumulated_to_quarterly(df, imputation='proporcional'), raw)
+    assert_equivalent(expected, result)
+
+
+def test_consolidate_duplicates_matches_reference_at_scale(timings):
+    import benchmark
+
+    data = benchmark.synthetic_dataset(2_000, 40)
+    refiled = data.sample(frac=0.2, random_state=0).assign(comisiones_percibidas=0.0)
+    expected, result = run_both(timings, 'consolidate_duplicates (96.000)', reference_consolidate_duplicates,
+                                main.consolidate_duplicates, pd.concat([data, refiled], ignore_index=True))
+    assert_equivalent(expected, result)
+
+
+def test_calculate_quarterly_metrics_matches_reference_at_scale(timings):
+    import benchmark
+
+    data = benchmark.synthetic_dataset(20, 100)
+    entity = data['entidad'].iloc[0]
+    expected, result = run_both(timings, 'calculate_quarterly_metrics (100)',
+                                lambda df: reference_calculate_quarterly_metrics(df, entity),
+                                lambda df: main.calculate_quarterly_metrics(df, entity), data)
+    assert_metrics_equivalent(expected, result)
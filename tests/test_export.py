@@ -0,0 +1,41 @@
+"""Exports returned by export_dataset must be accepted by st.download_button"""
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+
+import main
+
+
+def sample_frame():
+    return pd.DataFrame({
+        'entidad': ['A', 'A', 'B', 'B', 'C'],
+        'periodo': ['2024 Q1', '2024 Q2', '2024 Q1', '2024 Q2', '2024 Q1'],
+        'comisiones_percibidas': [1.5, -2.0, 0.0, np.nan, 1e6]
+    })
+
+
+READERS = {
+    'csv': pd.read_csv,
+    'parquet': pd.read_parquet,
+    'xlsx': pd.read_excel
+}
+
+
+@pytest.mark.parametrize('fmt', sorted(main.EXPORT_WRITERS))
+def test_in_memory_export_is_a_download_button_type(fmt):
+    df = sample_frame()
+    data, _ = convert_data_to_bytes_and_infer_mime(main.export_dataset(df, fmt, chunk_rows=2),
+                                                   RuntimeError('unsupported type'))
+    pd.testing.assert_frame_equal(READERS[fmt](io.BytesIO(data)), df)
+
+
+@pytest.mark.parametrize('fmt', sorted(main.EXPORT_WRITERS))
+def test_export_filters_entities_and_periods(fmt):
+    df = sample_frame()
+    data, _ = convert_data_to_bytes_and_infer_mime(
+        main.export_dataset(df, fmt, entities=['A', 'C'], periods=['2024 Q1']), RuntimeError('unsupported type')
+    )
+    assert READERS[fmt](io.BytesIO(data))['entidad'].tolist() == ['A', 'C']
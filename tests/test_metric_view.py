@@ -0,0 +1,30 @@
+"""Switching the charts between the quarterly and TTM views"""
+import pandas as pd
+
+import main
+
+
+def metrics_frame(quarters):
+    """Quarterly metrics of entity A over consecutive quarters and of B over the given number"""
+    data = pd.DataFrame({
+        'entidad': ['A'] * 6 + ['B'] * quarters,
+        'fecha': list(pd.date_range('2023-03-31', periods=6, freq='QE'))
+                 + list(pd.date_range('2023-03-31', periods=quarters, freq='QE')),
+        **{col: 100.0 for col in main.TTM_FLOW_COLUMNS + ['activos_totales', 'fondos_propios']}
+    })
+    return main.add_rolling_metrics(data).assign(var_ingresos=0.0)
+
+
+def test_entity_without_a_complete_window_has_no_ttm_rows_alone_or_with_others():
+    metrics = metrics_frame(3)
+    single = metrics[metrics['entidad'] == 'B'].drop(columns='entidad')
+    assert main.select_metric_view(single, 'TTM').empty
+    assert set(main.select_metric_view(metrics, 'TTM')['entidad']) == {'A'}
+
+
+def test_ttm_view_starts_at_the_first_complete_window():
+    metrics = metrics_frame(5)
+    single = metrics[metrics['entidad'] == 'B'].drop(columns='entidad')
+    view = main.select_metric_view(single, 'TTM')
+    assert len(view) == 2
+    assert (view['comisiones_percibidas'] == 400.0).all()
@@ -0,0 +1,19 @@
+"""Per-entity stages run on a process pool"""
+import pandas as pd
+
+import main
+
+
+def test_partition_key_is_only_computed_for_the_pool():
+    df = pd.DataFrame({'Denominación': ['A.', 'A', 'B', 'C', 'B.'], 'valor': [1.0, 2.0, 3.0, 4.0, 5.0]})
+    calls = []
+
+    def key(frame):
+        calls.append(len(frame))
+        return frame['Denominación'].map(main.clean_entity_name)
+
+    in_process = main.run_by_entity(pd.DataFrame.copy, df, key=key, workers=2)
+    assert calls == []
+    pooled = main.run_by_entity(pd.DataFrame.copy, df, key=key, workers=2, min_rows=0)
+    assert calls == [len(df)]
+    pd.testing.assert_frame_equal(pooled, in_process)
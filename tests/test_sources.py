@@ -0,0 +1,52 @@
+"""Loading the registered entity-type sources"""
+import os
+
+import pandas as pd
+import pytest
+
+import main
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    monkeypatch.setattr(main, 'STORE_DIR', str(tmp_path))
+    monkeypatch.setattr(main, 'SNAPSHOT_DIR', os.path.join(tmp_path, 'snapshots'))
+    main.load_data.clear()
+    yield tmp_path
+    main.load_data.clear()
+
+
+def test_missing_source_file_is_skipped(store, monkeypatch):
+    monkeypatch.setattr(main, 'ENTITY_SOURCES', dict(main.ENTITY_SOURCES))
+    monkeypatch.setattr(main, 'TIPO_COLORS', dict(main.TIPO_COLORS))
+    main.register_source('Gestora', os.path.join(store, 'gestoras.csv'), 'Gestoras de IIC', 'Gestora de IIC',
+                         '#48bb78')
+    combined, version = main.load_data()
+    assert set(combined['tipo']) == {'Sociedad', 'Agencia'}
+    assert version == main.dataset_version(combined)
+
+
+def test_query_views_read_the_derived_tables_of_the_requested_version(store):
+    _, version = main.load_data()
+    main.load_sector_aggregates.clear()
+    aggregates = main.load_sector_aggregates()
+    other = main.save_snapshot({'dataset': main.read_snapshot_table(version).iloc[:-1]})
+
+    sources = main.query_sources(version)
+    assert sources['sector'] == os.path.join(main.SNAPSHOT_DIR, version, 'sector_aggregates.parquet')
+    assert 'sector' not in main.query_sources(other)
+    assert main.run_query('SELECT COUNT(*) AS n FROM sector', version)['n'].item() == len(aggregates)
+    main.load_sector_aggregates.clear()
+
+
+def test_chunked_build_matches_load_data(store, monkeypatch):
+    _, version = main.load_data()
+    assert version == 'e23ef61baaad'
+    in_memory = main.SNAPSHOT_DIR
+    monkeypatch.setattr(main, 'SNAPSHOT_DIR', os.path.join(store, 'por_lotes'))
+    # Half a megabyte splits every source into several entity batches
+    assert main.build_dataset_chunked(memory_budget_mb=0.5) == version
+    for name in main.SNAPSHOT_TABLES:
+        expected = pd.read_parquet(os.path.join(in_memory, version, f'{name}.parquet'))
+        pd.testing.assert_frame_equal(main.read_snapshot_table(version, name), expected)